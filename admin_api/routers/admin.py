@@ -65,11 +65,12 @@ def _audit(db: Session, *, game_id, chat_id: int, action_type: str, phase_seq: i
 
 
 def _outbox(db: Session, *, event_type: str, game_id, payload_json: str, idem: str):
+    # relay просыпается по NOTIFY из триггера outbox_events_notify_ai после COMMIT;
+    # дубль idem пропускает триггер outbox_events_idempotency_bi (ON CONFLICT на партициях невозможен)
     db.execute(
         sql_text("""
             INSERT INTO outbox_events (event_type, aggregate_type, aggregate_id, payload, idempotency_key)
             VALUES (:event_type, 'game_session', :game_id, CAST(:payload AS jsonb), :idem)
-            ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
         """),
         {
             "event_type": event_type,
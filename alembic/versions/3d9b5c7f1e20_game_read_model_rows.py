@@ -0,0 +1,150 @@
+"""game_read_model_rows(uuid[]): the projection in one place
+
+Revision ID: 3d9b5c7f1e20
+Revises: a71c9e2f4b05
+Create Date: 2026-10-17 19:02:37.554120
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3d9b5c7f1e20'
+down_revision: Union[str, Sequence[str], None] = 'a71c9e2f4b05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# проекция (строки read model для набора игр) — единственная копия: её вызывают и
+# recompute_game_read_models(), и перестройка read model (consumer.py --rebuild, в теневую таблицу)
+ROWS_FUNCTION = """
+CREATE OR REPLACE FUNCTION game_read_model_rows(p_game_ids uuid[])
+RETURNS SETOF game_read_model AS $$
+    SELECT DISTINCT ON (gs.chat_id)
+        gs.chat_id, gs.id, gs.status, gs.current_phase, gs.phase_seq, gs.round_num,
+        gs.phase_started_at, gs.expires_at, gs.owner_tg_user_id,
+        COALESCE(p.players_total, 0), COALESCE(p.players_active, 0),
+        COALESCE(r.ready_count, 0), COALESCE(p.players_active, 0),
+        now()
+    FROM unnest(p_game_ids) WITH ORDINALITY AS g(game_id, ord)
+    JOIN game_sessions gs ON gs.id = g.game_id
+    LEFT JOIN (
+        SELECT game_id,
+               count(*)::int AS players_total,
+               (count(*) FILTER (WHERE is_active = true AND is_afk = false))::int AS players_active
+        FROM game_players
+        WHERE game_id = ANY(p_game_ids)
+        GROUP BY game_id
+    ) p ON p.game_id = gs.id
+    LEFT JOIN (
+        SELECT r.game_id, count(*)::int AS ready_count
+        FROM game_phase_ready r
+        JOIN game_sessions s ON s.id = r.game_id AND s.phase_seq = r.phase_seq
+        JOIN game_players pl ON pl.id = r.player_id
+        WHERE r.game_id = ANY(p_game_ids)
+          AND pl.is_active = true
+          AND pl.is_afk = false
+        GROUP BY r.game_id
+    ) r ON r.game_id = gs.id
+    ORDER BY gs.chat_id, g.ord DESC;
+$$ LANGUAGE sql STABLE;
+"""
+
+# результат тот же, что в 4624d62787d8; строки берёт из game_read_model_rows()
+RECOMPUTE_FUNCTION = """
+CREATE OR REPLACE FUNCTION recompute_game_read_models(p_game_ids uuid[])
+RETURNS void AS $$
+BEGIN
+    -- игра удалена/не найдена => чистим read_model строку, если была
+    DELETE FROM game_read_model rm
+    WHERE rm.game_id = ANY(p_game_ids)
+      AND NOT EXISTS (SELECT 1 FROM game_sessions gs WHERE gs.id = rm.game_id);
+
+    INSERT INTO game_read_model
+    SELECT * FROM game_read_model_rows(p_game_ids)
+    ON CONFLICT (chat_id) DO UPDATE SET
+        game_id = EXCLUDED.game_id,
+        status = EXCLUDED.status,
+        current_phase = EXCLUDED.current_phase,
+        phase_seq = EXCLUDED.phase_seq,
+        round_num = EXCLUDED.round_num,
+        phase_started_at = EXCLUDED.phase_started_at,
+        expires_at = EXCLUDED.expires_at,
+        owner_tg_user_id = EXCLUDED.owner_tg_user_id,
+        players_total = EXCLUDED.players_total,
+        players_active = EXCLUDED.players_active,
+        ready_count = EXCLUDED.ready_count,
+        ready_total = EXCLUDED.ready_total,
+        updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    op.execute(ROWS_FUNCTION)
+    op.execute(RECOMPUTE_FUNCTION)
+
+
+def downgrade():
+    # recompute_game_read_models() из 4624d62787d8, где проекция была внутри функции
+    op.execute("""
+    CREATE OR REPLACE FUNCTION recompute_game_read_models(p_game_ids uuid[])
+    RETURNS void AS $$
+    BEGIN
+        DELETE FROM game_read_model rm
+        WHERE rm.game_id = ANY(p_game_ids)
+          AND NOT EXISTS (SELECT 1 FROM game_sessions gs WHERE gs.id = rm.game_id);
+
+        INSERT INTO game_read_model (
+            chat_id, game_id, status, current_phase, phase_seq, round_num,
+            phase_started_at, expires_at, owner_tg_user_id,
+            players_total, players_active, ready_count, ready_total, updated_at
+        )
+        SELECT DISTINCT ON (gs.chat_id)
+            gs.chat_id, gs.id, gs.status, gs.current_phase, gs.phase_seq, gs.round_num,
+            gs.phase_started_at, gs.expires_at, gs.owner_tg_user_id,
+            COALESCE(p.players_total, 0), COALESCE(p.players_active, 0),
+            COALESCE(r.ready_count, 0), COALESCE(p.players_active, 0),
+            now()
+        FROM unnest(p_game_ids) WITH ORDINALITY AS g(game_id, ord)
+        JOIN game_sessions gs ON gs.id = g.game_id
+        LEFT JOIN (
+            SELECT game_id,
+                   count(*)::int AS players_total,
+                   (count(*) FILTER (WHERE is_active = true AND is_afk = false))::int AS players_active
+            FROM game_players
+            WHERE game_id = ANY(p_game_ids)
+            GROUP BY game_id
+        ) p ON p.game_id = gs.id
+        LEFT JOIN (
+            SELECT r.game_id, count(*)::int AS ready_count
+            FROM game_phase_ready r
+            JOIN game_sessions s ON s.id = r.game_id AND s.phase_seq = r.phase_seq
+            JOIN game_players pl ON pl.id = r.player_id
+            WHERE r.game_id = ANY(p_game_ids)
+              AND pl.is_active = true
+              AND pl.is_afk = false
+            GROUP BY r.game_id
+        ) r ON r.game_id = gs.id
+        ORDER BY gs.chat_id, g.ord DESC
+        ON CONFLICT (chat_id) DO UPDATE SET
+            game_id = EXCLUDED.game_id,
+            status = EXCLUDED.status,
+            current_phase = EXCLUDED.current_phase,
+            phase_seq = EXCLUDED.phase_seq,
+            round_num = EXCLUDED.round_num,
+            phase_started_at = EXCLUDED.phase_started_at,
+            expires_at = EXCLUDED.expires_at,
+            owner_tg_user_id = EXCLUDED.owner_tg_user_id,
+            players_total = EXCLUDED.players_total,
+            players_active = EXCLUDED.players_active,
+            ready_count = EXCLUDED.ready_count,
+            ready_total = EXCLUDED.ready_total,
+            updated_at = EXCLUDED.updated_at;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("DROP FUNCTION IF EXISTS game_read_model_rows(uuid[]);")
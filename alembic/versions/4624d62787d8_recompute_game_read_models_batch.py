@@ -0,0 +1,85 @@
+"""recompute_game_read_models(uuid[]) for batched consumer
+
+Revision ID: 4624d62787d8
+Revises: 54ac6b17c43a
+Create Date: 2026-10-17 14:21:05.118463
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4624d62787d8'
+down_revision: Union[str, Sequence[str], None] = '54ac6b17c43a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Тот же результат, что recompute_game_read_model(uuid) по каждой игре, но одним запросом на весь набор.
+    # Порядок массива важен: если две игры одного чата попали в одну пачку, в read_model остаётся та,
+    # что в массиве позже (как при последовательных вызовах).
+    op.execute("""
+    CREATE OR REPLACE FUNCTION recompute_game_read_models(p_game_ids uuid[])
+    RETURNS void AS $$
+    BEGIN
+        -- игра удалена/не найдена => чистим read_model строку, если была
+        DELETE FROM game_read_model rm
+        WHERE rm.game_id = ANY(p_game_ids)
+          AND NOT EXISTS (SELECT 1 FROM game_sessions gs WHERE gs.id = rm.game_id);
+
+        INSERT INTO game_read_model (
+            chat_id, game_id, status, current_phase, phase_seq, round_num,
+            phase_started_at, expires_at, owner_tg_user_id,
+            players_total, players_active, ready_count, ready_total, updated_at
+        )
+        SELECT DISTINCT ON (gs.chat_id)
+            gs.chat_id, gs.id, gs.status, gs.current_phase, gs.phase_seq, gs.round_num,
+            gs.phase_started_at, gs.expires_at, gs.owner_tg_user_id,
+            COALESCE(p.players_total, 0), COALESCE(p.players_active, 0),
+            COALESCE(r.ready_count, 0), COALESCE(p.players_active, 0),
+            now()
+        FROM unnest(p_game_ids) WITH ORDINALITY AS g(game_id, ord)
+        JOIN game_sessions gs ON gs.id = g.game_id
+        LEFT JOIN (
+            SELECT game_id,
+                   count(*)::int AS players_total,
+                   (count(*) FILTER (WHERE is_active = true AND is_afk = false))::int AS players_active
+            FROM game_players
+            WHERE game_id = ANY(p_game_ids)
+            GROUP BY game_id
+        ) p ON p.game_id = gs.id
+        LEFT JOIN (
+            SELECT r.game_id, count(*)::int AS ready_count
+            FROM game_phase_ready r
+            JOIN game_sessions s ON s.id = r.game_id AND s.phase_seq = r.phase_seq
+            JOIN game_players pl ON pl.id = r.player_id
+            WHERE r.game_id = ANY(p_game_ids)
+              AND pl.is_active = true
+              AND pl.is_afk = false
+            GROUP BY r.game_id
+        ) r ON r.game_id = gs.id
+        ORDER BY gs.chat_id, g.ord DESC
+        ON CONFLICT (chat_id) DO UPDATE SET
+            game_id = EXCLUDED.game_id,
+            status = EXCLUDED.status,
+            current_phase = EXCLUDED.current_phase,
+            phase_seq = EXCLUDED.phase_seq,
+            round_num = EXCLUDED.round_num,
+            phase_started_at = EXCLUDED.phase_started_at,
+            expires_at = EXCLUDED.expires_at,
+            owner_tg_user_id = EXCLUDED.owner_tg_user_id,
+            players_total = EXCLUDED.players_total,
+            players_active = EXCLUDED.players_active,
+            ready_count = EXCLUDED.ready_count,
+            ready_total = EXCLUDED.ready_total,
+            updated_at = EXCLUDED.updated_at;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+
+def downgrade():
+    op.execute("DROP FUNCTION IF EXISTS recompute_game_read_models(uuid[]);")
@@ -0,0 +1,234 @@
+"""partition outbox_events by created_at
+
+Revision ID: 54ac6b17c43a
+Revises: cfefc6e6a2ff
+Create Date: 2026-10-17 11:02:17.540912
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '54ac6b17c43a'
+down_revision: Union[str, Sequence[str], None] = 'cfefc6e6a2ff'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# сколько дневных партиций создаём наперёд (дальше их досоздаёт outbox_retention.py)
+PREMAKE_DAYS = 7
+
+COLUMNS = """
+    id, event_type, aggregate_type, aggregate_id, payload, created_at, published_at,
+    publish_attempts, last_error, idempotency_key, status, locked_until, lock_owner, next_retry_at
+"""
+
+
+def upgrade():
+    # 1) старая таблица уходит в сторону; её индексы больше не нужны (имена освобождаем)
+    op.execute("ALTER TABLE outbox_events RENAME TO outbox_events_legacy;")
+    op.execute("ALTER TABLE outbox_events_legacy RENAME CONSTRAINT outbox_events_pkey TO outbox_events_legacy_pkey;")
+    op.execute("DROP TRIGGER IF EXISTS outbox_events_notify_ai ON outbox_events_legacy;")
+    op.execute("DROP INDEX IF EXISTS ix_outbox_events_ready;")
+    op.execute("DROP INDEX IF EXISTS ix_outbox_events_unpublished;")
+    op.execute("DROP INDEX IF EXISTS ix_outbox_events_agg;")
+    op.execute("DROP INDEX IF EXISTS uq_outbox_events_idem_key;")
+
+    # 2) партиционированная outbox_events (PK обязан включать ключ партиционирования)
+    op.execute("""
+    CREATE TABLE outbox_events (
+        id uuid NOT NULL DEFAULT gen_random_uuid(),
+        event_type text NOT NULL,
+        aggregate_type text NOT NULL,
+        aggregate_id uuid NOT NULL,
+        payload jsonb NOT NULL DEFAULT '{}'::jsonb,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        published_at timestamptz,
+        publish_attempts integer NOT NULL DEFAULT 0,
+        last_error text,
+        idempotency_key text,
+        status text NOT NULL DEFAULT 'new',
+        locked_until timestamptz,
+        lock_owner text,
+        next_retry_at timestamptz,
+        CONSTRAINT outbox_events_pkey PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    """)
+
+    op.execute("CREATE INDEX ix_outbox_events_unpublished ON outbox_events (published_at, created_at);")
+    op.execute("CREATE INDEX ix_outbox_events_agg ON outbox_events (aggregate_type, aggregate_id, created_at);")
+    op.execute("CREATE INDEX ix_outbox_events_ready ON outbox_events (status, next_retry_at, created_at);")
+
+    # страховка: если партиции наперёд не досоздали, INSERT не падает
+    op.execute("CREATE TABLE outbox_events_default PARTITION OF outbox_events DEFAULT;")
+
+    # 3) дневная партиция [day, day+1) в UTC; строки, уже попавшие в default, переносим
+    op.execute("""
+    CREATE OR REPLACE FUNCTION outbox_events_ensure_partition(p_day date)
+    RETURNS text AS $$
+    DECLARE
+        v_name text := 'outbox_events_p' || to_char(p_day, 'YYYYMMDD');
+        v_from timestamptz := p_day::timestamp AT TIME ZONE 'UTC';
+        v_to timestamptz := (p_day + 1)::timestamp AT TIME ZONE 'UTC';
+    BEGIN
+        IF to_regclass(v_name) IS NOT NULL THEN
+            RETURN v_name;
+        END IF;
+
+        EXECUTE format('CREATE TABLE %I (LIKE outbox_events INCLUDING DEFAULTS)', v_name);
+        EXECUTE format(
+            'INSERT INTO %I SELECT * FROM outbox_events_default WHERE created_at >= %L AND created_at < %L',
+            v_name, v_from, v_to
+        );
+        EXECUTE format(
+            'DELETE FROM outbox_events_default WHERE created_at >= %L AND created_at < %L',
+            v_from, v_to
+        );
+        EXECUTE format(
+            'ALTER TABLE outbox_events ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            v_name, v_from, v_to
+        );
+        RETURN v_name;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute(f"""
+    DO $$
+    DECLARE
+        d date;
+        v_last date := (now() AT TIME ZONE 'UTC')::date + {PREMAKE_DAYS};
+    BEGIN
+        d := COALESCE(
+            (SELECT min(created_at AT TIME ZONE 'UTC')::date FROM outbox_events_legacy),
+            (now() AT TIME ZONE 'UTC')::date
+        );
+        WHILE d <= v_last LOOP
+            PERFORM outbox_events_ensure_partition(d);
+            d := d + 1;
+        END LOOP;
+    END;
+    $$;
+    """)
+
+    # 4) глобальная идемпотентность: уникальный индекс на партиционированной таблице обязан включать
+    #    created_at, поэтому ключи живут в отдельной таблице с горизонтом дедупликации
+    op.execute("""
+    CREATE TABLE outbox_idempotency_keys (
+        idempotency_key text PRIMARY KEY,
+        event_id uuid NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now()
+    );
+    """)
+    op.execute("CREATE INDEX ix_outbox_idempotency_keys_created ON outbox_idempotency_keys (created_at);")
+
+    op.execute("""
+    INSERT INTO outbox_idempotency_keys (idempotency_key, event_id, created_at)
+    SELECT idempotency_key, id, created_at
+    FROM outbox_events_legacy
+    WHERE idempotency_key IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    """)
+
+    op.execute(f"""
+    INSERT INTO outbox_events ({COLUMNS})
+    SELECT {COLUMNS}
+    FROM outbox_events_legacy;
+    """)
+
+    op.execute("DROP TABLE outbox_events_legacy;")
+
+    # 5) BEFORE INSERT: повторный idempotency_key => строка молча пропускается (как ON CONFLICT DO NOTHING).
+    #    Конкурентная вставка того же ключа ждёт на PK outbox_idempotency_keys до COMMIT/ROLLBACK первой.
+    op.execute("""
+    CREATE OR REPLACE FUNCTION trg_outbox_events_idempotency()
+    RETURNS trigger AS $$
+    BEGIN
+        IF NEW.idempotency_key IS NULL THEN
+            RETURN NEW;
+        END IF;
+
+        INSERT INTO outbox_idempotency_keys (idempotency_key, event_id, created_at)
+        VALUES (NEW.idempotency_key, NEW.id, NEW.created_at)
+        ON CONFLICT (idempotency_key) DO NOTHING;
+
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute("""
+    CREATE TRIGGER outbox_events_idempotency_bi
+    BEFORE INSERT ON outbox_events
+    FOR EACH ROW EXECUTE FUNCTION trg_outbox_events_idempotency();
+    """)
+
+    op.execute("""
+    CREATE TRIGGER outbox_events_notify_ai
+    AFTER INSERT ON outbox_events
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_events_notify();
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS outbox_events_notify_ai ON outbox_events;")
+    op.execute("DROP TRIGGER IF EXISTS outbox_events_idempotency_bi ON outbox_events;")
+    op.execute("DROP FUNCTION IF EXISTS trg_outbox_events_idempotency();")
+
+    op.execute("ALTER TABLE outbox_events RENAME TO outbox_events_partitioned;")
+    op.execute("ALTER TABLE outbox_events_partitioned RENAME CONSTRAINT outbox_events_pkey TO outbox_events_partitioned_pkey;")
+    op.execute("DROP INDEX IF EXISTS ix_outbox_events_ready;")
+    op.execute("DROP INDEX IF EXISTS ix_outbox_events_unpublished;")
+    op.execute("DROP INDEX IF EXISTS ix_outbox_events_agg;")
+
+    op.execute("""
+    CREATE TABLE outbox_events (
+        id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+        event_type text NOT NULL,
+        aggregate_type text NOT NULL,
+        aggregate_id uuid NOT NULL,
+        payload jsonb NOT NULL DEFAULT '{}'::jsonb,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        published_at timestamptz,
+        publish_attempts integer NOT NULL DEFAULT 0,
+        last_error text,
+        idempotency_key text,
+        status text NOT NULL DEFAULT 'new',
+        locked_until timestamptz,
+        lock_owner text,
+        next_retry_at timestamptz
+    );
+    """)
+
+    op.execute(f"""
+    INSERT INTO outbox_events ({COLUMNS})
+    SELECT {COLUMNS}
+    FROM outbox_events_partitioned;
+    """)
+
+    op.execute("DROP TABLE outbox_events_partitioned CASCADE;")
+    op.execute("DROP FUNCTION IF EXISTS outbox_events_ensure_partition(date);")
+    op.execute("DROP TABLE IF EXISTS outbox_idempotency_keys;")
+
+    op.create_index("ix_outbox_events_unpublished", "outbox_events", ["published_at", "created_at"])
+    op.create_index("ix_outbox_events_agg", "outbox_events", ["aggregate_type", "aggregate_id", "created_at"])
+    op.create_index("ix_outbox_events_ready", "outbox_events", ["status", "next_retry_at", "created_at"])
+    op.create_index(
+        "uq_outbox_events_idem_key",
+        "outbox_events",
+        ["idempotency_key"],
+        unique=True,
+        postgresql_where=sa.text("idempotency_key IS NOT NULL"),
+    )
+
+    op.execute("""
+    CREATE TRIGGER outbox_events_notify_ai
+    AFTER INSERT ON outbox_events
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_events_notify();
+    """)
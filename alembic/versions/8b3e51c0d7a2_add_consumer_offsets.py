@@ -0,0 +1,36 @@
+"""add consumer_offsets
+
+Revision ID: 8b3e51c0d7a2
+Revises: 4624d62787d8
+Create Date: 2026-10-17 16:40:12.903117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b3e51c0d7a2'
+down_revision: Union[str, Sequence[str], None] = '4624d62787d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Offset'ы consumer'а при CONSUMER_OFFSETS=db: пишутся в той же транзакции, что и consumed_events/read model,
+    # при назначении партиции consumer делает seek на next_offset. Kafka commit — только для мониторинга lag.
+    op.execute("""
+    CREATE TABLE consumer_offsets (
+        group_id    text        NOT NULL,
+        topic       text        NOT NULL,
+        "partition" int         NOT NULL,
+        next_offset bigint      NOT NULL,
+        updated_at  timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (group_id, topic, "partition")
+    );
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS consumer_offsets;")
@@ -0,0 +1,184 @@
+"""partition consumed_events by consumed_at
+
+Revision ID: a71c9e2f4b05
+Revises: 8b3e51c0d7a2
+Create Date: 2026-10-17 17:25:48.216390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a71c9e2f4b05'
+down_revision: Union[str, Sequence[str], None] = '8b3e51c0d7a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# сколько дневных партиций создаём наперёд (дальше их досоздаёт outbox_retention.py)
+PREMAKE_DAYS = 7
+
+COLUMNS = """
+    id, event_id, topic, "partition", kafka_offset, aggregate_type, aggregate_id, event_type, consumed_at
+"""
+
+
+def upgrade():
+    # 1) старая таблица уходит в сторону, имена индексов/constraint'ов освобождаем
+    op.execute("ALTER TABLE consumed_events RENAME TO consumed_events_legacy;")
+    op.execute("ALTER TABLE consumed_events_legacy DROP CONSTRAINT IF EXISTS uq_consumed_events_event_id;")
+    op.execute("ALTER TABLE consumed_events_legacy RENAME CONSTRAINT consumed_events_pkey TO consumed_events_legacy_pkey;")
+    op.execute("DROP INDEX IF EXISTS ix_consumed_events_aggregate;")
+
+    # 2) партиционированная consumed_events (PK обязан включать ключ партиционирования)
+    op.execute("""
+    CREATE TABLE consumed_events (
+        id uuid NOT NULL DEFAULT gen_random_uuid(),
+        event_id uuid NOT NULL,
+        topic text NOT NULL,
+        "partition" integer NOT NULL,
+        kafka_offset bigint NOT NULL,
+        aggregate_type text,
+        aggregate_id uuid,
+        event_type text,
+        consumed_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT consumed_events_pkey PRIMARY KEY (id, consumed_at)
+    ) PARTITION BY RANGE (consumed_at);
+    """)
+
+    # индексы локальные (по партиции): размер ограничен горизонтом dedup, а не временем жизни проекта
+    op.execute("CREATE INDEX ix_consumed_events_event_id ON consumed_events (event_id);")
+    op.execute("CREATE INDEX ix_consumed_events_aggregate ON consumed_events (aggregate_type, aggregate_id);")
+    # offset watermark партиции Kafka: dedup для событий старше горизонта
+    op.execute('CREATE INDEX ix_consumed_events_watermark ON consumed_events (topic, "partition", kafka_offset);')
+
+    # страховка: если партиции наперёд не досоздали, INSERT не падает
+    op.execute("CREATE TABLE consumed_events_default PARTITION OF consumed_events DEFAULT;")
+
+    # 3) дневная партиция [day, day+1) в UTC; строки, уже попавшие в default, переносим
+    op.execute("""
+    CREATE OR REPLACE FUNCTION consumed_events_ensure_partition(p_day date)
+    RETURNS text AS $$
+    DECLARE
+        v_name text := 'consumed_events_p' || to_char(p_day, 'YYYYMMDD');
+        v_from timestamptz := p_day::timestamp AT TIME ZONE 'UTC';
+        v_to timestamptz := (p_day + 1)::timestamp AT TIME ZONE 'UTC';
+    BEGIN
+        IF to_regclass(v_name) IS NOT NULL THEN
+            RETURN v_name;
+        END IF;
+
+        EXECUTE format('CREATE TABLE %I (LIKE consumed_events INCLUDING DEFAULTS)', v_name);
+        EXECUTE format(
+            'INSERT INTO %I SELECT * FROM consumed_events_default WHERE consumed_at >= %L AND consumed_at < %L',
+            v_name, v_from, v_to
+        );
+        EXECUTE format(
+            'DELETE FROM consumed_events_default WHERE consumed_at >= %L AND consumed_at < %L',
+            v_from, v_to
+        );
+        EXECUTE format(
+            'ALTER TABLE consumed_events ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            v_name, v_from, v_to
+        );
+        RETURN v_name;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute(f"""
+    DO $$
+    DECLARE
+        d date;
+        v_last date := (now() AT TIME ZONE 'UTC')::date + {PREMAKE_DAYS};
+    BEGIN
+        d := COALESCE(
+            (SELECT min(consumed_at AT TIME ZONE 'UTC')::date FROM consumed_events_legacy),
+            (now() AT TIME ZONE 'UTC')::date
+        );
+        WHILE d <= v_last LOOP
+            PERFORM consumed_events_ensure_partition(d);
+            d := d + 1;
+        END LOOP;
+    END;
+    $$;
+    """)
+
+    op.execute(f"""
+    INSERT INTO consumed_events ({COLUMNS})
+    SELECT {COLUMNS}
+    FROM consumed_events_legacy;
+    """)
+
+    op.execute("DROP TABLE consumed_events_legacy;")
+
+    # 4) уникальный индекс по event_id на партиционированной таблице невозможен (нужен consumed_at),
+    #    поэтому дедуп — BEFORE INSERT: повторный event_id в пределах горизонта => строка молча пропускается
+    #    (как ON CONFLICT DO NOTHING, RETURNING её не вернёт). Конкурентная вставка того же event_id
+    #    ждёт на advisory lock до COMMIT/ROLLBACK первой и затем видит её строку.
+    #    Горизонт берётся из сессии: consumer.py ставит consumed_events.horizon_days из
+    #    CONSUMED_EVENTS_HORIZON_DAYS на каждом соединении, и партиции старше него отсекаются при выполнении.
+    #    Без настройки (psql, другой писатель) смотрим во все партиции — их число ограничивает outbox_retention.py.
+    op.execute("""
+    CREATE OR REPLACE FUNCTION trg_consumed_events_dedup()
+    RETURNS trigger AS $$
+    DECLARE
+        v_days double precision := NULLIF(current_setting('consumed_events.horizon_days', true), '')::double precision;
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtextextended(NEW.event_id::text, 0));
+        IF EXISTS (
+            SELECT 1 FROM consumed_events
+            WHERE event_id = NEW.event_id
+              AND (v_days IS NULL OR v_days <= 0 OR consumed_at >= now() - make_interval(secs => v_days * 86400))
+        ) THEN
+            RETURN NULL;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute("""
+    CREATE TRIGGER consumed_events_dedup_bi
+    BEFORE INSERT ON consumed_events
+    FOR EACH ROW EXECUTE FUNCTION trg_consumed_events_dedup();
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS consumed_events_dedup_bi ON consumed_events;")
+    op.execute("DROP FUNCTION IF EXISTS trg_consumed_events_dedup();")
+
+    op.execute("ALTER TABLE consumed_events RENAME TO consumed_events_partitioned;")
+    op.execute("ALTER TABLE consumed_events_partitioned RENAME CONSTRAINT consumed_events_pkey TO consumed_events_partitioned_pkey;")
+    op.execute("DROP INDEX IF EXISTS ix_consumed_events_event_id;")
+    op.execute("DROP INDEX IF EXISTS ix_consumed_events_aggregate;")
+    op.execute("DROP INDEX IF EXISTS ix_consumed_events_watermark;")
+
+    op.execute("""
+    CREATE TABLE consumed_events (
+        id uuid PRIMARY KEY,
+        event_id uuid NOT NULL,
+        topic text NOT NULL,
+        "partition" integer NOT NULL,
+        kafka_offset bigint NOT NULL,
+        aggregate_type text,
+        aggregate_id uuid,
+        event_type text,
+        consumed_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT uq_consumed_events_event_id UNIQUE (event_id)
+    );
+    """)
+    op.execute("CREATE INDEX ix_consumed_events_aggregate ON consumed_events (aggregate_type, aggregate_id);")
+
+    op.execute(f"""
+    INSERT INTO consumed_events ({COLUMNS})
+    SELECT DISTINCT ON (event_id) {COLUMNS}
+    FROM consumed_events_partitioned
+    ORDER BY event_id, consumed_at;
+    """)
+
+    op.execute("DROP TABLE consumed_events_partitioned CASCADE;")
+    op.execute("DROP FUNCTION IF EXISTS consumed_events_ensure_partition(date);")
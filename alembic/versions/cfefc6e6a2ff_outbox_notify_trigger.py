@@ -0,0 +1,44 @@
+"""outbox notify trigger
+
+Revision ID: cfefc6e6a2ff
+Revises: d4d2ad8319b7
+Create Date: 2026-10-17 10:12:41.208311
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'cfefc6e6a2ff'
+down_revision: Union[str, Sequence[str], None] = 'd4d2ad8319b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # NOTIFY доставляется только после COMMIT (и схлопывается внутри транзакции),
+    # поэтому relay просыпается ровно тогда, когда новые строки уже видны.
+    # FOR EACH STATEMENT — один notify на INSERT, а не на каждую строку.
+    op.execute("""
+    CREATE OR REPLACE FUNCTION trg_outbox_events_notify()
+    RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('outbox_events', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute("""
+    DROP TRIGGER IF EXISTS outbox_events_notify_ai ON outbox_events;
+    CREATE TRIGGER outbox_events_notify_ai
+    AFTER INSERT ON outbox_events
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_events_notify();
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS outbox_events_notify_ai ON outbox_events;")
+    op.execute("DROP FUNCTION IF EXISTS trg_outbox_events_notify();")
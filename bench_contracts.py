@@ -0,0 +1,91 @@
+"""
+Contract validation microbenchmark: messages/sec per validation mode on real relay envelopes (bytes as they
+arrive from Kafka), single thread, no broker or DB.
+
+- json:       json.loads only (what the consumer does with CONSUMER_VALIDATE=off)
+- legacy:     contracts.parse_and_validate() (json.loads + EventEnvelope model + payload model)
+- envelope / sampled / full: contracts.FastValidator straight from bytes
+
+    python bench_contracts.py                       # 20000 synthetic envelopes, every mode
+    python bench_contracts.py -n 100000 --sample-rate 0.01 --repeat 5
+    python bench_contracts.py --from-db 5000        # last 5000 rows of outbox_events
+"""
+import json
+import time
+import argparse
+
+from bench_producer import db_rows, encoded_records, synthetic_rows
+from services.contracts.contracts import FastValidator, InvalidEvent, UnknownEventType, parse_and_validate
+
+
+def _legacy(raw: bytes):
+    try:
+        return parse_and_validate(raw)
+    except (InvalidEvent, UnknownEventType):
+        return None
+
+
+def modes(sample_rate: float) -> dict:
+    fast = {m: FastValidator(m, sample_rate=sample_rate) for m in ("envelope", "sampled", "full")}
+    return {
+        "json": json.loads,
+        "legacy": _legacy,
+        "envelope": fast["envelope"].validate,
+        "sampled": fast["sampled"].validate,
+        "full": fast["full"].validate,
+    }
+
+
+def run_one(fn, values: list[bytes], repeat: int) -> dict:
+    fn(values[0])  # validators are built on first use, keep that out of the timing
+    best = None
+    rejected = 0
+    for _ in range(repeat):
+        rejected = 0
+        t0 = time.perf_counter()
+        for v in values:
+            try:
+                fn(v)
+            except InvalidEvent:
+                rejected += 1
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "msgs_per_sec": int(len(values) / best) if best > 0 else None,
+        "us_per_msg": round(best / len(values) * 1e6, 2),
+        "rejected": rejected,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20000, help="number of synthetic envelopes")
+    ap.add_argument("--from-db", type=int, default=0, help="use the last N outbox_events rows instead")
+    ap.add_argument("--modes", default="json,legacy,envelope,sampled,full")
+    ap.add_argument("--sample-rate", type=float, default=0.05, help="payload share validated in 'sampled'")
+    ap.add_argument("--repeat", type=int, default=3, help="runs per mode, the best one is reported")
+    args = ap.parse_args()
+
+    rows = db_rows(args.from_db) if args.from_db else synthetic_rows(args.n)
+    values = [v for _, v in encoded_records(rows)]
+    available = modes(args.sample_rate)
+    results = {}
+    for mode in args.modes.split(","):
+        results[mode] = run_one(available[mode], values, args.repeat)
+
+    base = results.get("legacy", {}).get("msgs_per_sec")
+    if base:
+        for r in results.values():
+            r["x_legacy"] = round(r["msgs_per_sec"] / base, 2)
+
+    print(json.dumps({
+        "messages": len(values),
+        "source": "db" if args.from_db else "synthetic",
+        "avg_value_bytes": round(sum(len(v) for v in values) / max(1, len(values)), 1),
+        "sample_rate": args.sample_rate,
+        "modes": results,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
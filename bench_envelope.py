@@ -0,0 +1,109 @@
+"""
+Envelope schema_version 1 vs 2 (compact): bytes per message and consumer decode time, on the same events.
+
+Size: value, headers and the Kafka v2 record batch (uncompressed and with the relay's codec), as the
+producer builds it. Decode, per message, single thread, what the consumer does with each version:
+
+- dedup:    what it takes to know the event_id (v1: the whole value is decoded; v2: the headers)
+- decode:   the v1-shaped envelope dict (v1: json.loads; v2: headers + contracts.decode_compact())
+- validate: contracts.FastValidator("full")
+
+    python bench_envelope.py                    # 20000 synthetic envelopes
+    python bench_envelope.py --from-db 5000     # last 5000 rows of outbox_events
+"""
+import json
+import time
+import argparse
+
+from bench_producer import CODECS, db_rows, pack_batches, synthetic_rows
+import outbox_publisher as relay
+from services.contracts.contracts import FastValidator, decode_compact, is_compact
+
+
+def records(rows: list[dict], schema_version: int) -> list[tuple[bytes, bytes, list]]:
+    out = []
+    for r in rows:
+        value, headers, _ = relay.wire_message(relay._mk_message(r), schema_version)
+        out.append((relay.serialize_key(str(r["aggregate_id"])), relay.serialize_value(value), headers or []))
+    return out
+
+
+def sizes(recs: list, codec: str, batch_bytes: int) -> dict:
+    n = len(recs)
+    out = {
+        "value_bytes": round(sum(len(v) for _, v, _ in recs) / n, 1),
+        "header_bytes": round(sum(len(k) + len(v) for _, _, h in recs for k, v in h) / n, 1),
+    }
+    for name in ("none", codec):
+        wire = sum(len(b) for b in pack_batches(recs, codec_id=CODECS[name][0], batch_bytes=batch_bytes))
+        out[f"wire_bytes_{name}"] = round(wire / n, 1)
+    return out
+
+
+def _headers(h: list) -> dict:
+    # consumer._headers(): the routing fields as str
+    return {k: v.decode("utf-8", errors="ignore") for k, v in h if v is not None}
+
+
+def _v2_dedup(value: bytes, h: list):
+    return is_compact(value) and _headers(h)["x-event-id"]
+
+
+def _v2_decode(value: bytes, h: list):
+    return decode_compact(value, _headers(h))
+
+
+def decoders() -> dict:
+    full = FastValidator("full")
+    return {
+        "dedup": (lambda v, h: json.loads(v)["event_id"], _v2_dedup),
+        "decode": (lambda v, h: json.loads(v), _v2_decode),
+        "validate": (lambda v, h: full.validate(v), lambda v, h: full.validate(v, _headers(h))),
+    }
+
+
+def timed(fn, recs: list, repeat: int) -> dict:
+    fn(recs[0][1], recs[0][2])  # validators are built on first use
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _, v, h in recs:
+            fn(v, h)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return {"msgs_per_sec": int(len(recs) / best) if best > 0 else None, "us_per_msg": round(best / len(recs) * 1e6, 2)}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20000, help="number of synthetic envelopes")
+    ap.add_argument("--from-db", type=int, default=0, help="use the last N outbox_events rows instead")
+    ap.add_argument("--batch-bytes", type=int, default=relay.PRODUCER_BATCH_BYTES)
+    ap.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is reported")
+    args = ap.parse_args()
+
+    rows = db_rows(args.from_db) if args.from_db else synthetic_rows(args.n)
+    recs = {1: records(rows, 1), 2: records(rows, 2)}
+    codec = relay.pick_compression() or "none"
+
+    size = {f"v{v}": sizes(r, codec, args.batch_bytes) for v, r in recs.items()}
+    for key in size["v1"]:
+        if size["v1"][key]:
+            size["v2"][f"{key}_x_v1"] = round(size["v2"][key] / size["v1"][key], 3)
+
+    decode = {}
+    for name, (v1, v2) in decoders().items():
+        decode[name] = {"v1": timed(v1, recs[1], args.repeat), "v2": timed(v2, recs[2], args.repeat)}
+        decode[name]["v2_x_v1"] = round(decode[name]["v2"]["msgs_per_sec"] / decode[name]["v1"]["msgs_per_sec"], 2)
+
+    print(json.dumps({
+        "messages": len(rows),
+        "source": "db" if args.from_db else "synthetic",
+        "codec": codec,
+        "size_per_msg": size,
+        "decode": decode,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,31 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime as dt
+import hashlib
 import json
+import math
 import os
+import queue
 import signal
+import threading
 import time
 import traceback
 import uuid
+import zlib
 
-from kafka import KafkaConsumer, KafkaProducer
-from sqlalchemy import create_engine, text as sql_text
+from kafka import ConsumerRebalanceListener, KafkaConsumer, KafkaProducer, TopicPartition
+from kafka.structs import OffsetAndMetadata
+from sqlalchemy import create_engine, event, text as sql_text
 from sqlalchemy.orm import sessionmaker
 
+from metrics import Counter, Gauge, Histogram, start_http_server
+from services.contracts.contracts import (
+    H_AGGREGATE_ID, H_AGGREGATE_TYPE, H_EVENT_ID, H_EVENT_TYPE, VALIDATION_MODES,
+    FastValidator, InvalidEvent, decode_compact, is_compact,
+)
+
 # ---------------------------
 # Config (env)
 # ---------------------------
@@ -23,8 +40,104 @@ GROUP_ID = os.getenv("KAFKA_CONSUMER_GROUP", "game-consumer-v1")
 MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "10"))
 IDLE_SLEEP_SEC = float(os.getenv("IDLE_SLEEP_SEC", "0.2"))
 
+# Batch mode: poll(max_records) -> one dedup lookup, one multi-row consumed_events insert,
+# one transaction and one offset commit per poll. 0 = legacy per-message loop.
+BATCH_MODE = os.getenv("CONSUMER_BATCH", "1").strip().lower() not in ("0", "false", "no", "off")
+BATCH_MAX_RECORDS = int(os.getenv("CONSUMER_BATCH_MAX_RECORDS", "500"))
+POLL_TIMEOUT_MS = int(os.getenv("CONSUMER_POLL_TIMEOUT_MS", "1000"))
+
+# Read model in batch mode: "delta" applies per-event-type increments (O(1) per game), full recompute
+# stays the repair path (mismatch, unknown event types, every READ_MODEL_REPAIR_SEC); "recompute" = always full.
+READ_MODEL_MODE = os.getenv("CONSUMER_READ_MODEL", "delta").strip().lower()
+READ_MODEL_REPAIR_SEC = float(os.getenv("CONSUMER_READ_MODEL_REPAIR_SEC", "300"))
+
+# Non-blocking retries: after CONSUMER_INLINE_ATTEMPTS failed attempts a message is forwarded to the
+# "<topic>.retry.<delay>s" tier topics and the partition moves on; the retry worker
+# (python consumer.py --retry-worker) re-delivers it when due, DLQ only after the last tier.
+# Opt-in, e.g. CONSUMER_RETRY_TIERS=1,10,60, and only together with a running retry worker; empty (default) =
+# in-place retries up to MAX_ATTEMPTS, as before.
+RETRY_TIERS = [int(x) for x in os.getenv("CONSUMER_RETRY_TIERS", "").split(",") if x.strip()]
+INLINE_ATTEMPTS = int(os.getenv("CONSUMER_INLINE_ATTEMPTS", "1"))
+RETRY_GROUP_ID = os.getenv("KAFKA_RETRY_CONSUMER_GROUP", f"{GROUP_ID}.retry")
+
+# Worker pool: records are dispatched to CONSUMER_WORKERS threads by message key (aggregate id) or by
+# partition, so ordering holds per key/partition; a partition is paused while it has
+# CONSUMER_PARTITION_MAX_IN_FLIGHT uncommitted records. 0 = everything in the polling thread.
+WORKERS = int(os.getenv("CONSUMER_WORKERS", "0"))
+WORKER_DISPATCH = os.getenv("CONSUMER_WORKER_DISPATCH", "key").strip().lower()
+PARTITION_MAX_IN_FLIGHT = int(os.getenv("CONSUMER_PARTITION_MAX_IN_FLIGHT", "1000"))
+REVOKE_DRAIN_SEC = float(os.getenv("CONSUMER_REVOKE_DRAIN_SEC", "10"))
+
+# Offsets: "kafka" = commit to Kafka per batch/message; "db" = next offset per partition is upserted into
+# consumer_offsets in the processing transaction, the consumer seeks there on assignment and commits to
+# Kafka only every CONSUMER_KAFKA_COMMIT_SEC (lag monitoring). Not combinable with CONSUMER_WORKERS.
+OFFSETS_IN_DB = os.getenv("CONSUMER_OFFSETS", "kafka").strip().lower() == "db"
+KAFKA_COMMIT_SEC = float(os.getenv("CONSUMER_KAFKA_COMMIT_SEC", "30"))
+
+# consumed_events partitions older than this are dropped (outbox_retention.py); for an event created before
+# the horizon its event_id may be gone, so dedup falls back to the offset watermark of its Kafka partition.
+DEDUP_HORIZON_DAYS = float(os.getenv("CONSUMED_EVENTS_HORIZON_DAYS", "14"))
+
+# Dedup cache in front of consumed_events lookups (see DedupCache). CONSUMER_DEDUP_LRU=0 disables it.
+DEDUP_LRU_SIZE = int(os.getenv("CONSUMER_DEDUP_LRU", "100000"))
+DEDUP_BLOOM_CAPACITY = int(os.getenv("CONSUMER_DEDUP_BLOOM_CAPACITY", "1000000"))
+DEDUP_WARM_HOURS = float(os.getenv("CONSUMER_DEDUP_WARM_HOURS", "24"))
+
+# Runtime: "loop" = poll and process in turns (optionally with CONSUMER_WORKERS); "pipeline" = StagedPipeline,
+# fetch / decode / DB apply as stages joined by bounded queues (CONSUMER_PIPELINE_QUEUE polls each), so Kafka,
+# decoding and Postgres work at the same time. CONSUMER_PIPELINE_APPLIERS concurrent DB transactions, by key.
+RUNTIME = os.getenv("CONSUMER_RUNTIME", "loop").strip().lower()
+PIPELINE_APPLIERS = int(os.getenv("CONSUMER_PIPELINE_APPLIERS", "4"))
+PIPELINE_QUEUE = int(os.getenv("CONSUMER_PIPELINE_QUEUE", "4"))
+
+# Contract validation of consumed values (services/contracts FastValidator, straight from bytes):
+# "off" = JSON only; "envelope"; "sampled" = envelope + payload of CONSUMER_VALIDATE_SAMPLE of the messages;
+# "full". A rejected value is skipped like any malformed message and counted in game_consumer_invalid_total.
+VALIDATE_MODE = os.getenv("CONSUMER_VALIDATE", "off").strip().lower()
+VALIDATE_SAMPLE = float(os.getenv("CONSUMER_VALIDATE_SAMPLE", "0.05"))
+if VALIDATE_MODE not in ("off",) + VALIDATION_MODES:
+    raise RuntimeError(f"CONSUMER_VALIDATE must be off|{'|'.join(VALIDATION_MODES)}, got {VALIDATE_MODE!r}")
+VALIDATOR = FastValidator(VALIDATE_MODE, sample_rate=VALIDATE_SAMPLE) if VALIDATE_MODE != "off" else None
+
+METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", "0"))  # 0 = no HTTP endpoint
+LAG_EVERY_SEC = float(os.getenv("CONSUMER_LAG_EVERY_SEC", "15"))
+
 STOP = False
 
+# ---------------------------
+# Metrics (GET /metrics on CONSUMER_METRICS_PORT)
+# ---------------------------
+M_EVENTS = Counter(
+    "game_consumer_events_total", "Handled messages by outcome (ok|dedup|skipped|retried|dlq)",
+    ("event_type", "outcome"),
+)
+M_ATTEMPT_ERRORS = Counter("game_consumer_attempt_errors_total", "Failed processing attempts", ("event_type",))
+M_DB_SECONDS = Histogram(
+    "game_consumer_db_seconds", "DB transaction time an event was part of (batch transaction in batch mode)",
+    ("event_type",),
+)
+M_PROCESS_SECONDS = Histogram(
+    "game_consumer_process_seconds", "Total consumer time per event (parse, dedup, DB, retries)", ("event_type",),
+)
+M_EVENT_AGE = Histogram(
+    "game_consumer_event_age_seconds", "now - envelope created_at when the event is applied to the DB",
+    ("event_type",), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+M_BATCH_SIZE = Histogram(
+    "game_consumer_batch_size", "Records per processed batch",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+M_INVALID = Counter(
+    "game_consumer_invalid_total", "Values rejected by contract validation (CONSUMER_VALIDATE)", ("reason",),
+)
+M_WATERMARK_DEDUP = Counter(
+    "game_consumer_watermark_dedup_total", "Events beyond the dedup horizon skipped by the offset watermark",
+    ("topic", "partition"),
+)
+M_LAG = Gauge("game_consumer_lag", "End offset - committed offset per assigned partition", ("topic", "partition"))
+
+_TYPE_LABELS: set[str] = set()
+
 
 def _on_signal(sig, _frame):
     global STOP
@@ -46,6 +159,33 @@ def safe_json_deserializer(b: bytes | None):
         return None
 
 
+class CompactValue:
+    """A schema_version 2 value, not decoded yet: _parse() takes the routing fields from the headers, _msg() decodes."""
+
+    __slots__ = ("raw",)
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+
+
+def decode_value(b: bytes | None):
+    """
+    Consumer value_deserializer: dict, CompactValue or None (never raises); validated with CONSUMER_VALIDATE.
+    A v2 value needs its headers (a deserializer does not get them) and is decoded after dedup anyway.
+    """
+    if b and is_compact(b):
+        return CompactValue(b)
+    if VALIDATOR is None:
+        return safe_json_deserializer(b)
+    if not b:
+        return None
+    try:
+        return VALIDATOR.validate(b)
+    except InvalidEvent as e:
+        M_INVALID.inc(reason=str(e))
+        return None
+
+
 def _as_str_key(key):
     if key is None:
         return None
@@ -62,6 +202,110 @@ def is_valid_uuid(value) -> bool:
         return False
 
 
+def retry_topic(delay_sec: int) -> str:
+    return f"{TOPIC}.retry.{delay_sec}s"
+
+
+def _headers(record) -> dict:
+    return {
+        k: v.decode("utf-8", errors="ignore")
+        for k, v in (getattr(record, "headers", None) or [])
+        if v is not None
+    }
+
+
+class DedupCache:
+    """
+    In-process front of already_consumed(): an LRU of recently consumed event_ids (a hit needs no DB)
+    and a Bloom filter over consumed event_ids (a miss means "not consumed" -> no DB lookup either).
+    Only a Bloom "maybe" costs a SELECT.
+
+    Never authoritative: the consumed_events insert still skips known event_ids and only events that
+    were actually inserted touch the read model, so an event the cache does not know about (consumed
+    by another instance, Bloom reset on overflow) is still applied at most once.
+    Shared by the worker threads (CONSUMER_WORKERS, pipeline appliers): all state is read and written under a lock.
+    """
+
+    def __init__(self, *, lru_size: int, bloom_capacity: int, fp_rate: float = 0.001):
+        self.enabled = lru_size > 0 and bloom_capacity > 0
+        self.lru_size = lru_size
+        self.capacity = bloom_capacity
+        self._lock = threading.Lock()
+        self._lru: collections.OrderedDict = collections.OrderedDict()
+        self._count = 0
+        if self.enabled:
+            self.m = max(64, int(-bloom_capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+            self.k = max(1, round(self.m / bloom_capacity * math.log(2)))
+        else:
+            self.m, self.k = 0, 0
+        self._bits = bytearray((self.m + 7) // 8)
+
+    def _positions(self, event_id: str):
+        h = hashlib.blake2b(event_id.encode("ascii", errors="ignore"), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def is_known(self, event_id: str) -> bool:
+        if not self.enabled:
+            return False
+        with self._lock:
+            if event_id in self._lru:
+                self._lru.move_to_end(event_id)
+                return True
+        return False
+
+    def maybe_consumed(self, event_id: str) -> bool:
+        if not self.enabled:
+            return True
+        positions = self._positions(event_id)
+        with self._lock:  # add_many() sets bits and resets the filter from worker threads
+            bits = self._bits
+            return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def add_many(self, event_ids) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            for event_id in event_ids:
+                self._lru[event_id] = None
+                self._lru.move_to_end(event_id)
+                for p in self._positions(event_id):
+                    self._bits[p >> 3] |= 1 << (p & 7)
+                self._count += 1
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+            if self._count > self.capacity:
+                # full -> false positive rate climbs; start over from the LRU (older ids fall back to the DB insert)
+                self._bits = bytearray(len(self._bits))
+                self._count = 0
+                for event_id in self._lru:
+                    for p in self._positions(event_id):
+                        self._bits[p >> 3] |= 1 << (p & 7)
+                    self._count += 1
+
+    def warm(self, Session) -> int:
+        """Load event_ids consumed in the last DEDUP_WARM_HOURS (newest first, up to the Bloom capacity)."""
+        if not self.enabled or DEDUP_WARM_HOURS <= 0:
+            return 0
+        with Session() as db:
+            ids = db.execute(
+                sql_text("""
+                    SELECT event_id::text
+                    FROM consumed_events
+                    WHERE consumed_at > now() - make_interval(secs => :secs)
+                    ORDER BY consumed_at DESC
+                    LIMIT :n
+                """),
+                {"secs": DEDUP_WARM_HOURS * 3600, "n": self.capacity},
+            ).scalars().all()
+        self.add_many(reversed(ids))  # oldest first -> the newest stay in the LRU
+        return len(ids)
+
+
+DEDUP = DedupCache(lru_size=DEDUP_LRU_SIZE, bloom_capacity=DEDUP_BLOOM_CAPACITY)
+
+
 def already_consumed(db, *, event_id: str) -> bool:
     # event_id is UUID in schema
     res = db.execute(
@@ -71,6 +315,227 @@ def already_consumed(db, *, event_id: str) -> bool:
     return res is not None
 
 
+def already_consumed_many(db, *, event_ids: list[str]) -> set[str]:
+    if not event_ids:
+        return set()
+    rows = db.execute(
+        sql_text("SELECT event_id::text FROM consumed_events WHERE event_id = ANY(CAST(:event_ids AS uuid[]))"),
+        {"event_ids": event_ids},
+    ).scalars().all()
+    return set(rows)
+
+
+class SchemaCaps:
+    """
+    What the connected database offers, with the statement variants chosen for it. Probed once
+    (see schema()) instead of trying a statement per message and catching the error: a failed
+    statement aborts the surrounding transaction.
+    """
+
+    def __init__(self, *, offset_column: str, has_recompute: bool, has_recompute_batch: bool,
+                 has_read_model: bool, has_consumer_offsets: bool):
+        self.offset_column = offset_column  # "kafka_offset", or "offset" before d4d2ad8319b7
+        self.has_recompute = has_recompute
+        self.has_recompute_batch = has_recompute_batch
+        self.has_read_model = has_read_model
+        self.has_consumer_offsets = has_consumer_offsets
+
+        col = f'"{offset_column}"'
+        self.mark_consumed_sql = sql_text(f"""
+            INSERT INTO consumed_events
+              (id, event_id, topic, "partition", {col}, aggregate_type, aggregate_id, event_type, consumed_at)
+            VALUES
+              (gen_random_uuid(), CAST(:event_id AS uuid), :topic, :partition, :offset, :aggregate_type,
+               CAST(:aggregate_id AS uuid), :event_type, now())
+            ON CONFLICT DO NOTHING
+        """)
+        self.mark_consumed_many_sql = sql_text(f"""
+            INSERT INTO consumed_events
+              (id, event_id, topic, "partition", {col}, aggregate_type, aggregate_id, event_type, consumed_at)
+            SELECT gen_random_uuid(), u.event_id, u.topic, u.partition, u.kafka_offset,
+                   u.aggregate_type, u.aggregate_id, u.event_type, now()
+            FROM unnest(
+              CAST(:event_ids AS uuid[]),
+              CAST(:topics AS text[]),
+              CAST(:partitions AS int[]),
+              CAST(:offsets AS bigint[]),
+              CAST(:aggregate_types AS text[]),
+              CAST(:aggregate_ids AS uuid[]),
+              CAST(:event_types AS text[])
+            ) AS u(event_id, topic, partition, kafka_offset, aggregate_type, aggregate_id, event_type)
+            ON CONFLICT DO NOTHING
+            RETURNING event_id::text
+        """)
+        self.watermark_sql = sql_text(f"""
+            SELECT u.topic, u.partition,
+                   (SELECT max(c.{col})
+                    FROM consumed_events c
+                    WHERE c.topic = u.topic AND c."partition" = u.partition) AS watermark
+            FROM unnest(CAST(:topics AS text[]), CAST(:partitions AS int[])) AS u(topic, partition)
+        """)
+
+    def describe(self) -> str:
+        return (f"offset_column={self.offset_column} recompute={self.has_recompute} "
+                f"recompute_batch={self.has_recompute_batch} read_model={self.has_read_model} "
+                f"consumer_offsets={self.has_consumer_offsets}")
+
+
+PROBE_SCHEMA_SQL = """
+SELECT
+  (SELECT column_name
+   FROM information_schema.columns
+   WHERE table_schema = current_schema()
+     AND table_name = 'consumed_events'
+     AND column_name IN ('kafka_offset', 'offset')
+   ORDER BY column_name = 'kafka_offset' DESC
+   LIMIT 1) AS offset_column,
+  to_regprocedure('recompute_game_read_model(uuid)') IS NOT NULL AS has_recompute,
+  to_regprocedure('recompute_game_read_models(uuid[])') IS NOT NULL AS has_recompute_batch,
+  to_regclass('game_read_model') IS NOT NULL AS has_read_model,
+  to_regclass('consumer_offsets') IS NOT NULL AS has_consumer_offsets
+"""
+
+SCHEMA: SchemaCaps | None = None
+_SCHEMA_STALE = threading.Event()  # set on every new DB connection (DB restart, failover -> maybe migrated)
+
+
+def probe_schema(db) -> SchemaCaps:
+    row = db.execute(sql_text(PROBE_SCHEMA_SQL)).one()
+    if row.offset_column is None:
+        raise RuntimeError("consumed_events is missing (run alembic upgrade head)")
+    return SchemaCaps(
+        offset_column=row.offset_column,
+        has_recompute=row.has_recompute,
+        has_recompute_batch=row.has_recompute_batch,
+        has_read_model=row.has_read_model,
+        has_consumer_offsets=row.has_consumer_offsets,
+    )
+
+
+def schema(db) -> SchemaCaps:
+    """Current SchemaCaps; probed on first use and again after a reconnect."""
+    global SCHEMA
+    if SCHEMA is None or _SCHEMA_STALE.is_set():
+        _SCHEMA_STALE.clear()
+        caps = probe_schema(db)
+        if SCHEMA is None or caps.describe() != SCHEMA.describe():
+            print(f"[consumer] schema: {caps.describe()}", flush=True)
+            if not caps.has_recompute:
+                print("[consumer] WARN: recompute_game_read_model() отсутствует — пропускаю материализацию",
+                      flush=True)
+        SCHEMA = caps
+    return SCHEMA
+
+
+def _on_connect(dbapi_conn, _record) -> None:
+    _SCHEMA_STALE.set()
+    if DEDUP_HORIZON_DAYS > 0:
+        # trg_consumed_events_dedup (a71c9e2f4b05) looks back this far: same horizon as the watermark fallback
+        with dbapi_conn.cursor() as cur:
+            cur.execute("SELECT set_config('consumed_events.horizon_days', %s, false)", (str(DEDUP_HORIZON_DAYS),))
+        dbapi_conn.commit()  # a session setting made in a rolled-back transaction is undone
+
+
+def _watch_reconnects(engine) -> None:
+    event.listen(engine, "connect", _on_connect)
+
+
+def _msg(item: dict) -> dict | None:
+    """
+    The envelope as a v1-shaped dict. A compact (schema_version 2) value is decoded here, on first use, so a
+    duplicate never pays for it. None = the value is invalid (counted in game_consumer_invalid_total).
+    """
+    if item["msg"] is None and item["raw"] is not None:
+        raw, item["raw"] = item["raw"], None
+        try:
+            if VALIDATOR is not None:
+                item["msg"] = VALIDATOR.validate(raw, item["headers"])
+            else:
+                item["msg"] = decode_compact(raw, item["headers"])
+        except InvalidEvent as e:
+            M_INVALID.inc(reason=str(e))
+    return item["msg"]
+
+
+def _created_at(item: dict) -> dt.datetime | None:
+    record = item["record"]
+    if item["msg"] is None and getattr(record, "timestamp_type", None) == 0 and record.timestamp:
+        # v2 not decoded yet: the relay sets the record CreateTime to created_at
+        return dt.datetime.fromtimestamp(record.timestamp / 1000, dt.timezone.utc)
+    msg = _msg(item)
+    if msg is None:
+        return None
+    created_at = msg.get("created_at")
+    if not created_at:
+        return None
+    try:
+        ts = dt.datetime.fromisoformat(str(created_at))
+    except ValueError:
+        return None
+    return ts if ts.tzinfo is not None else ts.replace(tzinfo=dt.timezone.utc)
+
+
+def _beyond_horizon(item: dict) -> bool:
+    """Event created before the dedup horizon (its consumed_events row may be dropped already)."""
+    if DEDUP_HORIZON_DAYS <= 0:
+        return False
+    ts = _created_at(item)
+    return ts is not None and ts < dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=DEDUP_HORIZON_DAYS)
+
+
+def _type_label(event_type: str) -> str:
+    # event_type comes from the wire: cap the label set so a bad producer cannot blow up /metrics
+    if event_type in _TYPE_LABELS or len(_TYPE_LABELS) < 64:
+        _TYPE_LABELS.add(event_type)
+        return event_type
+    return "other"
+
+
+def _observe(item: dict, *, outcome: str, db_sec: float | None = None, total_sec: float | None = None) -> None:
+    event_type = _type_label(item["event_type"])
+    M_EVENTS.inc(event_type=event_type, outcome=outcome)
+    if db_sec is not None:
+        M_DB_SECONDS.observe(db_sec, event_type=event_type)
+    if total_sec is not None:
+        M_PROCESS_SECONDS.observe(total_sec, event_type=event_type)
+    if outcome == "ok":
+        ts = _created_at(item)
+        if ts is not None:
+            M_EVENT_AGE.observe(max(0.0, (dt.datetime.now(dt.timezone.utc) - ts).total_seconds()),
+                                event_type=event_type)
+
+
+def _skipped(stats: dict) -> None:
+    stats["skipped"] += 1
+    M_EVENTS.inc(event_type="invalid", outcome="skipped")
+
+
+def below_watermark(db, *, items: list[dict]) -> set[str]:
+    """
+    Event_ids of `items` beyond the horizon and at or below the highest consumed offset of their Kafka partition.
+    Events within the horizon are left to the event_id lookup: retried events are consumed below the watermark
+    on purpose. Every event dropped this way is logged and counted.
+    """
+    items = [i for i in items if _beyond_horizon(i)]
+    tps = sorted({(i["topic"], i["partition"]) for i in items})
+    if not tps:
+        return set()
+    rows = db.execute(
+        schema(db).watermark_sql,
+        {"topics": [t for t, _ in tps], "partitions": [p for _, p in tps]},
+    ).all()
+    watermark = {(r.topic, r.partition): r.watermark for r in rows if r.watermark is not None}
+    dropped = set()
+    for i in items:
+        tp = (i["topic"], i["partition"])
+        if tp in watermark and i["offset"] <= watermark[tp]:
+            dropped.add(i["event_id"])
+            M_WATERMARK_DEDUP.inc(topic=i["topic"], partition=i["partition"])
+            print(f"[consumer] watermark dedup {i['topic']}[{i['partition']}]@{i['offset']} "
+                  f"event_id={i['event_id']} (watermark {watermark[tp]})", flush=True)
+    return dropped
+
+
 def mark_consumed(
     db,
     *,
@@ -82,70 +547,280 @@ def mark_consumed(
     aggregate_id: str,
     event_type: str,
 ):
-    """Idempotent write: one row per event_id.
-
-    Works with both schemas:
-      - consumed_events(kafka_offset)
-      - consumed_events("offset")  (legacy)
-    """
-
-    params = {
-        "event_id": event_id,
-        "topic": topic,
-        "partition": partition,
-        "kafka_offset": offset,
-        "offset": offset,
-        "aggregate_type": aggregate_type,
-        "aggregate_id": aggregate_id,
-        "event_type": event_type,
-    }
+    """Idempotent write: one row per event_id (either offset column, see SchemaCaps)."""
+    db.execute(
+        schema(db).mark_consumed_sql,
+        {
+            "event_id": event_id,
+            "topic": topic,
+            "partition": partition,
+            "offset": offset,
+            "aggregate_type": aggregate_type,
+            "aggregate_id": aggregate_id,
+            "event_type": event_type,
+        },
+    )
+
+
+def mark_consumed_many(db, *, items: list[dict]) -> set[str]:
+    """Multi-row variant of mark_consumed(). Returns the event_ids actually inserted."""
+    if not items:
+        return set()
+    rows = db.execute(
+        schema(db).mark_consumed_many_sql,
+        {
+            "event_ids": [i["event_id"] for i in items],
+            "topics": [i["topic"] for i in items],
+            "partitions": [i["partition"] for i in items],
+            "offsets": [i["offset"] for i in items],
+            "aggregate_types": [i["aggregate_type"] for i in items],
+            "aggregate_ids": [i["aggregate_id"] for i in items],
+            "event_types": [i["event_type"] for i in items],
+        },
+    ).scalars().all()
+    return set(rows)
 
-    # Prefer the new column name.
-    try:
-        db.execute(
-            sql_text(
-                """
-                INSERT INTO consumed_events
-                  (event_id, topic, \"partition\", kafka_offset, aggregate_type, aggregate_id, event_type, consumed_at)
-                VALUES
-                  (CAST(:event_id AS uuid), :topic, :partition, :kafka_offset, :aggregate_type, CAST(:aggregate_id AS uuid), :event_type, now())
-                ON CONFLICT (event_id) DO NOTHING
-                """
-            ),
-            params,
-        )
-        return
-    except Exception as e:
-        # Fallback to legacy column name "offset" if needed.
-        if "kafka_offset" not in str(e) and "does not exist" not in str(e):
-            # Not a schema mismatch → re-raise.
-            raise
 
+def _next_offsets(records) -> dict:
+    """TopicPartition -> offset to resume from (last record + 1)."""
+    offsets = {}
+    for record in records:
+        tp = TopicPartition(record.topic, record.partition)
+        if record.offset + 1 > offsets.get(tp, -1):
+            offsets[tp] = record.offset + 1
+    return offsets
+
+
+def store_offsets(db, *, records) -> None:
+    """Upsert the next offset per partition of `records` (call inside the processing transaction)."""
+    offsets = _next_offsets(records)
+    if not offsets:
+        return
     db.execute(
         sql_text(
             """
-            INSERT INTO consumed_events
-              (event_id, topic, \"partition\", \"offset\", aggregate_type, aggregate_id, event_type, consumed_at)
-            VALUES
-              (CAST(:event_id AS uuid), :topic, :partition, :offset, :aggregate_type, CAST(:aggregate_id AS uuid), :event_type, now())
-            ON CONFLICT (event_id) DO NOTHING
+            INSERT INTO consumer_offsets (group_id, topic, "partition", next_offset, updated_at)
+            SELECT :group_id, u.topic, u.partition, u.next_offset, now()
+            FROM unnest(
+              CAST(:topics AS text[]),
+              CAST(:partitions AS int[]),
+              CAST(:offsets AS bigint[])
+            ) AS u(topic, partition, next_offset)
+            ON CONFLICT (group_id, topic, "partition") DO UPDATE
+              SET next_offset = EXCLUDED.next_offset,
+                  updated_at = EXCLUDED.updated_at
             """
         ),
-        params,
+        {
+            "group_id": GROUP_ID,
+            "topics": [tp.topic for tp in offsets],
+            "partitions": [tp.partition for tp in offsets],
+            "offsets": list(offsets.values()),
+        },
     )
 
 
+def load_offsets(db, *, tps) -> dict:
+    tps = list(tps)
+    if not tps:
+        return {}
+    rows = db.execute(
+        sql_text(
+            """
+            SELECT topic, "partition", next_offset
+            FROM consumer_offsets
+            WHERE group_id = :group_id
+              AND (topic, "partition") IN (
+                SELECT * FROM unnest(CAST(:topics AS text[]), CAST(:partitions AS int[]))
+              )
+            """
+        ),
+        {"group_id": GROUP_ID, "topics": [tp.topic for tp in tps], "partitions": [tp.partition for tp in tps]},
+    ).all()
+    return {TopicPartition(r.topic, r.partition): int(r.next_offset) for r in rows}
+
+
+def _store_offset(db, item: dict) -> None:
+    # only records of TOPIC itself; the retry worker keeps Kafka offsets for the tier topics
+    if OFFSETS_IN_DB and item.get("retry_tier", -1) < 0:
+        store_offsets(db, records=[item["record"]])
+
+
 def recompute_read_model(db, *, game_id: str):
-    """Materialize read-model for the game. If the function is absent, degrade gracefully."""
+    """Materialize read-model for the game (no-op without recompute_game_read_model())."""
+    if not schema(db).has_recompute:
+        return
+    db.execute(sql_text("SELECT recompute_game_read_model(CAST(:game_id AS uuid))"), {"game_id": game_id})
+
+
+def recompute_read_models(db, *, game_ids: list[str]) -> None:
+    """Set-based recompute for a whole batch (one call, one row per game; see migration 4624d62787d8)."""
+    if not game_ids:
+        return
+    caps = schema(db)
+    if caps.has_recompute_batch:
+        db.execute(sql_text("SELECT recompute_game_read_models(CAST(:game_ids AS uuid[]))"), {"game_ids": game_ids})
+    elif caps.has_recompute:
+        for game_id in game_ids:  # before 4624d62787d8: one call per game, same order
+            recompute_read_model(db, game_id=game_id)
+
+
+# Event types that do not touch game_read_model at all.
+READ_MODEL_NOOP_TYPES = {"round.resolved", "snapshot.created"}
+
+# Games updated by deltas since the last repair; recomputed in full every READ_MODEL_REPAIR_SEC
+# (catches what no event describes, e.g. a player going AFK). Updated by the worker / applier threads and
+# drained by the repair on the main thread: only under _DELTA_LOCK.
+_DELTA_TOUCHED: set[str] = set()
+_DELTA_LOCK = threading.Lock()
+
+APPLY_DELTAS_SQL = """
+UPDATE game_read_model rm
+SET current_phase = COALESCE(u.new_phase, rm.current_phase),
+    phase_seq = COALESCE(u.phase_seq, rm.phase_seq),
+    round_num = GREATEST(rm.round_num, COALESCE(u.round_num, rm.round_num)),
+    phase_started_at = COALESCE(u.phase_started_at, rm.phase_started_at),
+    ready_count = CASE WHEN u.phase_seq IS NOT NULL THEN 0 ELSE rm.ready_count END + u.ready_inc,
+    status = COALESCE(u.status, rm.status),
+    players_total = rm.players_total + u.players_inc,
+    players_active = rm.players_active + u.players_inc,
+    ready_total = rm.ready_total + u.players_inc,
+    updated_at = now()
+FROM unnest(
+  CAST(:game_ids AS uuid[]),
+  CAST(:new_phases AS text[]),
+  CAST(:phase_seqs AS int[]),
+  CAST(:round_nums AS int[]),
+  CAST(:phase_started_ats AS timestamptz[]),
+  CAST(:ready_seqs AS int[]),
+  CAST(:ready_incs AS int[]),
+  CAST(:statuses AS text[]),
+  CAST(:players_incs AS int[])
+) AS u(game_id, new_phase, phase_seq, round_num, phase_started_at, ready_seq, ready_inc, status, players_inc)
+WHERE rm.game_id = u.game_id
+  -- guards: anything that does not line up is left to the full recompute
+  AND (u.phase_seq IS NULL OR u.phase_seq > rm.phase_seq)
+  AND (u.ready_inc = 0 OR u.ready_seq = COALESCE(u.phase_seq, rm.phase_seq))
+  AND CASE WHEN u.phase_seq IS NOT NULL THEN 0 ELSE rm.ready_count END + u.ready_inc
+      <= rm.ready_total + u.players_inc
+RETURNING rm.game_id::text;
+"""
+
+
+def fold_read_model_deltas(items: list[dict]) -> tuple[dict, set]:
+    """
+    Fold a batch into at most one delta per game:
+      phase.changed    -> new phase/seq/round, ready_count reset
+      player.ready_set -> ready_count + 1 (for the phase it was set in)
+      round.started    -> round_num
+      game.finished / game.archived -> status
+      player.joined    -> players_total/players_active/ready_total + 1
+    Returns (deltas by game_id, games that need a full recompute instead).
+    """
+    deltas: dict[str, dict] = {}
+    recompute: set[str] = set()
+
+    for item in items:
+        game_id = item["aggregate_id"]
+        event_type = item["event_type"]
+        if game_id in recompute or event_type in READ_MODEL_NOOP_TYPES:
+            continue
+
+        payload = item["msg"].get("payload") or {}
+        d = deltas.setdefault(game_id, {
+            "new_phase": None, "phase_seq": None, "round_num": None, "phase_started_at": None,
+            "ready_seq": None, "ready_inc": 0, "status": None, "players_inc": 0,
+        })
+
+        try:
+            if event_type == "phase.changed":
+                seq = int(payload["phase_seq"])
+                if d["phase_seq"] is None or seq > d["phase_seq"]:
+                    d.update(new_phase=payload["new_phase"], phase_seq=seq,
+                             phase_started_at=item["msg"].get("created_at"), ready_seq=seq, ready_inc=0)
+                    if payload.get("round_num") is not None:
+                        d["round_num"] = max(int(payload["round_num"]), d["round_num"] or 0)
+
+            elif event_type == "player.ready_set":
+                seq = int(payload["phase_seq"])
+                if d["phase_seq"] is not None and seq < d["phase_seq"]:
+                    pass  # ready for a phase that is already over
+                elif d["ready_seq"] is None or d["ready_seq"] == seq:
+                    d["ready_seq"] = seq
+                    d["ready_inc"] += 1
+                else:
+                    raise ValueError("ready for a phase this batch has not seen")
+
+            elif event_type == "round.started":
+                d["round_num"] = max(int(payload["round_num"]), d["round_num"] or 0)
+
+            elif event_type == "game.finished":
+                d["status"] = "finished"
+
+            elif event_type == "game.archived":
+                d["status"] = "archived"
+
+            elif event_type == "player.joined":
+                d["players_inc"] += 1
+
+            else:
+                raise ValueError(f"no delta for {event_type}")  # game.created and anything new
+
+        except (KeyError, TypeError, ValueError):
+            recompute.add(game_id)
+            deltas.pop(game_id, None)
+
+    return deltas, recompute
+
+
+def apply_read_model_deltas(db, *, deltas: dict) -> set[str]:
+    """One UPDATE for all games of the batch. Returns the games it applied to."""
+    if not deltas or not schema(db).has_read_model:
+        return set()
+    game_ids = list(deltas)
+
+    def col(k):
+        return [deltas[g][k] for g in game_ids]
+
+    rows = db.execute(
+        sql_text(APPLY_DELTAS_SQL),
+        {
+            "game_ids": game_ids,
+            "new_phases": col("new_phase"),
+            "phase_seqs": col("phase_seq"),
+            "round_nums": col("round_num"),
+            "phase_started_ats": col("phase_started_at"),
+            "ready_seqs": col("ready_seq"),
+            "ready_incs": col("ready_inc"),
+            "statuses": col("status"),
+            "players_incs": col("players_inc"),
+        },
+    ).scalars().all()
+    return set(rows)
+
+
+def repair_read_model(Session) -> int:
+    """Periodic full recompute of every game the deltas touched since the last repair."""
+    with _DELTA_LOCK:
+        # taken before the recompute: a game touched again meanwhile is simply repaired next time
+        games = list(_DELTA_TOUCHED)
+        _DELTA_TOUCHED.clear()
+    if not games:
+        return 0
     try:
-        db.execute(sql_text("SELECT recompute_game_read_model(CAST(:game_id AS uuid))"), {"game_id": game_id})
-    except Exception as e:
-        
-        msg = str(e)
-        if "recompute_game_read_model" in msg and "does not exist" in msg:
-            print("[consumer] WARN: recompute_game_read_model() отсутствует — пропускаю материализацию", flush=True)
-            return
+        with Session.begin() as db:
+            recompute_read_models(db, game_ids=games)
+    except Exception:
+        with _DELTA_LOCK:
+            _DELTA_TOUCHED.update(games)
         raise
+    return len(games)
+
+
+def _distinct_last(values: list[str]) -> list[str]:
+    """Distinct values ordered by their LAST occurrence (same outcome as applying them one by one)."""
+    pos = {v: i for i, v in enumerate(values)}
+    return sorted(pos, key=pos.__getitem__)
 
 
 def publish_dlq(
@@ -157,14 +832,15 @@ def publish_dlq(
     err: Exception,
     attempt: int,
     reason: str = "processing_error",
+    src: dict | None = None,
 ):
     payload = {
         "reason": reason,
         "attempt": attempt,
         "error": repr(err),
-        "traceback": traceback.format_exc(),
+        "traceback": "".join(traceback.format_exception(type(err), err, err.__traceback__)),
         "original": msg,
-        "src": {
+        "src": src or {
             "topic": getattr(record, "topic", None),
             "partition": getattr(record, "partition", None),
             "offset": getattr(record, "offset", None),
@@ -173,9 +849,71 @@ def publish_dlq(
     }
 
     # Key must be str for our serializer.
+    # No flush here: flush_dlq() waits for all dead letters of a poll at once.
     dlq_key = payload["src"]["key"]
-    dlq.send(topic, key=dlq_key, value=payload)
-    dlq.flush(5)
+    return dlq.send(topic, key=dlq_key, value=payload)
+
+
+def flush_dlq(Session, dlq: KafkaProducer, pending: list, stats: dict) -> None:
+    """
+    Finish the dead letters buffered by process_record(): ONE producer flush for all of them, then
+    ONE transaction that marks them consumed as DLQ:<event_type>. Callers run it before committing
+    the offsets of the same records, so an offset never gets ahead of its DLQ write.
+    `pending` is a list of (item, future or None, t0) and is emptied.
+    """
+    if not pending:
+        return
+    entries, pending[:] = list(pending), []
+    try:
+        dlq.flush(10)
+    except Exception as e:
+        print(f"[consumer] ERROR: DLQ flush failed: {e!r}", flush=True)
+
+    for item, fut, t0 in entries:
+        try:
+            if fut is None:
+                raise RuntimeError("DLQ send was not accepted by the producer")
+            fut.get(timeout=0)
+            stats["dlq"] += 1
+            _observe(item, outcome="dlq", total_sec=time.monotonic() - t0)
+        except Exception as dlq_e:
+            # same as before batching: logged, the event is still marked consumed below
+            print(f"[consumer] ERROR: failed to publish DLQ for {item['event_id']}: {dlq_e!r}", flush=True)
+
+    items = [{**item, "event_type": f"DLQ:{item['event_type']}"} for item, _, _ in entries]
+    try:
+        with Session.begin() as db:
+            mark_consumed_many(db, items=items)
+            if OFFSETS_IN_DB:
+                store_offsets(db, records=[i["record"] for i in items if i.get("retry_tier", -1) < 0])
+        # not added to DEDUP: dlq_replay.py releases these rows and the events must get through again
+    except Exception as db_e:
+        print(f"[consumer] ERROR: failed to mark_consumed after DLQ: {db_e!r}", flush=True)
+
+
+def forward_retry(dlq: KafkaProducer, *, item: dict, tier: int, attempt: int, err: Exception) -> None:
+    """
+    Send the original message unchanged to retry tier `tier`; attempt metadata and the original
+    coordinates travel in headers. Waits for the ack: the source offset is committed right after.
+    """
+    record = item["record"]
+    delay = RETRY_TIERS[tier]
+    headers = {
+        "x-retry-tier": tier,
+        "x-retry-attempt": attempt,
+        "x-retry-due-ms": int(time.time() * 1000) + delay * 1000,
+        "x-retry-error": repr(err)[:500],
+        "x-src-topic": item["topic"],
+        "x-src-partition": item["partition"],
+        "x-src-offset": item["offset"],
+    }
+    fut = dlq.send(
+        retry_topic(delay),
+        key=_as_str_key(getattr(record, "key", None)),
+        value=_msg(item),  # v2 goes on as the expanded v1 envelope
+        headers=[(k, str(v).encode("utf-8")) for k, v in headers.items()],
+    )
+    fut.get(timeout=10)
 
 
 def _sleep_backoff(attempt: int):
@@ -183,146 +921,1007 @@ def _sleep_backoff(attempt: int):
     time.sleep(min(0.2 * (2 ** max(0, attempt - 1)), 2.0))
 
 
-def main():
-    print(f"[consumer] bootstrap={KAFKA_BOOTSTRAP_SERVERS} topic={TOPIC} group={GROUP_ID}", flush=True)
+def _parse(record) -> dict | None:
+    """Envelope fields the consumer needs, or None for a message that can only be skipped."""
+    msg = record.value
+    if msg is None:
+        return None
 
-    engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
+    headers = _headers(record)
+    raw = None
+    if isinstance(msg, CompactValue):
+        # schema_version 2: routing fields in headers, the value is decoded by _msg() after dedup
+        msg, raw = None, msg.raw
+        event_id, agg_id = headers.get(H_EVENT_ID), headers.get(H_AGGREGATE_ID)
+        event_type, agg_type = headers.get(H_EVENT_TYPE), headers.get(H_AGGREGATE_TYPE)
+    else:
+        aggregate = msg.get("aggregate") or {}
+        event_id, agg_id = msg.get("event_id"), aggregate.get("id")
+        event_type, agg_type = msg.get("type") or msg.get("event_type"), aggregate.get("type")
+
+    # Basic validation to avoid hard crashes on malformed messages.
+    if not is_valid_uuid(event_id) or not is_valid_uuid(agg_id):
+        return None
+
+    item = {
+        "record": record,
+        "msg": msg,
+        "raw": raw,
+        "headers": headers,
+        "event_id": str(event_id),
+        "event_type": event_type or "unknown",
+        "aggregate_type": agg_type,
+        "aggregate_id": str(agg_id),
+        "topic": record.topic,
+        "partition": record.partition,
+        "offset": record.offset,
+        "retry_tier": -1,
+        "retry_attempt": 0,
+    }
+
+    # re-injected by dlq_replay.py: its consumed_events row was just released, don't trust the cache
+    item["replayed"] = "x-dlq-replay" in headers
+    if "x-retry-tier" in headers:
+        # re-delivered from a retry topic: keep the coordinates of the original message
+        try:
+            item.update(
+                topic=headers["x-src-topic"],
+                partition=int(headers["x-src-partition"]),
+                offset=int(headers["x-src-offset"]),
+                retry_tier=int(headers["x-retry-tier"]),
+                retry_attempt=int(headers.get("x-retry-attempt", 0)),
+            )
+        except (KeyError, ValueError):
+            return None
+    return item
+
+
+def process_record(Session, dlq: KafkaProducer, item: dict, stats: dict, dlq_pending: list | None = None) -> bool:
+    """
+    One message, own transaction, in-place retries with backoff.
+    With RETRY_TIERS: after INLINE_ATTEMPTS the message goes to the next retry tier and counts as
+    handled here; DLQ after the last tier. Without: DLQ after MAX_ATTEMPTS.
+    With `dlq_pending` a dead letter is only sent and buffered; the caller must flush_dlq() it
+    before committing the offset.
+    Returns False only if interrupted by STOP before the message was handled.
+    """
+    record = item["record"]
+    event_id = item["event_id"]
+    agg_id = item["aggregate_id"]
+    tier = item.get("retry_tier", -1)
+    max_attempts = INLINE_ATTEMPTS if RETRY_TIERS else MAX_ATTEMPTS
+
+    t0 = time.monotonic()
+    attempt = 0
+    while attempt < max_attempts and not STOP:
+        try:
+            t_db = time.monotonic()
+            with Session.begin() as db:
+                # the cache answers for most events; only a Bloom "maybe" goes to the DB
+                seen = DEDUP.is_known(event_id) and not item["replayed"]
+                if not seen and (item["replayed"] or DEDUP.maybe_consumed(event_id)):
+                    stats["dedup_lookups"] += 1
+                    seen = already_consumed(db, event_id=event_id)
+                if not seen:
+                    seen = bool(below_watermark(db, items=[item]))
+                if seen:
+                    stats["dedup"] += 1
+                    _store_offset(db, item)
+                    DEDUP.add_many([event_id])
+                    _observe(item, outcome="dedup")
+                    return True
+
+                if _msg(item) is None:
+                    _skipped(stats)
+                    _store_offset(db, item)
+                    return True
+
+                # demo: materialize by aggregate id (game id)
+                recompute_read_model(db, game_id=agg_id)
+
+                mark_consumed(
+                    db,
+                    event_id=event_id,
+                    topic=item["topic"],
+                    partition=item["partition"],
+                    offset=item["offset"],
+                    aggregate_type=item["aggregate_type"],
+                    aggregate_id=agg_id,
+                    event_type=item["event_type"],
+                )
+                _store_offset(db, item)
+
+            now = time.monotonic()
+            DEDUP.add_many([event_id])
+            stats["ok"] += 1
+            _observe(item, outcome="ok", db_sec=now - t_db, total_sec=now - t0)
+            return True
+
+        except Exception as e:
+            attempt += 1
+            M_ATTEMPT_ERRORS.inc(event_type=_type_label(item["event_type"]))
+            if attempt < max_attempts:
+                _sleep_backoff(attempt)
+                continue
+
+            total_attempts = item.get("retry_attempt", 0) + attempt
+            if tier + 1 < len(RETRY_TIERS):
+                try:
+                    forward_retry(dlq, item=item, tier=tier + 1, attempt=total_attempts, err=e)
+                    stats["retried"] += 1
+                    _observe(item, outcome="retried", total_sec=time.monotonic() - t0)
+                except Exception as fwd_e:
+                    print(f"[consumer] ERROR: failed to forward to retry tier {tier + 1}: {fwd_e!r}, "
+                          f"sending to DLQ", flush=True)
+                else:
+                    if OFFSETS_IN_DB:
+                        try:
+                            with Session.begin() as db:
+                                _store_offset(db, item)
+                        except Exception as db_e:
+                            # re-read after a restart -> forwarded once more; the retry tier dedups on event_id
+                            print(f"[consumer] ERROR: failed to store offset after retry forward: {db_e!r}",
+                                  flush=True)
+                    return True
+
+            # Give up → DLQ + mark consumed to avoid infinite reprocessing in demo.
+            stats["errors"] += 1
+            fut = None
+            try:
+                fut = publish_dlq(
+                    dlq,
+                    topic=DLQ_TOPIC,
+                    record=record,
+                    msg=_msg(item),
+                    err=e,
+                    attempt=total_attempts,
+                    reason="processing_error",
+                    src={
+                        "topic": item["topic"],
+                        "partition": item["partition"],
+                        "offset": item["offset"],
+                        "key": _as_str_key(getattr(record, "key", None)),
+                    },
+                )
+            except Exception as dlq_e:
+                print(f"[consumer] ERROR: failed to publish DLQ: {dlq_e!r}", flush=True)
+
+            # Kafka-committed offsets go after the caller's flush_dlq(); an offset stored in Postgres
+            # by a later record of the poll would not wait for it -> no buffering there
+            if dlq_pending is not None and not (OFFSETS_IN_DB and tier < 0):
+                dlq_pending.append((item, fut, t0))
+            else:
+                flush_dlq(Session, dlq, [(item, fut, t0)], stats)
+            return True
+
+    return False
+
+
+def process_batch(Session, dlq: KafkaProducer, records: list, stats: dict, items: list | None = None) -> list:
+    """
+    Whole poll in ONE transaction: dedup via event_id = ANY(...), one multi-row consumed_events
+    insert, then ONE set-based read-model recompute for the distinct games of the new events
+    (a round start or a ready wave is many events of one game -> one recompute).
+    If that transaction fails, nothing of it is kept and the batch is replayed message by
+    message (process_record: retries / DLQ per message).
+
+    `items`: the records already parsed by the caller (pipeline decode stage, skipped ones counted there).
+    Returns the records that are done (their offsets may be committed).
+    """
+    t0 = time.monotonic()
+    M_BATCH_SIZE.observe(len(records))
+    done = []
+    if items is None:
+        items = []
+        for record in records:
+            item = _parse(record)
+            if item is None:
+                _skipped(stats)
+            else:
+                items.append(item)
+
+    try:
+        t_db = time.monotonic()
+        with Session.begin() as db:
+            # the cache answers for most events; only Bloom "maybe" ids go to the DB
+            seen, lookup = set(), []
+            for item in items:
+                if DEDUP.is_known(item["event_id"]) and not item["replayed"]:
+                    seen.add(item["event_id"])
+                elif item["replayed"] or DEDUP.maybe_consumed(item["event_id"]):
+                    lookup.append(item["event_id"])
+            stats["dedup_lookups"] += len(lookup)
+            seen |= already_consumed_many(db, event_ids=lookup)
+            seen |= below_watermark(db, items=[i for i in items if i["event_id"] not in seen])
+
+            fresh = []
+            for item in items:
+                if item["event_id"] in seen:
+                    stats["dedup"] += 1
+                    continue
+                seen.add(item["event_id"])  # the same event twice within one poll
+                fresh.append(item)
+
+            # compact (v2) values are decoded only now: the duplicates above never were
+            invalid = {id(i) for i in fresh if _msg(i) is None}
+            if invalid:
+                for _ in invalid:
+                    _skipped(stats)
+                fresh = [i for i in fresh if id(i) not in invalid]
+                items = [i for i in items if id(i) not in invalid]
+
+            inserted = mark_consumed_many(db, items=fresh)
+            if len(inserted) < len(fresh):
+                # consumed meanwhile (another instance, or an id the cache did not know): skip it here
+                stats["dedup"] += len(fresh) - len(inserted)
+                fresh = [i for i in fresh if i["event_id"] in inserted]
+
+            # demo: materialize by aggregate id (game id)
+            if READ_MODEL_MODE == "delta":
+                deltas, recompute = fold_read_model_deltas(fresh)
+                applied = apply_read_model_deltas(db, deltas=deltas)
+                recompute |= set(deltas) - applied  # no read-model row yet, or a guard did not match
+            else:
+                applied, recompute = set(), {i["aggregate_id"] for i in fresh}
+
+            recompute_read_models(
+                db,
+                game_ids=_distinct_last([i["aggregate_id"] for i in fresh if i["aggregate_id"] in recompute]),
+            )
+
+            if OFFSETS_IN_DB:
+                store_offsets(db, records=records)  # skipped and duplicate records included
+
+        now = time.monotonic()
+        fresh_ids = {id(i) for i in fresh}  # not event_id: the same event twice in a poll is one ok + one dedup
+        for item in items:
+            if id(item) in fresh_ids:
+                _observe(item, outcome="ok", db_sec=now - t_db, total_sec=now - t0)
+            else:
+                _observe(item, outcome="dedup")
+
+        DEDUP.add_many([i["event_id"] for i in items])
+        with _DELTA_LOCK:
+            _DELTA_TOUCHED.update(applied)
+        stats["ok"] += len(fresh)
+        stats["rm_delta"] += len(applied)
+        stats["rm_recompute"] += len(recompute)
+        return list(records)
+
+    except Exception as e:
+        print(f"[consumer] WARN: batch of {len(items)} failed ({type(e).__name__}: {e}), "
+              f"falling back to per-message processing", flush=True)
+
+    by_offset = {(i["partition"], i["offset"]): i for i in items}
+    dlq_pending = []
+    for record in records:
+        item = by_offset.get((record.partition, record.offset))
+        if item is not None and not process_record(Session, dlq, item, stats, dlq_pending):
+            break  # STOP: nothing after this record may be committed
+        done.append(record)
+    flush_dlq(Session, dlq, dlq_pending, stats)
+    return done
+
+
+def dead_letter_chunk(Session, dlq: KafkaProducer, records: list, err: Exception, stats: dict,
+                      items: list | None = None) -> None:
+    """
+    Last resort for a chunk whose processing raised past process_batch() / process_record() (those retry and
+    dead-letter failing events themselves, so this is a bug or an unexpected state, not a bad event).
+    Every event of the chunk goes to the DLQ (reason consumer_error) and is marked consumed as DLQ:<type>;
+    the caller then completes the offsets, so the partition's commit point moves on instead of stalling.
+    An event applied before the error only becomes a DLQ duplicate: its replay is deduplicated.
+    """
+    if items is None:
+        items = []
+        for record in records:
+            try:
+                item = _parse(record)
+            except Exception:
+                item = None
+            if item is None:
+                _skipped(stats)
+            else:
+                items.append(item)
+
+    t0, pending = time.monotonic(), []
+    for item in items:
+        stats["errors"] += 1
+        fut = None
+        try:
+            fut = publish_dlq(
+                dlq,
+                topic=DLQ_TOPIC,
+                record=item["record"],
+                msg=_msg(item),
+                err=err,
+                attempt=item.get("retry_attempt", 0),
+                reason="consumer_error",
+                src={
+                    "topic": item["topic"],
+                    "partition": item["partition"],
+                    "offset": item["offset"],
+                    "key": _as_str_key(getattr(item["record"], "key", None)),
+                },
+            )
+        except Exception as dlq_e:
+            print(f"[consumer] ERROR: failed to publish DLQ for {item['event_id']}: {dlq_e!r}", flush=True)
+        pending.append((item, fut, t0))
+    flush_dlq(Session, dlq, pending, stats)
+
+
+def _commit_done(consumer: KafkaConsumer, done: list, pending: dict | None = None) -> None:
+    """
+    Commit next offset per partition for the records that are done (one commit per batch).
+    With `pending` (CONSUMER_OFFSETS=db, the offsets are already in Postgres) only remember them
+    for the next lazy Kafka commit.
+    """
+    offsets = _next_offsets(done)
+    if not offsets:
+        return
+    if pending is not None:
+        for tp, offset in offsets.items():
+            pending[tp] = max(offset, pending.get(tp, 0))
+        return
+    consumer.commit({tp: OffsetAndMetadata(offset, None) for tp, offset in offsets.items()})
+
+
+def _flush_lazy_commit(consumer: KafkaConsumer, pending: dict, tps=None) -> None:
+    """Kafka commit of offsets that already live in consumer_offsets: for lag monitoring only."""
+    tps = [tp for tp in (tps if tps is not None else list(pending)) if tp in pending]
+    if not tps:
+        return
+    offsets = {tp: OffsetAndMetadata(pending.pop(tp), None) for tp in tps}
+    try:
+        consumer.commit(offsets)
+    except Exception as e:
+        print(f"[consumer] WARN: lazy kafka commit failed: {e!r}", flush=True)
+
+
+class DbOffsetsListener(ConsumerRebalanceListener):
+    """CONSUMER_OFFSETS=db: newly assigned partitions resume from consumer_offsets, not from Kafka."""
+
+    def __init__(self, consumer: KafkaConsumer, Session, pending: dict):
+        self.consumer = consumer
+        self.Session = Session
+        self.pending = pending
+
+    def on_partitions_revoked(self, revoked):
+        _flush_lazy_commit(self.consumer, self.pending, revoked)
+
+    def on_partitions_assigned(self, assigned):
+        with self.Session() as db:
+            stored = load_offsets(db, tps=assigned)
+        for tp, offset in stored.items():
+            self.consumer.seek(tp, offset)
+        print("[consumer] partitions assigned: "
+              + ", ".join(f"{tp.partition}@{stored.get(tp, 'kafka')}" for tp in sorted(assigned)), flush=True)
+
+
+def _new_stats() -> dict:
+    return {"ok": 0, "dedup": 0, "dedup_lookups": 0, "skipped": 0, "dlq": 0, "errors": 0, "retried": 0,
+            "batches": 0, "rm_delta": 0, "rm_recompute": 0}
+
+
+def _log_stats(totals: dict, extra: str = "") -> None:
+    print(
+        f"[metrics] ok={totals['ok']} dedup={totals['dedup']} lookups={totals['dedup_lookups']} "
+        f"skipped={totals['skipped']} "
+        f"dlq={totals['dlq']} errors={totals['errors']} retried={totals['retried']} "
+        f"batches={totals['batches']} "
+        f"rm_delta={totals['rm_delta']} rm_recompute={totals['rm_recompute']}{extra}",
+        flush=True,
+    )
+
+
+class PartitionOffsets:
+    """
+    Dispatched offsets of one partition. Workers complete them in any order; the commit point is
+    the lowest offset that is not completed yet (everything below it is done).
+    """
+
+    def __init__(self, tp: TopicPartition):
+        self.tp = tp
+        self.abandoned = False  # revoked with work still queued: workers skip the rest
+        self.committed = None
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._done = set()
+        self._next = None
+
+    def add(self, offset: int) -> None:
+        with self._lock:
+            self._pending.append(offset)
+
+    def complete(self, offset: int) -> None:
+        with self._lock:
+            self._done.add(offset)
+            while self._pending and self._pending[0] in self._done:
+                o = self._pending.popleft()
+                self._done.discard(o)
+                self._next = o + 1
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def commit_offset(self) -> int | None:
+        """Next offset to commit, or None if nothing new completed since the last commit."""
+        with self._lock:
+            if self._next is None or self._next == self.committed:
+                return None
+            return self._next
+
+
+class _Worker(threading.Thread):
+    """Drains its queue in chunks of up to BATCH_MAX_RECORDS and processes them like the main loop does."""
+
+    def __init__(self, idx: int, Session, dlq: KafkaProducer):
+        super().__init__(name=f"consumer-worker-{idx}", daemon=True)
+        self.q: queue.Queue = queue.Queue()
+        self.Session = Session
+        self.dlq = dlq
+        self.stats = _new_stats()
+
+    def run(self):
+        while True:
+            work = [self.q.get()]
+            while len(work) < BATCH_MAX_RECORDS:
+                try:
+                    work.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+
+            last = work[-1] is None
+            work = [(t, r) for t, r in (w for w in work if w is not None) if not t.abandoned]
+            if work:
+                try:
+                    self._process(work)
+                except Exception as e:
+                    print(f"[consumer] ERROR: {self.name}: {e!r}, dead-lettering {len(work)} records", flush=True)
+                    dead_letter_chunk(self.Session, self.dlq, [r for _, r in work], e, self.stats)
+                    for tracker, record in work:
+                        tracker.complete(record.offset)
+            if last:
+                return
+
+    def _process(self, work: list):
+        trackers = {(r.partition, r.offset): t for t, r in work}
+        records = [r for _, r in work]
+        if BATCH_MODE:
+            done = process_batch(self.Session, self.dlq, records, self.stats)
+            self.stats["batches"] += 1
+        else:
+            done, dlq_pending = [], []
+            for record in records:
+                item = _parse(record)
+                if item is None:
+                    _skipped(self.stats)
+                elif not process_record(self.Session, self.dlq, item, self.stats, dlq_pending):
+                    break
+                done.append(record)
+            flush_dlq(self.Session, self.dlq, dlq_pending, self.stats)
+        for record in done:
+            trackers[(record.partition, record.offset)].complete(record.offset)
+
+
+class TrackedOffsets(ConsumerRebalanceListener):
+    """
+    Offsets of records handed to other threads, committed contiguously per partition by the thread
+    that owns the KafkaConsumer. Also the rebalance listener: revoked partitions are drained for up to
+    REVOKE_DRAIN_SEC and committed, whatever is still queued after that is abandoned (the new owner
+    re-reads it; consumed_events dedup makes that safe).
+    """
+
+    def __init__(self, consumer: KafkaConsumer):
+        self.consumer = consumer
+        self.trackers: dict[TopicPartition, PartitionOffsets] = {}
+        self.paused: set[TopicPartition] = set()
+
+    def track(self, record) -> PartitionOffsets:
+        tp = TopicPartition(record.topic, record.partition)
+        tracker = self.trackers.get(tp)
+        if tracker is None:
+            tracker = self.trackers[tp] = PartitionOffsets(tp)
+        tracker.add(record.offset)
+        return tracker
+
+    def commit(self, tps=None) -> None:
+        offsets = {}
+        for tp in (tps if tps is not None else list(self.trackers)):
+            tracker = self.trackers.get(tp)
+            nxt = tracker.commit_offset() if tracker is not None else None
+            if nxt is not None:
+                offsets[tp] = OffsetAndMetadata(nxt, None)
+        if offsets:
+            self.consumer.commit(offsets)
+            for tp, om in offsets.items():
+                self.trackers[tp].committed = om.offset
+
+    def drain(self, tps, timeout_sec: float) -> int:
+        """Wait until `tps` have nothing in flight; commit; abandon the rest. Returns records abandoned."""
+        tps = [tp for tp in tps if tp in self.trackers]
+        deadline = time.monotonic() + timeout_sec
+        while time.monotonic() < deadline and any(self.trackers[tp].in_flight for tp in tps):
+            time.sleep(0.05)
+        try:
+            self.commit(tps)
+        except Exception as e:
+            print(f"[consumer] WARN: commit on drain failed: {e!r}", flush=True)
+        abandoned = 0
+        for tp in tps:
+            tracker = self.trackers.pop(tp)
+            tracker.abandoned = True
+            abandoned += tracker.in_flight
+            self.paused.discard(tp)
+        return abandoned
+
+    def on_partitions_revoked(self, revoked):
+        abandoned = self.drain(list(revoked), REVOKE_DRAIN_SEC)
+        print(f"[consumer] partitions revoked: {sorted(tp.partition for tp in revoked)}"
+              + (f", abandoned {abandoned} in-flight records" if abandoned else ""), flush=True)
+
+    def on_partitions_assigned(self, assigned):
+        self.paused.clear()  # a new assignment starts unpaused
+        print(f"[consumer] partitions assigned: {sorted(tp.partition for tp in assigned)}", flush=True)
+
+
+class WorkerPool(TrackedOffsets):
+    """
+    Fetching stays in the main thread (KafkaConsumer is not thread-safe): poll -> dispatch() ->
+    flow_control() (pause/resume) -> commit().
+    """
+
+    def __init__(self, consumer: KafkaConsumer, Session, dlq: KafkaProducer, n: int):
+        super().__init__(consumer)
+        self.workers = [_Worker(i, Session, dlq) for i in range(n)]
+        for w in self.workers:
+            w.start()
+
+    def _worker_for(self, record) -> _Worker:
+        key = _as_str_key(record.key)
+        if WORKER_DISPATCH == "key" and key:
+            return self.workers[zlib.crc32(key.encode("utf-8")) % len(self.workers)]
+        return self.workers[record.partition % len(self.workers)]
+
+    def dispatch(self, records: list) -> None:
+        for record in records:
+            self._worker_for(record).q.put((self.track(record), record))
+
+    def flow_control(self) -> None:
+        for tp, tracker in self.trackers.items():
+            n = tracker.in_flight
+            if tp not in self.paused and n >= PARTITION_MAX_IN_FLIGHT:
+                self.consumer.pause(tp)
+                self.paused.add(tp)
+            elif tp in self.paused and n <= PARTITION_MAX_IN_FLIGHT // 2:
+                self.consumer.resume(tp)
+                self.paused.discard(tp)
+
+    def poll_timeout_ms(self) -> int:
+        # paused partitions are only resumed between polls
+        return min(POLL_TIMEOUT_MS, 50) if self.paused else POLL_TIMEOUT_MS
+
+    def stop(self, timeout_sec: float) -> None:
+        abandoned = self.drain(list(self.trackers), timeout_sec)
+        if abandoned:
+            print(f"[consumer] stop: abandoned {abandoned} in-flight records", flush=True)
+        for w in self.workers:
+            w.q.put(None)
+        for w in self.workers:
+            w.join(timeout=1)
+
+    def collect_stats(self, stats: dict) -> dict:
+        out = dict(stats)
+        for w in self.workers:
+            for k, v in w.stats.items():
+                out[k] = out.get(k, 0) + v
+        return out
+
+
+class StagedPipeline(TrackedOffsets):
+    """
+    CONSUMER_RUNTIME=pipeline: three stages joined by bounded queues, so a Kafka fetch, JSON decoding and
+    DB transactions run at the same time instead of taking turns.
+
+      fetch   thread, owns the KafkaConsumer: poll -> track offsets -> decode queue; commits what the
+              apply stage completed. A full queue pauses the assignment; poll() keeps the group session
+              alive but returns nothing until there is room again (backpressure).
+      decode  asyncio task: decode_value() (JSON, CONSUMER_VALIDATE), splits every poll by message key.
+      apply   PIPELINE_APPLIERS asyncio tasks, each runs process_batch() in the stage's thread pool on the
+              stage's own engine. One applier per key, so per-aggregate order holds.
+    """
+
+    def __init__(self, consumer: KafkaConsumer, Session, dlq: KafkaProducer, *, repair_Session,
+                 appliers: int, queue_size: int):
+        super().__init__(consumer)
+        self.Session = Session
+        self.repair_Session = repair_Session
+        self.dlq = dlq
+        self.n = max(1, appliers)
+        self.queue_size = max(1, queue_size)
+        self.stats = [_new_stats() for _ in range(self.n + 1)]  # [0] = decode stage
+        self.loop = None
+        self.decode_q: asyncio.Queue | None = None
+        self.apply_qs: list[asyncio.Queue] = []
+        self.executor = None
+        now = time.time()
+        self._next_lag = 0.0
+        self._next_repair = now + READ_MODEL_REPAIR_SEC
+        self._last_metrics = now
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.decode_q = asyncio.Queue(self.queue_size)
+        self.apply_qs = [asyncio.Queue(self.queue_size) for _ in range(self.n)]
+        fetch = threading.Thread(target=self._fetch, name="consumer-fetch", daemon=True)
+        with concurrent.futures.ThreadPoolExecutor(self.n, thread_name_prefix="consumer-apply") as self.executor:
+            appliers = [asyncio.create_task(self._apply(i)) for i in range(self.n)]
+            fetch.start()
+            await self._decode()
+            await asyncio.gather(*appliers)
+        await asyncio.to_thread(fetch.join)
+
+    # fetch stage
+    def _fetch(self) -> None:
+        try:
+            while not STOP:
+                try:
+                    polled = self.consumer.poll(timeout_ms=POLL_TIMEOUT_MS, max_records=BATCH_MAX_RECORDS)
+                    records = [r for tp_records in polled.values() for r in tp_records]
+                    if records:
+                        self._put(self.decode_q, [(self.track(r), r) for r in records])
+                    self.commit()
+                except Exception as loop_e:
+                    print(f"[consumer] ERROR: fetch stage exception: {loop_e!r}", flush=True)
+                    _sleep_backoff(3)
+                self._housekeeping()
+        finally:
+            abandoned = self.drain(list(self.trackers), REVOKE_DRAIN_SEC)
+            if abandoned:
+                print(f"[consumer] stop: abandoned {abandoned} in-flight records", flush=True)
+            # after everything queued so far (asyncio.Queue serves waiting putters in order)
+            asyncio.run_coroutine_threadsafe(self.decode_q.put(None), self.loop).result()
+
+    def _put(self, q: asyncio.Queue, work) -> None:
+        """Hand `work` to the event loop; while the queue is full, keep polling with the assignment paused."""
+        fut = asyncio.run_coroutine_threadsafe(q.put(work), self.loop)
+        paused = False
+        try:
+            while not STOP:
+                try:
+                    fut.result(timeout=0.05)
+                    return
+                except concurrent.futures.TimeoutError:
+                    pass
+                if not paused:
+                    self.consumer.pause(*self.consumer.assignment())
+                    paused = True
+                # heartbeat/rebalance only; a partition assigned meanwhile is not paused -> rewind and pause it
+                for tp, records in self.consumer.poll(timeout_ms=50).items():
+                    self.consumer.seek(tp, records[0].offset)
+                    self.consumer.pause(tp)
+                self.commit()
+        finally:
+            if paused:
+                self.consumer.resume(*self.consumer.assignment())
+        # STOP while waiting: the put stays queued and is drained like the rest
+
+    def _housekeeping(self) -> None:
+        now = time.time()
+        if METRICS_PORT and now >= self._next_lag:
+            try:
+                update_lag(self.consumer)
+            except Exception as e:
+                print(f"[consumer] WARN: lag update failed: {e!r}", flush=True)
+            self._next_lag = now + LAG_EVERY_SEC
+
+        if READ_MODEL_MODE == "delta" and now >= self._next_repair:
+            try:
+                repaired = repair_read_model(self.repair_Session)
+                if repaired:
+                    print(f"[consumer] read model repair: recomputed {repaired} games", flush=True)
+            except Exception as e:
+                print(f"[consumer] WARN: read model repair failed: {e!r}", flush=True)
+            self._next_repair = now + READ_MODEL_REPAIR_SEC
+
+        if now - self._last_metrics >= 10:
+            totals = self.collect_stats()
+            _log_stats(totals, extra=f" queued={self.decode_q.qsize()}/"
+                                     + ",".join(str(q.qsize()) for q in self.apply_qs))
+            self._last_metrics = now
+
+    # decode stage
+    async def _decode(self) -> None:
+        stats = self.stats[0]
+        while (work := await self.decode_q.get()) is not None:
+            chunks = [[] for _ in range(self.n)]
+            for tracker, record in work:
+                if tracker.abandoned:
+                    continue
+                record = record._replace(value=decode_value(record.value))
+                item = _parse(record)
+                if item is None:
+                    _skipped(stats)  # still goes to its applier: the offset completes in order there
+                key = _as_str_key(record.key)
+                idx = zlib.crc32(key.encode("utf-8")) % self.n if key else record.partition % self.n
+                chunks[idx].append((tracker, record, item))
+            for q, chunk in zip(self.apply_qs, chunks):
+                if chunk:
+                    await q.put(chunk)
+        for q in self.apply_qs:
+            await q.put(None)
+
+    # apply stage
+    async def _apply(self, idx: int) -> None:
+        q, stats = self.apply_qs[idx], self.stats[idx + 1]
+        while (chunk := await q.get()) is not None:
+            chunk = [c for c in chunk if not c[0].abandoned]
+            if not chunk:
+                continue
+            records = [r for _, r, _ in chunk]
+            items = [i for _, _, i in chunk if i is not None]
+            try:
+                done = await self.loop.run_in_executor(
+                    self.executor, process_batch, self.Session, self.dlq, records, stats, items,
+                )
+            except Exception as e:
+                print(f"[consumer] ERROR: apply stage {idx}: {e!r}, dead-lettering {len(chunk)} records", flush=True)
+                await self.loop.run_in_executor(
+                    self.executor, dead_letter_chunk, self.Session, self.dlq, records, e, stats, items,
+                )
+                done = records
+            stats["batches"] += 1
+            trackers = {(r.partition, r.offset): t for t, r, _ in chunk}
+            for record in done:
+                trackers[(record.partition, record.offset)].complete(record.offset)
+
+    def collect_stats(self) -> dict:
+        out = _new_stats()
+        for stats in self.stats:
+            for k, v in stats.items():
+                out[k] += v
+        return out
+
+
+def run_pipeline(repair_Session) -> None:
+    """CONSUMER_RUNTIME=pipeline; the apply stage gets its own engine (one connection per applier)."""
+    engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True, pool_size=PIPELINE_APPLIERS,
+                           max_overflow=2)
     Session = sessionmaker(bind=engine, future=True)
+    _watch_reconnects(engine)
 
     consumer = KafkaConsumer(
-        TOPIC,
         bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
         group_id=GROUP_ID,
         enable_auto_commit=False,
         auto_offset_reset="earliest",
-        value_deserializer=safe_json_deserializer,
-        key_deserializer=lambda b: b.decode("utf-8") if b else None,
-        consumer_timeout_ms=1000,
+        key_deserializer=lambda b: b.decode("utf-8") if b else None,  # values are decoded by the decode stage
+        max_poll_records=BATCH_MAX_RECORDS,
     )
+    dlq = _dlq_producer()
+    pipeline = StagedPipeline(consumer, Session, dlq, repair_Session=repair_Session,
+                              appliers=PIPELINE_APPLIERS, queue_size=PIPELINE_QUEUE)
+    consumer.subscribe([TOPIC], listener=pipeline)
+    _start_metrics("consumer")
+
+    try:
+        asyncio.run(pipeline.run())
+    finally:
+        try:
+            dlq.flush(5)
+        except Exception:
+            pass
+        try:
+            dlq.close(5)
+        except Exception:
+            pass
+        try:
+            consumer.close(5)
+        except Exception:
+            pass
+
+
+_LAG_LABELS: set[tuple] = set()  # (topic, partition) currently exported by game_consumer_lag
+
 
-    dlq = KafkaProducer(
+def update_lag(consumer: KafkaConsumer, Session=None) -> None:
+    """
+    game_consumer_lag per assigned partition. Committed = consumer_offsets with CONSUMER_OFFSETS=db
+    (pass Session), Kafka's committed offset otherwise; nothing committed yet = from the beginning.
+    """
+    tps = list(consumer.assignment())
+    for topic, partition in list(_LAG_LABELS):
+        if TopicPartition(topic, partition) not in tps:
+            M_LAG.remove(topic=topic, partition=partition)
+            _LAG_LABELS.discard((topic, partition))
+    if not tps:
+        return
+
+    end = consumer.end_offsets(tps)
+    if Session is not None:
+        with Session() as db:
+            committed = load_offsets(db, tps=tps)
+    else:
+        committed = {tp: consumer.committed(tp) for tp in tps}
+    missing = [tp for tp in tps if committed.get(tp) is None]
+    if missing:
+        committed.update(consumer.beginning_offsets(missing))
+
+    for tp in tps:
+        if tp in end and committed.get(tp) is not None:
+            M_LAG.set(max(0, end[tp] - committed[tp]), topic=tp.topic, partition=tp.partition)
+            _LAG_LABELS.add((tp.topic, tp.partition))
+
+
+def _start_metrics(prefix: str) -> None:
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        print(f"[{prefix}] metrics on :{METRICS_PORT}/metrics", flush=True)
+
+
+def _warm_dedup(Session) -> None:
+    try:
+        n = DEDUP.warm(Session)
+        if DEDUP.enabled:
+            print(f"[consumer] dedup cache: warmed with {n} event_ids (bloom {DEDUP.m} bits, k={DEDUP.k})", flush=True)
+    except Exception as e:
+        # an empty filter only means no lookups; the consumed_events insert still dedups
+        print(f"[consumer] WARN: dedup cache warm-up failed: {e!r}", flush=True)
+
+
+def _dlq_producer() -> KafkaProducer:
+    """Producer for the DLQ and the retry tier topics."""
+    return KafkaProducer(
         bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
         key_serializer=lambda s: s.encode("utf-8") if s else None,
         value_serializer=lambda v: json.dumps(v, ensure_ascii=False).encode("utf-8"),
     )
 
-    ok = dedup = skipped = dlq_cnt = errors = 0
+
+def main():
+    print(f"[consumer] bootstrap={KAFKA_BOOTSTRAP_SERVERS} topic={TOPIC} group={GROUP_ID} "
+          f"mode={'batch' if BATCH_MODE else 'single'}"
+          + (f" max_records={BATCH_MAX_RECORDS} read_model={READ_MODEL_MODE}" if BATCH_MODE else "")
+          + (f" workers={WORKERS} dispatch={WORKER_DISPATCH}" if WORKERS > 0 else "")
+          + (f" runtime=pipeline appliers={PIPELINE_APPLIERS} queue={PIPELINE_QUEUE}" if RUNTIME == "pipeline" else ""),
+          flush=True)
+
+    engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True, pool_size=max(5, WORKERS + 1))
+    Session = sessionmaker(bind=engine, future=True)
+    _watch_reconnects(engine)
+    with Session() as db:
+        schema(db)  # fail fast without consumed_events; prints what was detected
+    _warm_dedup(Session)
+
+    if RUNTIME == "pipeline":
+        if WORKERS > 0 or OFFSETS_IN_DB:
+            raise SystemExit("[consumer] CONSUMER_RUNTIME=pipeline has its own apply stage and commits to Kafka, "
+                             "unset CONSUMER_WORKERS / CONSUMER_OFFSETS=db")
+        run_pipeline(Session)
+        return
+
+    if OFFSETS_IN_DB:
+        if WORKERS > 0:
+            raise SystemExit("[consumer] CONSUMER_OFFSETS=db needs in-order processing, unset CONSUMER_WORKERS")
+        with Session() as db:
+            if not schema(db).has_consumer_offsets:
+                raise SystemExit("[consumer] CONSUMER_OFFSETS=db: consumer_offsets is missing (alembic upgrade head)")
+
+    consumer = KafkaConsumer(
+        bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+        group_id=GROUP_ID,
+        enable_auto_commit=False,
+        auto_offset_reset="earliest",
+        value_deserializer=decode_value,
+        key_deserializer=lambda b: b.decode("utf-8") if b else None,
+        consumer_timeout_ms=1000,
+        max_poll_records=BATCH_MAX_RECORDS,
+    )
+
+    dlq = _dlq_producer()
+
+    pool = None
+    pending = {} if OFFSETS_IN_DB else None  # CONSUMER_OFFSETS=db: offsets waiting for the lazy Kafka commit
+    if WORKERS > 0:
+        pool = WorkerPool(consumer, Session, dlq, WORKERS)
+        consumer.subscribe([TOPIC], listener=pool)
+    elif OFFSETS_IN_DB:
+        consumer.subscribe([TOPIC], listener=DbOffsetsListener(consumer, Session, pending))
+    else:
+        consumer.subscribe([TOPIC])
+    next_kafka_commit = time.time() + KAFKA_COMMIT_SEC
+    next_lag = 0.0
+    _start_metrics("consumer")
+
+    stats = _new_stats()
     last_metrics = time.time()
+    next_repair = time.time() + READ_MODEL_REPAIR_SEC
 
     try:
         while not STOP:
             any_msg = False
 
             try:
-                for record in consumer:
-                    any_msg = True
-                    if STOP:
-                        break
+                if pool is not None:
+                    polled = consumer.poll(timeout_ms=pool.poll_timeout_ms(), max_records=BATCH_MAX_RECORDS)
+                    records = [r for tp_records in polled.values() for r in tp_records]
+                    if records:
+                        any_msg = True
+                        pool.dispatch(records)
+                    pool.flow_control()
+                    pool.commit()
 
-                    msg = record.value
-                    if msg is None:
-                        skipped += 1
-                        consumer.commit()
-                        continue
+                elif BATCH_MODE:
+                    polled = consumer.poll(timeout_ms=POLL_TIMEOUT_MS, max_records=BATCH_MAX_RECORDS)
+                    # partitions are independent; within one partition records are in offset order
+                    records = [r for tp_records in polled.values() for r in tp_records]
+                    if records:
+                        any_msg = True
+                        done = process_batch(Session, dlq, records, stats)
+                        _commit_done(consumer, done, pending)
+                        stats["batches"] += 1
+                        if len(done) < len(records):
+                            break  # STOP in the middle of the per-message fallback
 
-                    event_id = msg.get("event_id")
-                    event_type = msg.get("type") or msg.get("event_type") or "unknown"
-                    aggregate = msg.get("aggregate") or {}
-                    agg_type = aggregate.get("type")
-                    agg_id = aggregate.get("id")
+                else:
+                    for record in consumer:
+                        any_msg = True
+                        if STOP:
+                            break
 
-                    # Basic validation to avoid hard crashes on malformed messages.
-                    if not is_valid_uuid(event_id) or not is_valid_uuid(agg_id):
-                        skipped += 1
-                        consumer.commit()
-                        continue
+                        item = _parse(record)
+                        if item is None:
+                            _skipped(stats)
+                            _commit_done(consumer, [record], pending)
+                            continue
 
-                    attempt = 0
-                    handled = False
-
-                    while not handled and attempt < MAX_ATTEMPTS and not STOP:
-                        try:
-                            with Session.begin() as db:
-                                if already_consumed(db, event_id=event_id):
-                                    dedup += 1
-                                    handled = True
-                                    break
-
-                                # demo: materialize by aggregate id (game id)
-                                recompute_read_model(db, game_id=agg_id)
-
-                                mark_consumed(
-                                    db,
-                                    event_id=event_id,
-                                    topic=record.topic,
-                                    partition=record.partition,
-                                    offset=record.offset,
-                                    aggregate_type=agg_type,
-                                    aggregate_id=agg_id,
-                                    event_type=event_type,
-                                )
-
-                            ok += 1
-                            handled = True
-
-                        except Exception as e:
-                            attempt += 1
-                            if attempt < MAX_ATTEMPTS:
-                                _sleep_backoff(attempt)
-                                continue
-
-                            # Give up → DLQ + mark consumed to avoid infinite reprocessing in demo.
-                            errors += 1
-                            try:
-                                publish_dlq(
-                                    dlq,
-                                    topic=DLQ_TOPIC,
-                                    record=record,
-                                    msg=msg,
-                                    err=e,
-                                    attempt=attempt,
-                                    reason="processing_error",
-                                )
-                                dlq_cnt += 1
-                            except Exception as dlq_e:
-                                print(f"[consumer] ERROR: failed to publish DLQ: {dlq_e!r}", flush=True)
-
-                            try:
-                                with Session.begin() as db:
-                                    mark_consumed(
-                                        db,
-                                        event_id=event_id,
-                                        topic=record.topic,
-                                        partition=record.partition,
-                                        offset=record.offset,
-                                        aggregate_type=agg_type,
-                                        aggregate_id=agg_id,
-                                        event_type=f"DLQ:{event_type}",
-                                    )
-                            except Exception as db_e:
-                                print(f"[consumer] ERROR: failed to mark_consumed after DLQ: {db_e!r}", flush=True)
-
-                            handled = True
-
-                    consumer.commit()
+                        if not process_record(Session, dlq, item, stats):
+                            break  # STOP: leave the offset uncommitted
+                        _commit_done(consumer, [record], pending)
 
             except Exception as loop_e:
                 # If kafka connection hiccups, don't crash the container.
                 print(f"[consumer] ERROR: consumer loop exception: {loop_e!r}", flush=True)
                 _sleep_backoff(3)
 
-            if not any_msg:
-                time.sleep(IDLE_SLEEP_SEC)
+            if not any_msg and not BATCH_MODE and pool is None:
+                time.sleep(IDLE_SLEEP_SEC)  # poll() already blocks for POLL_TIMEOUT_MS
 
             now = time.time()
+            if BATCH_MODE and READ_MODEL_MODE == "delta" and now >= next_repair:
+                try:
+                    repaired = repair_read_model(Session)
+                    if repaired:
+                        print(f"[consumer] read model repair: recomputed {repaired} games", flush=True)
+                except Exception as e:
+                    print(f"[consumer] WARN: read model repair failed: {e!r}", flush=True)
+                next_repair = now + READ_MODEL_REPAIR_SEC
+
+            if METRICS_PORT and now >= next_lag:
+                try:
+                    update_lag(consumer, Session if OFFSETS_IN_DB else None)
+                except Exception as e:
+                    print(f"[consumer] WARN: lag update failed: {e!r}", flush=True)
+                next_lag = now + LAG_EVERY_SEC
+
+            if pending and now >= next_kafka_commit:
+                _flush_lazy_commit(consumer, pending)
+                next_kafka_commit = now + KAFKA_COMMIT_SEC
+
             if now - last_metrics >= 10:
-                print(
-                    f"[metrics] ok={ok} dedup={dedup} skipped={skipped} dlq={dlq_cnt} errors={errors}",
-                    flush=True,
-                )
+                _log_stats(pool.collect_stats(stats) if pool is not None else stats)
                 last_metrics = now
 
     finally:
+        if pool is not None:
+            try:
+                pool.stop(REVOKE_DRAIN_SEC)
+            except Exception as e:
+                print(f"[consumer] WARN: worker pool stop failed: {e!r}", flush=True)
+        if pending:
+            _flush_lazy_commit(consumer, pending)
         try:
             dlq.flush(5)
         except Exception:
@@ -337,5 +1936,242 @@ def main():
             pass
 
 
+def run_retry_worker():
+    """
+    Re-delivers messages from the retry tier topics once x-retry-due-ms has passed.
+    A tier topic is in due order per partition, so a record that is not due yet parks its partition
+    (seek back + pause) until then; the other partitions/tiers keep going.
+    Processing is process_record(): a failure forwards to the next tier or, after the last one, to DLQ.
+    """
+    if not RETRY_TIERS:
+        raise SystemExit("[retry] CONSUMER_RETRY_TIERS is empty, nothing to do")
+
+    topics = [retry_topic(d) for d in RETRY_TIERS]
+    print(f"[retry] bootstrap={KAFKA_BOOTSTRAP_SERVERS} topics={','.join(topics)} group={RETRY_GROUP_ID}",
+          flush=True)
+
+    engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
+    Session = sessionmaker(bind=engine, future=True)
+    _watch_reconnects(engine)
+    with Session() as db:
+        schema(db)  # fail fast without consumed_events; prints what was detected
+    _warm_dedup(Session)
+
+    consumer = KafkaConsumer(
+        *topics,
+        bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+        group_id=RETRY_GROUP_ID,
+        enable_auto_commit=False,
+        auto_offset_reset="earliest",
+        value_deserializer=decode_value,
+        key_deserializer=lambda b: b.decode("utf-8") if b else None,
+        max_poll_records=BATCH_MAX_RECORDS,
+    )
+    dlq = _dlq_producer()
+
+    stats = _new_stats()
+    paused: dict[TopicPartition, int] = {}  # partition -> due ms of its head record
+    last_metrics = time.time()
+    next_lag = 0.0
+    _start_metrics("retry")
+
+    try:
+        while not STOP:
+            try:
+                now_ms = int(time.time() * 1000)
+                assigned = consumer.assignment()
+                for tp in [tp for tp, due in paused.items() if due <= now_ms or tp not in assigned]:
+                    if tp in assigned:
+                        consumer.resume(tp)
+                    del paused[tp]
+
+                timeout_ms = POLL_TIMEOUT_MS
+                if paused:
+                    timeout_ms = max(10, min(timeout_ms, min(paused.values()) - now_ms))
+                polled = consumer.poll(timeout_ms=timeout_ms, max_records=BATCH_MAX_RECORDS)
+
+                offsets = {}
+                dlq_pending = []
+                stopped = False
+                for tp, records in polled.items():
+                    for record in records:
+                        due = int(_headers(record).get("x-retry-due-ms") or 0)
+                        if due > int(time.time() * 1000):
+                            consumer.seek(tp, record.offset)
+                            consumer.pause(tp)
+                            paused[tp] = due
+                            break
+
+                        item = _parse(record)
+                        if item is None:
+                            _skipped(stats)
+                        elif not process_record(Session, dlq, item, stats, dlq_pending):
+                            stopped = True
+                            break
+                        offsets[tp] = OffsetAndMetadata(record.offset + 1, None)
+                    if stopped:
+                        break
+
+                flush_dlq(Session, dlq, dlq_pending, stats)  # one DLQ flush per poll, before the commit
+                if offsets:
+                    consumer.commit(offsets)
+
+            except Exception as loop_e:
+                print(f"[retry] ERROR: retry loop exception: {loop_e!r}", flush=True)
+                _sleep_backoff(3)
+
+            now = time.time()
+            if METRICS_PORT and now >= next_lag:
+                try:
+                    update_lag(consumer)
+                except Exception as e:
+                    print(f"[retry] WARN: lag update failed: {e!r}", flush=True)
+                next_lag = now + LAG_EVERY_SEC
+
+            if now - last_metrics >= 10:
+                print(
+                    f"[metrics] retry ok={stats['ok']} dedup={stats['dedup']} skipped={stats['skipped']} "
+                    f"retried={stats['retried']} dlq={stats['dlq']} errors={stats['errors']} paused={len(paused)}",
+                    flush=True,
+                )
+                last_metrics = now
+
+    finally:
+        try:
+            dlq.flush(5)
+            dlq.close(5)
+        except Exception:
+            pass
+        try:
+            consumer.close(5)
+        except Exception:
+            pass
+
+
+# ---------------------------
+# Read model rebuild (python consumer.py --rebuild)
+# ---------------------------
+REBUILD_TABLE = "game_read_model_rebuild"
+
+# the projection itself is game_read_model_rows() (migration 3d9b5c7f1e20), shared with
+# recompute_game_read_models(); a game that no longer exists yields no row. Every chat is built once.
+REBUILD_APPLY_SQL = f"""
+INSERT INTO {REBUILD_TABLE}
+SELECT * FROM game_read_model_rows(CAST(:game_ids AS uuid[]));
+"""
+
+REBUILD_CHUNK = int(os.getenv("CONSUMER_REBUILD_CHUNK", "5000"))  # games per set-based statement
+
+# latest game of every chat (or of the given chats): what the shadow table is built from
+REBUILD_GAMES_SQL = """
+SELECT DISTINCT ON (chat_id) id::text
+FROM game_sessions
+WHERE CAST(:chat_ids AS bigint[]) IS NULL OR chat_id = ANY(CAST(:chat_ids AS bigint[]))
+ORDER BY chat_id, created_at DESC;
+"""
+
+# start of the oldest transaction still running: a live write that may commit after the shadow read its
+# game has updated_at (now() = its transaction start) at or after this
+REBUILD_SINCE_SQL = """
+SELECT LEAST(now(), COALESCE(min(xact_start), now()))
+FROM pg_stat_activity
+WHERE datname = current_database() AND xact_start IS NOT NULL;
+"""
+
+
+class ReadModelRebuild:
+    """
+    Rebuild game_read_model in a shadow table and swap it in, outside the consumer group and without
+    consumed_events. The projection is derived from game_sessions / game_players / game_phase_ready (an event
+    only says "this game changed"), so the rebuild reads those tables, not the topic:
+
+    1. shadow table (UNLOGGED, LIKE game_read_model) filled with the latest game of every chat by
+       game_read_model_rows(), CONSUMER_REBUILD_CHUNK games per statement and transaction;
+    2. swap in one transaction: EXCLUSIVE lock on game_read_model (the live consumer waits, readers do not);
+       the chats the live consumer wrote since step 1 started (updated_at) are built once more from the
+       committed state, then game_read_model's rows are replaced.
+
+    Step 2 only redoes what the consumer touched during the build, not the chats where the old, possibly
+    corrupt, live rows differ: those are what the rebuild replaces.
+    The swap copies rows instead of renaming tables: v_current_game_by_chat, the indexes and the foreign key
+    stay attached to game_read_model. One row per chat, so the copy is small.
+    """
+
+    def __init__(self, Session):
+        self.Session = Session
+        self.stats = {"games": 0, "reconciled": 0}
+
+    def prepare(self) -> tuple[list[str], dt.datetime]:
+        with self.Session.begin() as db:
+            since = db.execute(sql_text(REBUILD_SINCE_SQL)).scalar()
+            db.execute(sql_text(f"DROP TABLE IF EXISTS {REBUILD_TABLE}"))
+            # UNLOGGED: a crashed rebuild is simply started again
+            db.execute(sql_text(f"CREATE UNLOGGED TABLE {REBUILD_TABLE} (LIKE game_read_model INCLUDING ALL)"))
+            return db.execute(sql_text(REBUILD_GAMES_SQL), {"chat_ids": None}).scalars().all(), since
+
+    def apply(self, game_ids: list[str], db=None) -> int:
+        for i in range(0, len(game_ids), REBUILD_CHUNK):
+            chunk = game_ids[i:i + REBUILD_CHUNK]
+            if db is not None:
+                db.execute(sql_text(REBUILD_APPLY_SQL), {"game_ids": chunk})
+                continue
+            with self.Session.begin() as tx:
+                tx.execute(sql_text(REBUILD_APPLY_SQL), {"game_ids": chunk})
+        return len(game_ids)
+
+    def run(self) -> dict:
+        t0 = time.monotonic()
+        games, since = self.prepare()
+        self.stats["games"] = self.apply(games)
+        print(f"[rebuild] {self.stats['games']} games in {REBUILD_TABLE} after "
+              f"{time.monotonic() - t0:.1f}s, swapping", flush=True)
+        if STOP:
+            raise SystemExit("[rebuild] interrupted, game_read_model left untouched")
+
+        with self.Session.begin() as db:
+            db.execute(sql_text("LOCK TABLE game_read_model IN EXCLUSIVE MODE"))
+            chats = db.execute(
+                sql_text("SELECT chat_id FROM game_read_model WHERE updated_at >= :since"), {"since": since},
+            ).scalars().all()
+            if chats:
+                db.execute(sql_text(f"DELETE FROM {REBUILD_TABLE} WHERE chat_id = ANY(CAST(:c AS bigint[]))"),
+                           {"c": chats})
+                games = db.execute(sql_text(REBUILD_GAMES_SQL), {"chat_ids": chats}).scalars().all()
+                self.stats["reconciled"] = self.apply(games, db=db)
+            db.execute(sql_text("DELETE FROM game_read_model"))
+            n = db.execute(sql_text(f"""
+                INSERT INTO game_read_model
+                SELECT s.*
+                FROM {REBUILD_TABLE} s
+                WHERE EXISTS (SELECT 1 FROM game_sessions gs WHERE gs.id = s.game_id)
+            """)).rowcount
+            db.execute(sql_text(f"DROP TABLE {REBUILD_TABLE}"))
+
+        return {**self.stats, "rows": n, "elapsed_sec": round(time.monotonic() - t0, 3)}
+
+
+def run_rebuild():
+    print(f"[rebuild] into {REBUILD_TABLE}", flush=True)
+    engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
+    Session = sessionmaker(bind=engine, future=True)
+    with Session() as db:
+        if not schema(db).has_read_model or db.execute(
+            sql_text("SELECT to_regprocedure('game_read_model_rows(uuid[])')")
+        ).scalar() is None:
+            raise SystemExit("[rebuild] game_read_model / game_read_model_rows() missing (alembic upgrade head)")
+    result = ReadModelRebuild(Session).run()
+    print(json.dumps({"rebuild": result}, ensure_ascii=False), flush=True)
+
+
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--retry-worker", action="store_true", help="consume the retry tier topics instead of TOPIC")
+    ap.add_argument("--rebuild", action="store_true",
+                    help="rebuild game_read_model in a shadow table from the game tables, then swap it in")
+    args = ap.parse_args()
+    if args.retry_worker:
+        run_retry_worker()
+    elif args.rebuild:
+        run_rebuild()
+    else:
+        main()
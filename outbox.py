@@ -40,15 +40,16 @@ def emit_event(
     if _requires_idem(event_type) and not idempotency_key:
         raise ValueError(f"idempotency_key is required for event_type={event_type}")
 
+    # outbox_events is partitioned by created_at, so there is no global unique index for ON CONFLICT.
+    # BEFORE INSERT trigger outbox_events_idempotency_bi dedups via outbox_idempotency_keys
+    # (a repeated key is silently skipped, within the dedup horizon of outbox_retention.py).
+    # AFTER INSERT trigger outbox_events_notify_ai -> NOTIFY outbox_events on COMMIT (wakes the relay)
     db.execute(
         sql_text("""
             INSERT INTO outbox_events
                 (event_type, aggregate_type, aggregate_id, payload, idempotency_key)
             VALUES
                 (:event_type, :aggregate_type, :aggregate_id, CAST(:payload AS jsonb), :idempotency_key)
-            ON CONFLICT (idempotency_key)
-            WHERE idempotency_key IS NOT NULL
-            DO NOTHING
         """),
         {
             "event_type": event_type,
@@ -2,8 +2,13 @@ import os
 import json
 import time
 import argparse
+import select
+import signal
 import socket
 import sys
+import threading
+import _thread
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
@@ -11,7 +16,12 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import text as sql_text
 
+import psycopg2
 from kafka import KafkaProducer
+from kafka import codec as kafka_codec
+
+from metrics import Counter, Gauge, Histogram, start_http_server
+from services.contracts.contracts import to_compact
 
 load_dotenv()
 
@@ -32,12 +42,108 @@ IDLE_SLEEP = float(os.getenv("OUTBOX_POLL_SLEEP_SEC", "0.5"))
 
 LOCK_TTL_SEC = int(os.getenv("OUTBOX_LOCK_TTL_SEC", "30"))
 PUBLISH_TIMEOUT_SEC = float(os.getenv("OUTBOX_PUBLISH_TIMEOUT_SEC", "10"))
+# Lease heartbeat: while a batch is in flight, locked_until of its rows is pushed forward every
+# HEARTBEAT_SEC, so LOCK_TTL_SEC only has to cover a dead relay, not a slow batch. 0 = off.
+HEARTBEAT_SEC = float(os.getenv("OUTBOX_HEARTBEAT_SEC", str(max(1.0, LOCK_TTL_SEC / 3))))
+
+# pipelined: send the whole reserved batch, wait for acks, finalize all rows in one transaction
+# sync:      legacy path, send_sync() + one transaction per event
+PUBLISH_MODE = os.getenv("OUTBOX_PUBLISH_MODE", "pipelined").strip().lower()
+
+# LISTEN/NOTIFY wake-up (trigger outbox_events_notify_ai). When enabled, an idle relay blocks on
+# LISTEN and IDLE_SLEEP is not used; LISTEN_FALLBACK_SEC is only a safety net (missed notify,
+# due next_retry_at, expired locks to reclaim).
+LISTEN_ENABLED = os.getenv("OUTBOX_LISTEN", "1").strip().lower() not in ("0", "false", "no", "off")
+NOTIFY_CHANNEL = os.getenv("OUTBOX_NOTIFY_CHANNEL", "outbox_events")
+LISTEN_FALLBACK_SEC = float(os.getenv("OUTBOX_LISTEN_FALLBACK_SEC", "5"))
+
+# Scale-out with per-aggregate ordering: aggregate_id is hashed into OWNERSHIP_BUCKETS buckets,
+# each bucket is owned by exactly one relay via a session advisory lock, and a relay only
+# reserves rows from its buckets. 0 = off (single relay / no ordering guarantee across relays).
+OWNERSHIP_BUCKETS = int(os.getenv("OUTBOX_OWNERSHIP_BUCKETS", "0"))
+REBALANCE_SEC = float(os.getenv("OUTBOX_REBALANCE_SEC", "5"))
+LOCK_NAMESPACE = int(os.getenv("OUTBOX_LOCK_NAMESPACE", "7301"))  # advisory lock classid
+
+# Adaptive batch size / idle poll interval (BATCH_SIZE is the starting point, IDLE_SLEEP the floor).
+ADAPTIVE = os.getenv("OUTBOX_ADAPTIVE", "1").strip().lower() not in ("0", "false", "no", "off")
+BATCH_MIN = int(os.getenv("OUTBOX_BATCH_MIN", "10"))
+BATCH_MAX = int(os.getenv("OUTBOX_BATCH_MAX", "500"))
+POLL_MAX_SEC = float(os.getenv("OUTBOX_POLL_MAX_SEC", "5"))
+TARGET_CYCLE_SEC = float(os.getenv("OUTBOX_TARGET_CYCLE_SEC", "1.0"))  # publish + finalize per batch
+TARGET_LAG_SEC = float(os.getenv("OUTBOX_TARGET_LAG_SEC", "1.0"))      # backlog age worth growing for
+RECLAIM_EVERY_SEC = float(os.getenv("OUTBOX_RECLAIM_EVERY_SEC", "5"))
+
+# Producer profile: "reliable" (ordered retries + batch compression) or "legacy" (old settings).
+PRODUCER_PROFILE = os.getenv("OUTBOX_PRODUCER_PROFILE", "reliable").strip().lower()
+COMPRESSION = os.getenv("OUTBOX_COMPRESSION", "auto").strip().lower()  # auto|zstd|lz4|snappy|gzip|none
+PRODUCER_LINGER_MS = int(os.getenv("OUTBOX_PRODUCER_LINGER_MS", "5"))
+PRODUCER_BATCH_BYTES = int(os.getenv("OUTBOX_PRODUCER_BATCH_BYTES", "131072"))
+PRODUCER_RETRIES = int(os.getenv("OUTBOX_PRODUCER_RETRIES", "5"))
+
+# Envelope on the wire of TOPIC: 1 = JSON envelope of docs/events.md; 2 = compact (contracts.to_compact(): short
+# keys, epoch-ms timestamp, event_id/type/aggregate in headers, so consumers dedup without decoding the value).
+# Consumers read both: switch to 2 once they are updated. The DLQ always gets the v1 envelope.
+SCHEMA_VERSION = int(os.getenv("OUTBOX_SCHEMA_VERSION", "1"))
+if SCHEMA_VERSION not in (1, 2):
+    raise RuntimeError(f"OUTBOX_SCHEMA_VERSION must be 1 or 2, got {SCHEMA_VERSION}")
+
+# SIGTERM/SIGINT: finish (or abort) the in-flight batch within this budget, then return our
+# 'processing' rows to 'new' so the next relay picks them up without waiting for LOCK_TTL_SEC.
+DRAIN_TIMEOUT_SEC = float(os.getenv("OUTBOX_DRAIN_TIMEOUT_SEC", "8"))
+
+METRICS_PORT = int(os.getenv("OUTBOX_METRICS_PORT", "0"))  # 0 = no HTTP endpoint
+BACKLOG_PROBE_SEC = float(os.getenv("OUTBOX_BACKLOG_PROBE_SEC", "5"))
 
 engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
 OWNER = f"{socket.gethostname()}:{os.getpid()}"
 
+STOP = False           # shutdown requested: no new reserves
+_IN_BATCH = False      # rows of ours are in flight
+_DRAIN_DEADLINE = None
+_DRAIN_TIMER = None
+
+
+def _on_signal(sig, _frame):
+    """
+    Idle -> KeyboardInterrupt right away (nothing to drain).
+    Mid-batch -> let the batch finish, but a timer interrupts it after DRAIN_TIMEOUT_SEC;
+    a second signal aborts immediately.
+    """
+    global STOP, _DRAIN_DEADLINE, _DRAIN_TIMER
+    if STOP or not _IN_BATCH:
+        STOP = True
+        raise KeyboardInterrupt
+
+    STOP = True
+    _DRAIN_DEADLINE = time.monotonic() + DRAIN_TIMEOUT_SEC
+    print(f"[relay] got signal {sig}, draining in-flight batch (up to {DRAIN_TIMEOUT_SEC}s)...", flush=True)
+    _DRAIN_TIMER = threading.Timer(DRAIN_TIMEOUT_SEC, _thread.interrupt_main)  # re-enters here -> abort
+    _DRAIN_TIMER.daemon = True
+    _DRAIN_TIMER.start()
+
+
+# ----------------------------
+# Metrics (GET /metrics on OUTBOX_METRICS_PORT)
+# ----------------------------
+M_PUBLISH_LATENCY = Histogram(
+    "outbox_relay_publish_latency_seconds", "Kafka ack time per message (send -> ack)", ("topic",),
+)
+M_EVENTS = Counter(
+    "outbox_relay_events_total", "Finalized outbox events by outcome (published|retried|dead)",
+    ("event_type", "outcome"),
+)
+M_BATCH_SIZE = Histogram(
+    "outbox_relay_batch_size", "Rows reserved per batch",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+M_RECLAIMED = Counter("outbox_relay_reclaimed_total", "Expired processing locks returned to new")
+M_LEASE_LOST = Counter("outbox_relay_lease_lost_total", "In-flight rows whose lock was taken over (not finalized)")
+M_DB_SECONDS = Histogram("outbox_relay_db_seconds", "DB transaction time by operation", ("op",))
+M_BACKLOG_AGE = Gauge("outbox_relay_backlog_age_seconds", "now - oldest unpublished created_at")
+M_ADAPTIVE = Gauge("outbox_relay_adaptive", "Current adaptive controller values", ("param",))
+
 
 # ----------------------------
 # Helpers
@@ -95,6 +201,15 @@ def _check_mode() -> int:
     return 0 if kafka_ok else 2
 
 
+@contextmanager
+def _db_timer(op: str):
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        M_DB_SECONDS.observe(time.monotonic() - t0, op=op)
+
+
 def _json_default(o):
     if isinstance(o, datetime):
         return o.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
@@ -130,6 +245,13 @@ def _mk_message(row: dict) -> dict:
     }
 
 
+def wire_message(msg: dict, schema_version: int = SCHEMA_VERSION) -> tuple:
+    """Envelope as sent to TOPIC: (value, headers, timestamp_ms); v2 also sets the record timestamp to created_at."""
+    if schema_version == 2:
+        return to_compact(msg)
+    return msg, None, None
+
+
 # ----------------------------
 # SQL (reserve / finalize / reclaim)
 # ----------------------------
@@ -172,6 +294,48 @@ RETURNING
   o.last_error;
 """
 
+# Ownership mode: only rows from owned buckets, and only if no OLDER unpublished row of the same
+# aggregate is blocked (waiting for next_retry_at or still 'processing' by a dead owner).
+# Otherwise a retry would let later events of the aggregate overtake it.
+RESERVE_OWNED_SQL = """
+WITH picked AS (
+  SELECT o.id
+  FROM outbox_events o
+  WHERE o.published_at IS NULL
+    AND o.status = 'new'
+    AND (o.next_retry_at IS NULL OR o.next_retry_at <= now())
+    AND ((hashtext(o.aggregate_id::text) & 2147483647) % :buckets) = ANY(CAST(:owned AS int[]))
+    AND NOT EXISTS (
+      SELECT 1
+      FROM outbox_events e
+      WHERE e.aggregate_type = o.aggregate_type
+        AND e.aggregate_id = o.aggregate_id
+        AND e.published_at IS NULL
+        AND e.created_at < o.created_at
+        AND (e.status <> 'new' OR (e.next_retry_at IS NOT NULL AND e.next_retry_at > now()))
+    )
+  ORDER BY o.created_at ASC
+  FOR UPDATE SKIP LOCKED
+  LIMIT :limit
+)
+UPDATE outbox_events o
+SET status = 'processing',
+    locked_until = now() + (:lock_ttl_sec || ' seconds')::interval,
+    lock_owner = :owner
+FROM picked
+WHERE o.id = picked.id
+RETURNING
+  o.id,
+  o.event_type,
+  o.aggregate_type,
+  o.aggregate_id,
+  o.idempotency_key,
+  o.payload,
+  o.created_at,
+  o.publish_attempts,
+  o.last_error;
+"""
+
 MARK_SENT_SQL = """
 UPDATE outbox_events
 SET status='sent',
@@ -213,6 +377,97 @@ WHERE id=:id
 """
 
 
+# Set-based finalize (pipelined mode): one statement per outcome kind for the whole batch.
+MARK_SENT_MANY_SQL = """
+UPDATE outbox_events
+SET status='sent',
+    published_at=now(),
+    last_error=NULL,
+    locked_until=NULL,
+    lock_owner=NULL,
+    next_retry_at=NULL
+WHERE id = ANY(CAST(:ids AS uuid[]))
+  AND status='processing'
+  AND lock_owner=:owner;
+"""
+
+MARK_RETRY_MANY_SQL = """
+UPDATE outbox_events o
+SET status='new',
+    publish_attempts=o.publish_attempts+1,
+    last_error=u.err,
+    next_retry_at=now() + (u.delay_sec || ' seconds')::interval,
+    locked_until=NULL,
+    lock_owner=NULL
+FROM unnest(CAST(:ids AS uuid[]), CAST(:errs AS text[]), CAST(:delays AS int[])) AS u(id, err, delay_sec)
+WHERE o.id = u.id
+  AND o.status='processing'
+  AND o.lock_owner=:owner;
+"""
+
+MARK_DEAD_MANY_SQL = """
+UPDATE outbox_events o
+SET status='dead',
+    published_at=now(),
+    publish_attempts=o.publish_attempts+1,
+    last_error=u.err,
+    locked_until=NULL,
+    lock_owner=NULL,
+    next_retry_at=NULL
+FROM unnest(CAST(:ids AS uuid[]), CAST(:errs AS text[])) AS u(id, err)
+WHERE o.id = u.id
+  AND o.status='processing'
+  AND o.lock_owner=:owner;
+"""
+
+
+# Heartbeat: extend only rows that are still ours; a row missing from RETURNING was reclaimed.
+EXTEND_LEASE_SQL = """
+UPDATE outbox_events
+SET locked_until = now() + (:lock_ttl_sec || ' seconds')::interval
+WHERE id = ANY(CAST(:ids AS uuid[]))
+  AND status='processing'
+  AND lock_owner=:owner
+RETURNING id;
+"""
+
+
+# Rows held back unsent (an earlier row of their aggregate failed in the same batch): back to 'new',
+# not a failed attempt. RESERVE_OWNED_SQL keeps them out until that earlier row is published or dead.
+RELEASE_MANY_SQL = """
+UPDATE outbox_events
+SET status='new',
+    locked_until=NULL,
+    lock_owner=NULL
+WHERE id = ANY(CAST(:ids AS uuid[]))
+  AND status='processing'
+  AND lock_owner=:owner;
+"""
+
+
+# Graceful shutdown: everything this relay still holds goes back to 'new' in one statement
+# (not a failed attempt: publish_attempts/next_retry_at untouched).
+RELEASE_OWNED_SQL = """
+UPDATE outbox_events
+SET status='new',
+    locked_until=NULL,
+    lock_owner=NULL
+WHERE status='processing'
+  AND lock_owner=:owner;
+"""
+
+
+BACKLOG_AGE_SQL = """
+SELECT COALESCE(EXTRACT(EPOCH FROM now() - min(created_at)), 0)
+FROM outbox_events
+WHERE published_at IS NULL;
+"""
+
+
+def backlog_age_seconds(db) -> float:
+    return float(db.execute(sql_text(BACKLOG_AGE_SQL)).scalar_one() or 0.0)
+
+
 def reclaim_stuck_processing(db) -> int:
     res = db.execute(sql_text(RECLAIM_SQL))
     return getattr(res, "rowcount", 0) or 0
@@ -223,155 +478,950 @@ def reserve_batch(db, *, limit: int, lock_ttl_sec: int, owner: str):
         sql_text(RESERVE_SQL),
         {"limit": limit, "lock_ttl_sec": lock_ttl_sec, "owner": owner},
     ).mappings().all()
-    return rows
+    # RETURNING order is not guaranteed -> publish in created_at order
+    return sorted(rows, key=lambda r: r["created_at"])
+
+
+def reserve_owned_batch(db, *, limit: int, lock_ttl_sec: int, owner: str, buckets: int, owned: list[int]):
+    if not owned:
+        return []
+    rows = db.execute(
+        sql_text(RESERVE_OWNED_SQL),
+        {
+            "limit": limit,
+            "lock_ttl_sec": lock_ttl_sec,
+            "owner": owner,
+            "buckets": buckets,
+            "owned": owned,
+        },
+    ).mappings().all()
+    return sorted(rows, key=lambda r: r["created_at"])
+
+
+def extend_lease(db, *, event_ids: list[str], owner: str, lock_ttl_sec: int) -> set[str]:
+    if not event_ids:
+        return set()
+    rows = db.execute(
+        sql_text(EXTEND_LEASE_SQL),
+        {"ids": event_ids, "owner": owner, "lock_ttl_sec": lock_ttl_sec},
+    ).scalars().all()
+    return {str(r) for r in rows}
 
 
-def mark_sent(db, *, event_id: str, owner: str) -> None:
-    db.execute(sql_text(MARK_SENT_SQL), {"id": event_id, "owner": owner})
+def release_owned(db, *, owner: str) -> int:
+    res = db.execute(sql_text(RELEASE_OWNED_SQL), {"owner": owner})
+    return getattr(res, "rowcount", 0) or 0
+
+
+def mark_sent(db, *, event_id: str, owner: str) -> int:
+    res = db.execute(sql_text(MARK_SENT_SQL), {"id": event_id, "owner": owner})
+    return getattr(res, "rowcount", 0) or 0
 
 
-def mark_retry(db, *, event_id: str, owner: str, err: str, delay_sec: int) -> None:
-    db.execute(
+def mark_retry(db, *, event_id: str, owner: str, err: str, delay_sec: int) -> int:
+    res = db.execute(
         sql_text(MARK_RETRY_SQL),
         {"id": event_id, "owner": owner, "err": err[:4000], "delay_sec": delay_sec},
     )
+    return getattr(res, "rowcount", 0) or 0
 
 
-def mark_dead(db, *, event_id: str, owner: str, err: str) -> None:
-    db.execute(
+def mark_dead(db, *, event_id: str, owner: str, err: str) -> int:
+    res = db.execute(
         sql_text(MARK_DEAD_SQL),
         {"id": event_id, "owner": owner, "err": err[:4000]},
     )
+    return getattr(res, "rowcount", 0) or 0
+
+
+def release_many(db, *, event_ids: list[str], owner: str) -> int:
+    if not event_ids:
+        return 0
+    res = db.execute(sql_text(RELEASE_MANY_SQL), {"ids": event_ids, "owner": owner})
+    return getattr(res, "rowcount", 0) or 0
+
+
+def mark_sent_many(db, *, event_ids: list[str], owner: str) -> int:
+    if not event_ids:
+        return 0
+    res = db.execute(sql_text(MARK_SENT_MANY_SQL), {"ids": event_ids, "owner": owner})
+    return getattr(res, "rowcount", 0) or 0
+
+
+def mark_retry_many(db, *, items: list[tuple[str, str, int]], owner: str) -> int:
+    """items: (event_id, err, delay_sec)"""
+    if not items:
+        return 0
+    res = db.execute(
+        sql_text(MARK_RETRY_MANY_SQL),
+        {
+            "ids": [i[0] for i in items],
+            "errs": [i[1][:4000] for i in items],
+            "delays": [int(i[2]) for i in items],
+            "owner": owner,
+        },
+    )
+    return getattr(res, "rowcount", 0) or 0
+
+
+def mark_dead_many(db, *, items: list[tuple[str, str]], owner: str) -> int:
+    """items: (event_id, err)"""
+    if not items:
+        return 0
+    res = db.execute(
+        sql_text(MARK_DEAD_MANY_SQL),
+        {
+            "ids": [i[0] for i in items],
+            "errs": [i[1][:4000] for i in items],
+            "owner": owner,
+        },
+    )
+    return getattr(res, "rowcount", 0) or 0
 
 
 # ----------------------------
 # Publish
 # ----------------------------
-def build_producer() -> KafkaProducer:
-    return KafkaProducer(
-        bootstrap_servers=BOOTSTRAP,
-        key_serializer=lambda k: (k.encode("utf-8") if k else None),
-        value_serializer=lambda v: json.dumps(v, default=_json_default, ensure_ascii=False).encode("utf-8"),
-        acks="all",
-        retries=3,
-        linger_ms=10,
+def serialize_key(k):
+    return k.encode("utf-8") if k else None
+
+
+def serialize_value(v) -> bytes:
+    if isinstance(v, bytes):
+        return v  # already encoded (schema_version 2)
+    return json.dumps(v, default=_json_default, ensure_ascii=False).encode("utf-8")
+
+
+def pick_compression(name: str = COMPRESSION):
+    """auto -> best codec the installed client can actually use (zstd > lz4 > gzip)."""
+    if name in ("", "none"):
+        return None
+    if name != "auto":
+        return name
+    for codec_name, available in (
+        ("zstd", kafka_codec.has_zstd),
+        ("lz4", kafka_codec.has_lz4),
+        ("gzip", kafka_codec.has_gzip),
+    ):
+        if available():
+            return codec_name
+    return None
+
+
+def producer_config(profile: str = PRODUCER_PROFILE) -> dict:
+    cfg = {
+        "bootstrap_servers": BOOTSTRAP,
+        "key_serializer": serialize_key,
+        "value_serializer": serialize_value,
+        "acks": "all",
+    }
+
+    if profile == "legacy":
+        cfg.update(retries=3, linger_ms=10)
+        return cfg
+
+    cfg.update(
+        retries=PRODUCER_RETRIES,
+        # without idempotence a retried request may land after a later one -> only 1 in flight
+        max_in_flight_requests_per_connection=1,
+        compression_type=pick_compression(),
+        linger_ms=PRODUCER_LINGER_MS,
+        batch_size=PRODUCER_BATCH_BYTES,
     )
 
+    # kafka-python 2.0.x has no idempotent producer; newer clients do, and then up to 5
+    # in-flight requests keep per-partition order
+    if "enable_idempotence" in KafkaProducer.DEFAULT_CONFIG:
+        cfg.update(enable_idempotence=True, max_in_flight_requests_per_connection=5)
+
+    return cfg
+
 
-def send_sync(producer: KafkaProducer, topic: str, key: str, value: dict, timeout_sec: float):
-    fut = producer.send(topic, key=key, value=value)
+def build_producer() -> KafkaProducer:
+    return KafkaProducer(**producer_config())
+
+
+def send_sync(producer: KafkaProducer, topic: str, key: str, value, timeout_sec: float, *,
+              headers: list | None = None, timestamp_ms: int | None = None):
+    t0 = time.monotonic()
+    fut = producer.send(topic, key=key, value=value, headers=headers, timestamp_ms=timestamp_ms)
     fut.get(timeout=timeout_sec)
+    M_PUBLISH_LATENCY.observe(time.monotonic() - t0, topic=topic)
+
+
+def send_async(producer: KafkaProducer, topic: str, key: str, value, *,
+               headers: list | None = None, timestamp_ms: int | None = None):
+    """
+    Fire-and-collect: returns (future, None) or (None, exc).
+    producer.send() itself may raise (buffer full, metadata timeout) -> keep it as a failed outcome.
+    """
+    t0 = time.monotonic()
+    try:
+        fut = producer.send(topic, key=key, value=value, headers=headers, timestamp_ms=timestamp_ms)
+    except Exception as e:
+        return None, e
+    # ack time is taken in the producer's I/O thread, not when await_all() gets to this future
+    fut.add_callback(lambda _md: M_PUBLISH_LATENCY.observe(time.monotonic() - t0, topic=topic))
+    return fut, None
+
+
+def await_all(pending: list, timeout_sec: float) -> list:
+    """
+    Wait for every future under one shared deadline.
+    Returns exceptions in the same order (None = acked).
+    """
+    deadline = time.monotonic() + timeout_sec
+    out = []
+    for fut, exc in pending:
+        if exc is not None:
+            out.append(exc)
+            continue
+        try:
+            fut.get(timeout=max(0.0, deadline - time.monotonic()))
+            out.append(None)
+        except Exception as e:
+            out.append(e)
+    return out
+
+
+def _envelope_ok(msg: dict) -> bool:
+    return bool(msg.get("event_id") and msg.get("type") and msg.get("aggregate", {}).get("id"))
+
+
+def _dlq_message(msg: dict, attempt: int, err: str) -> dict:
+    dlq_msg = dict(msg)
+    dlq_msg["dlq"] = {"failed_at": _utc_now_iso(), "attempts": attempt, "error": err}
+    return dlq_msg
+
+
+# ----------------------------
+# LISTEN/NOTIFY
+# ----------------------------
+def _libpq_dsn() -> str:
+    # DATABASE_URL may carry a SQLAlchemy driver suffix (postgresql+psycopg2://)
+    return engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class OutboxListener:
+    """
+    Dedicated autocommit psycopg2 connection that LISTENs on NOTIFY_CHANNEL.
+    Never raises from wait(): on any connection problem it degrades to a plain sleep
+    and reconnects on the next call.
+    """
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.conn = None
+
+    def _connect(self):
+        conn = psycopg2.connect(_libpq_dsn())
+        conn.set_session(autocommit=True)
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.channel}"')
+        self.conn = conn
+
+    def start(self) -> None:
+        # LISTEN before the first reserve: a notify sent in between is queued, not lost
+        try:
+            self._connect()
+        except Exception as e:
+            print(f"[relay] WARN: listen failed ({type(e).__name__}: {e}), fallback to polling")
+            self.close()
+
+    def wait(self, timeout_sec: float) -> bool:
+        """Block until a notify arrives or timeout. Returns True if woken by NOTIFY."""
+        try:
+            if self.conn is None or self.conn.closed:
+                self._connect()
+
+            if not self.conn.notifies:
+                ready, _, _ = select.select([self.conn], [], [], timeout_sec)
+                if not ready:
+                    return False
+                self.conn.poll()
+
+            woke = bool(self.conn.notifies)
+            self.conn.notifies.clear()  # several inserts -> one wake-up
+            return woke
+
+        except Exception as e:
+            print(f"[relay] WARN: listen failed ({type(e).__name__}: {e}), fallback to polling")
+            self.close()
+            time.sleep(min(timeout_sec, IDLE_SLEEP))
+            return False
+
+    def close(self):
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+
+
+# ----------------------------
+# Bucket ownership (scale-out with per-aggregate ordering)
+# ----------------------------
+class BucketOwnership:
+    """
+    Each relay holds session advisory locks (LOCK_NAMESPACE, bucket) on a dedicated connection.
+    Membership = shared lock (LOCK_NAMESPACE + 1, 0); live relays are counted from pg_locks.
+    Both disappear with the session, so a crashed relay frees its buckets automatically.
+
+    Rebalance runs only between batches (nothing of ours is in flight), so a bucket never has
+    two publishers at the same time. Target share = ceil(buckets / live_relays).
+    """
+
+    def __init__(self, buckets: int, owner: str):
+        self.buckets = buckets
+        self.owner = owner
+        self.conn = None
+        self.owned: list[int] = []
+        self._next_rebalance = 0.0
+        # start probing from an owner-specific offset so relays don't fight over bucket 0..k
+        self._offset = sum(owner.encode("utf-8")) % buckets
+
+    def _connect(self):
+        conn = engine.connect()
+        with conn.begin():
+            conn.execute(sql_text("SELECT pg_advisory_lock_shared(:ns, 0)"), {"ns": LOCK_NAMESPACE + 1})
+        self.conn = conn
+        self.owned = []
+
+    def close(self):
+        # invalidate (not return to pool): pooled connection must not keep our session locks
+        try:
+            if self.conn is not None:
+                self.conn.invalidate()
+                self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+        self.owned = []
+
+    def _live_relays(self) -> int:
+        n = self.conn.execute(sql_text("""
+            SELECT count(*)
+            FROM pg_locks
+            WHERE locktype = 'advisory'
+              AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+              AND classid = :ns
+              AND objid = 0
+              AND mode = 'ShareLock'
+              AND granted
+        """), {"ns": LOCK_NAMESPACE + 1}).scalar_one()
+        return max(1, int(n))
+
+    def rebalance(self) -> None:
+        if self.conn is None:
+            self._connect()
+
+        with self.conn.begin():
+            relays = self._live_relays()
+            target = -(-self.buckets // relays)  # ceil
+
+            while len(self.owned) > target:
+                b = self.owned.pop()
+                self.conn.execute(sql_text("SELECT pg_advisory_unlock(:ns, :b)"), {"ns": LOCK_NAMESPACE, "b": b})
+
+            if len(self.owned) < target:
+                for i in range(self.buckets):
+                    b = (self._offset + i) % self.buckets
+                    if b in self.owned:
+                        continue
+                    got = self.conn.execute(
+                        sql_text("SELECT pg_try_advisory_lock(:ns, :b)"),
+                        {"ns": LOCK_NAMESPACE, "b": b},
+                    ).scalar_one()
+                    if got:
+                        self.owned.append(b)
+                        if len(self.owned) >= target:
+                            break
+
+        self.owned.sort()
+
+    def reserve(self, *, limit: int, lock_ttl_sec: int) -> list:
+        """
+        Reserve on the lock-holding connection itself: if that session is gone,
+        our bucket locks are gone too and the reserve fails instead of stealing rows.
+        """
+        try:
+            now = time.monotonic()
+            if self.conn is None or now >= self._next_rebalance:
+                before = list(self.owned)
+                self.rebalance()
+                self._next_rebalance = now + REBALANCE_SEC
+                if self.owned != before:
+                    print(f"[relay] buckets owned={len(self.owned)}/{self.buckets}")
+
+            with self.conn.begin():
+                return reserve_owned_batch(
+                    self.conn,
+                    limit=limit,
+                    lock_ttl_sec=lock_ttl_sec,
+                    owner=self.owner,
+                    buckets=self.buckets,
+                    owned=self.owned,
+                )
+
+        except Exception as e:
+            print(f"[relay] WARN: ownership connection lost ({type(e).__name__}: {e}), buckets released")
+            self.close()
+            return []
+
+
+# ----------------------------
+# Lease heartbeat
+# ----------------------------
+class LeaseHeartbeat:
+    """
+    Background thread that extends locked_until of the rows currently in flight.
+
+    track(ids) before publishing, release(ids) right BEFORE finalizing (returns the ids whose
+    lease was lost). Releasing before the finalize transaction matters: a heartbeat that races
+    with finalize then never reports our own freshly finalized rows as lost.
+
+    A lost row is not sent again and not finalized by us: another relay reclaimed it and owns
+    its outcome now (the finalize UPDATEs are keyed on lock_owner anyway).
+    """
+
+    def __init__(self, owner: str, *, lock_ttl_sec: int, every_sec: float):
+        self.owner = owner
+        self.lock_ttl_sec = lock_ttl_sec
+        self.every_sec = every_sec
+        self._lock = threading.Lock()
+        self._tracked: set[str] = set()
+        self._lost: set[str] = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="outbox-lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.every_sec + 1)
+
+    def track(self, event_ids: list[str]) -> None:
+        with self._lock:
+            self._tracked.update(event_ids)
+
+    def is_lost(self, event_id: str) -> bool:
+        with self._lock:
+            return event_id in self._lost
+
+    def release(self, event_ids: list[str]) -> set[str]:
+        with self._lock:
+            ids = set(event_ids)
+            self._tracked -= ids
+            lost = self._lost & ids
+            self._lost -= ids
+        if lost:
+            M_LEASE_LOST.inc(len(lost))
+        return lost
+
+    def beat(self) -> None:
+        with self._lock:
+            ids = list(self._tracked - self._lost)
+        if not ids:
+            return
+        with _db_timer("heartbeat"), SessionLocal() as db:
+            with db.begin():
+                kept = extend_lease(db, event_ids=ids, owner=self.owner, lock_ttl_sec=self.lock_ttl_sec)
+        with self._lock:
+            # only rows still tracked: released ones may be finalized already
+            lost = (set(ids) - kept) & self._tracked
+            self._lost |= lost
+        if lost:
+            print(f"[relay] WARN: lease lost for {len(lost)} in-flight rows, they will not be finalized")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.every_sec):
+            try:
+                self.beat()
+            except Exception as e:
+                # next beat retries; if the DB stays away the leases simply expire
+                print(f"[relay] WARN: lease heartbeat failed ({type(e).__name__}: {e})")
+
+
+# ----------------------------
+# Batch processing
+# ----------------------------
+_OUTCOME_LABEL = {"sent": "published", "retry": "retried", "dead": "dead"}
+
+
+def send_outcomes(keys: list, errors: list, *, ordered: bool) -> list[str]:
+    """
+    "sent" / "failed" / "blocked" per send, in batch order (`errors[i]` is None when send i was acked).
+    ordered: after the first failed send of a key, its later failed sends are "blocked" (released unsent,
+    no attempt counted: they only failed behind it). A later send that was acked is in Kafka and stays "sent".
+    """
+    out: list[str] = []
+    failed: set = set()
+    for key, exc in zip(keys, errors):
+        if exc is None:
+            out.append("sent")
+        elif ordered and key in failed:
+            out.append("blocked")
+        else:
+            failed.add(key)
+            out.append("failed")
+    return out
+
+
+def publish_batch_sync(producer: KafkaProducer, batch, lease: LeaseHeartbeat = None,
+                       ordered: bool = OWNERSHIP_BUCKETS > 0) -> dict:
+    """
+    Legacy path: one blocking send + one finalize transaction per event.
+    Dead letters are the exception: they are sent as they come up and awaited together at the end
+    of the batch (one wait instead of one per event), then finalized like the rest.
+
+    ordered (ownership mode): once a send of an aggregate fails, its later rows in the batch are not sent
+    but released (they would overtake the failed one in Kafka).
+    """
+    stats = {"sent": 0, "retry": 0, "dead": 0, "lost": 0, "blocked": 0}
+    failed_keys: set[str] = set()
+    blocked: list[str] = []
+    to_dlq = []  # (row, attempt_next, err, (future, exc))
+
+    def finalize(row, outcome: str, err: str | None, attempt_next: int) -> None:
+        event_id = str(row["id"])
+        # lease lost during the send: the row belongs to whoever reclaimed it, leave its state alone
+        if lease is not None and lease.release([event_id]):
+            stats["lost"] += 1
+            return
+
+        with _db_timer("finalize"), SessionLocal() as db:
+            with db.begin():
+                if outcome == "sent":
+                    n = mark_sent(db, event_id=event_id, owner=OWNER)
+                elif outcome == "retry":
+                    n = mark_retry(db, event_id=event_id, owner=OWNER, err=err, delay_sec=backoff_seconds(attempt_next))
+                else:
+                    n = mark_dead(db, event_id=event_id, owner=OWNER, err=err)
+        if not n:
+            # taken over between the last heartbeat and now; the lock_owner guard kept the row intact
+            stats["lost"] += 1
+            M_LEASE_LOST.inc()
+            return
+        stats[outcome] += 1
+        M_EVENTS.inc(event_type=row["event_type"], outcome=_OUTCOME_LABEL[outcome])
+
+    for row in batch:
+        event_id = str(row["id"])
+        attempts_done = int(row.get("publish_attempts") or 0)
+        attempt_next = attempts_done + 1
+
+        # reclaimed by another relay while earlier rows of this batch were sending -> not ours anymore
+        if lease is not None and lease.is_lost(event_id):
+            lease.release([event_id])
+            stats["lost"] += 1
+            continue
+
+        msg = _mk_message(row)
+        key = str(row["aggregate_id"])  # IMPORTANT: keep per-aggregate ordering
+
+        # hard validation -> permanent failure -> DLQ immediately
+        if not _envelope_ok(msg):
+            err = f"PermanentError: invalid envelope for outbox id={event_id}"
+            dlq_msg = _dlq_message(msg, attempt_next, err)
+            to_dlq.append((row, attempt_next, err, send_async(producer, DLQ_TOPIC, key, dlq_msg)))
+            continue
+
+        if key in failed_keys:
+            blocked.append(event_id)
+            continue
+
+        # normal publish path
+        try:
+            value, headers, ts = wire_message(msg)
+            send_sync(producer, TOPIC, key, value, PUBLISH_TIMEOUT_SEC, headers=headers, timestamp_ms=ts)
+
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+            if ordered:
+                failed_keys.add(key)
+
+            # if attempts threshold reached -> DLQ (awaited with the other dead letters below)
+            if attempt_next >= MAX_ATTEMPTS:
+                dlq_msg = _dlq_message(msg, attempt_next, err)
+                to_dlq.append((row, attempt_next, err, send_async(producer, DLQ_TOPIC, key, dlq_msg)))
+                continue
+            # retry main publish
+            outcome = "retry"
+
+        else:
+            outcome, err = "sent", None
+
+        finalize(row, outcome, err, attempt_next)
+
+    if to_dlq:
+        for (row, attempt_next, err, _), exc in zip(to_dlq, await_all([d[3] for d in to_dlq], PUBLISH_TIMEOUT_SEC)):
+            if exc is None:
+                finalize(row, "dead", f"DLQ: {err}", attempt_next)
+            else:
+                # DLQ failed => MUST retry (otherwise event freezes forever)
+                finalize(row, "retry", f"DLQ failed: {type(exc).__name__}: {exc}; original: {err}", attempt_next)
+
+    if lease is not None:
+        lost = lease.release(blocked)
+        stats["lost"] += len(lost)
+        blocked = [i for i in blocked if i not in lost]
+    if blocked:
+        with _db_timer("finalize"), SessionLocal() as db:
+            with db.begin():
+                stats["blocked"] = release_many(db, event_ids=blocked, owner=OWNER)
+
+    return stats
+
+
+def publish_batch_pipelined(producer: KafkaProducer, batch, lease: LeaseHeartbeat = None,
+                            ordered: bool = OWNERSHIP_BUCKETS > 0) -> dict:
+    """
+    Send the whole reserved batch, then wait for all acks, then finalize every row
+    with set-based UPDATEs in ONE transaction.
+
+    Delivery guarantees are the same as in sync mode: a row becomes 'sent' only after its ack,
+    and if finalize fails the rows stay 'processing' and get reclaimed after LOCK_TTL_SEC (at-least-once).
+    Rows whose lease was lost mid-flight (see LeaseHeartbeat) skip the DLQ send and the finalize.
+
+    ordered (ownership mode): an aggregate's rows still go out back to back; the producer keeps them in
+    order within the partition (one request in flight, or idempotence). Once one of them fails, the later
+    failed ones are released without an attempt (send_outcomes()) and go out after it on its retry.
+    """
+    t_start = time.monotonic()
+    sent: list[str] = []
+    retry: list[tuple[str, str, int]] = []
+    dead: list[tuple[str, str]] = []
+    blocked: list[str] = []
+    to_dlq: list[tuple[str, int, str, dict, str]] = []  # (event_id, attempt, key, msg, err)
+
+    # 1) validate; invalid envelopes go to the DLQ and never block their aggregate
+    main_rows = []
+    for row in batch:
+        event_id = str(row["id"])
+        attempt_next = int(row.get("publish_attempts") or 0) + 1
+
+        msg = _mk_message(row)
+        key = str(row["aggregate_id"])  # IMPORTANT: keep per-aggregate ordering
+
+        if not _envelope_ok(msg):
+            to_dlq.append((event_id, attempt_next, key, msg, f"PermanentError: invalid envelope for outbox id={event_id}"))
+            continue
+
+        main_rows.append((event_id, attempt_next, key, msg))
+
+    # 2) fire all main sends, then collect acks
+    pending = []
+    for _, _, key, msg in main_rows:
+        value, headers, ts = wire_message(msg)
+        pending.append(send_async(producer, TOPIC, key, value, headers=headers, timestamp_ms=ts))
+    errors = await_all(pending, PUBLISH_TIMEOUT_SEC)
+    outcomes = send_outcomes([r[2] for r in main_rows], errors, ordered=ordered)
+
+    for (event_id, attempt_next, key, msg), exc, outcome in zip(main_rows, errors, outcomes):
+        if outcome == "sent":
+            sent.append(event_id)
+            continue
+        if outcome == "blocked":
+            blocked.append(event_id)
+            continue
+
+        err = f"{type(exc).__name__}: {exc}"
+        if attempt_next >= MAX_ATTEMPTS:
+            to_dlq.append((event_id, attempt_next, key, msg, err))
+        else:
+            retry.append((event_id, err, backoff_seconds(attempt_next)))
+
+    # 3) DLQ path (invalid envelopes + exhausted attempts), also pipelined
+    if lease is not None:
+        to_dlq = [d for d in to_dlq if not lease.is_lost(d[0])]
+    if to_dlq:
+        dlq_pending = [
+            send_async(producer, DLQ_TOPIC, key, _dlq_message(msg, attempt_next, err))
+            for (_, attempt_next, key, msg, err) in to_dlq
+        ]
+        for (event_id, attempt_next, _, _, err), exc in zip(to_dlq, await_all(dlq_pending, PUBLISH_TIMEOUT_SEC)):
+            if exc is None:
+                dead.append((event_id, f"DLQ: {err}"))
+            else:
+                # DLQ failed => MUST retry (otherwise event freezes forever)
+                retry.append((
+                    event_id,
+                    f"DLQ failed: {type(exc).__name__}: {exc}; original: {err}",
+                    backoff_seconds(attempt_next),
+                ))
+
+    # 4) finalize everything in one transaction (only rows we still hold)
+    lost: set[str] = set()
+    if lease is not None:
+        lost = lease.release([str(r["id"]) for r in batch])
+        if lost:
+            sent = [i for i in sent if i not in lost]
+            retry = [r for r in retry if r[0] not in lost]
+            dead = [d for d in dead if d[0] not in lost]
+            blocked = [i for i in blocked if i not in lost]
+
+    t_finalize = time.monotonic()
+    with _db_timer("finalize"), SessionLocal() as db:
+        with db.begin():
+            n_sent = mark_sent_many(db, event_ids=sent, owner=OWNER)
+            n_retry = mark_retry_many(db, items=retry, owner=OWNER)
+            n_dead = mark_dead_many(db, items=dead, owner=OWNER)
+            n_blocked = release_many(db, event_ids=blocked, owner=OWNER)
+
+    # taken over after the last heartbeat: the lock_owner guard skipped them
+    late_lost = max(0, len(sent) + len(retry) + len(dead) + len(blocked) - (n_sent + n_retry + n_dead + n_blocked))
+    if late_lost:
+        M_LEASE_LOST.inc(late_lost)
+
+    types = {str(r["id"]): r["event_type"] for r in batch}
+    for event_id in sent:
+        M_EVENTS.inc(event_type=types[event_id], outcome="published")
+    for event_id, *_ in retry:
+        M_EVENTS.inc(event_type=types[event_id], outcome="retried")
+    for event_id, *_ in dead:
+        M_EVENTS.inc(event_type=types[event_id], outcome="dead")
+
+    return {
+        "sent": n_sent,
+        "retry": n_retry,
+        "dead": n_dead,
+        "lost": len(lost) + late_lost,
+        "blocked": n_blocked,
+        "publish_sec": t_finalize - t_start,
+        "finalize_sec": time.monotonic() - t_finalize,
+    }
+
+
+# ----------------------------
+# Adaptive batch size / poll cadence
+# ----------------------------
+class AdaptiveController:
+    """
+    AIMD-style controller, driven by what the loop already observes (no extra queries):
+
+    - backlog age = now - created_at of the oldest reserved row (reserve picks oldest first);
+    - full batch and backlog older than TARGET_LAG_SEC -> batch x2, while a cycle
+      (publish + finalize) stays under the target;
+    - cycle over the target -> batch /2 (Kafka or DB is the bottleneck, keep lock hold time short);
+    - half-empty batch -> slow decay towards BATCH_MIN;
+    - idle -> poll interval x2 up to poll_max; any rows -> back to poll_min.
+    """
+
+    def __init__(self, *, enabled: bool, batch_size: int, batch_min: int, batch_max: int,
+                 poll_min: float, poll_max: float, target_cycle_sec: float, target_lag_sec: float):
+        self.enabled = enabled
+        self.batch_min = max(1, min(batch_min, batch_size))
+        self.batch_max = max(batch_max, batch_size)
+        self.poll_min = poll_min
+        self.poll_max = max(poll_max, poll_min)
+        # a cycle must stay well below the lock TTL: keeps lock hold time short, and without
+        # the heartbeat (OUTBOX_HEARTBEAT_SEC=0) rows would get reclaimed mid-flight
+        self.target_cycle_sec = min(target_cycle_sec, LOCK_TTL_SEC / 3)
+        self.target_lag_sec = target_lag_sec
+
+        self.batch_size = batch_size
+        self.poll_sec = poll_min
+
+        self.backlog_age_sec = 0.0
+        self.cycle_sec = 0.0
+        self.finalize_sec = 0.0
+        self._last_report = 0.0
+        self._reported = None
+
+    def on_batch(self, *, n: int, backlog_age_sec: float, cycle_sec: float, finalize_sec: float) -> None:
+        self.backlog_age_sec = backlog_age_sec
+        self.cycle_sec = cycle_sec
+        self.finalize_sec = finalize_sec
+        if not self.enabled:
+            return
+
+        self.poll_sec = self.poll_min
+
+        if cycle_sec > self.target_cycle_sec:
+            self.batch_size = max(self.batch_min, self.batch_size // 2)
+        elif n >= self.batch_size and backlog_age_sec > self.target_lag_sec:
+            self.batch_size = min(self.batch_max, self.batch_size * 2)
+        elif n < self.batch_size // 2:
+            self.batch_size = max(self.batch_min, self.batch_size - max(1, self.batch_size // 4))
+
+    def on_idle(self) -> None:
+        self.backlog_age_sec = 0.0
+        if self.enabled:
+            self.poll_sec = min(self.poll_max, self.poll_sec * 2)
+
+    def snapshot(self) -> dict:
+        return {
+            "batch_size": self.batch_size,
+            "poll_sec": round(self.poll_sec, 3),
+            "backlog_age_sec": round(self.backlog_age_sec, 3),
+            "cycle_sec": round(self.cycle_sec, 3),
+            "finalize_sec": round(self.finalize_sec, 3),
+        }
+
+    def report(self) -> None:
+        """Publish current values as gauges; log them when batch/poll changed (at most every 5s)."""
+        for k, v in self.snapshot().items():
+            M_ADAPTIVE.set(v, param=k)
+
+        now = time.monotonic()
+        current = (self.batch_size, round(self.poll_sec, 3))
+        if current == self._reported or now - self._last_report < 5:
+            return
+        self._reported = current
+        self._last_report = now
+        print("[relay] adaptive " + " ".join(f"{k}={v}" for k, v in self.snapshot().items()))
 
 
 # ----------------------------
 # Main loop
 # ----------------------------
+def _shutdown(producer, lease, ownership, listener) -> None:
+    """Drain budget left after the batch: flush/close the producer, then release our rows in one UPDATE."""
+    if lease is not None:
+        lease.stop()
+
+    left = DRAIN_TIMEOUT_SEC if _DRAIN_DEADLINE is None else _DRAIN_DEADLINE - time.monotonic()
+    try:
+        # whatever was sent but not finalized is released below and published again (at-least-once)
+        producer.close(timeout=max(0.5, left))
+    except Exception:
+        pass
+
+    try:
+        with _db_timer("release"), SessionLocal() as db:
+            with db.begin():
+                released = release_owned(db, owner=OWNER)
+        if released:
+            print(f"[relay] released={released} processing rows back to new")
+    except Exception as e:
+        print(f"[relay] WARN: release failed ({type(e).__name__}: {e}), rows wait for lock_ttl={LOCK_TTL_SEC}s")
+
+    # bucket locks go last: until the rows are released nobody else could publish them in order anyway
+    if ownership is not None:
+        ownership.close()
+    if listener is not None:
+        listener.close()
+
+
 def main():
+    global _IN_BATCH
+    signal.signal(signal.SIGINT, _on_signal)
+    signal.signal(signal.SIGTERM, _on_signal)
+
     producer = build_producer()
+    publish_batch = publish_batch_sync if PUBLISH_MODE == "sync" else publish_batch_pipelined
+    listener = OutboxListener(NOTIFY_CHANNEL) if LISTEN_ENABLED else None
+    if listener is not None:
+        listener.start()
+    ownership = BucketOwnership(OWNERSHIP_BUCKETS, OWNER) if OWNERSHIP_BUCKETS > 0 else None
+    lease = LeaseHeartbeat(OWNER, lock_ttl_sec=LOCK_TTL_SEC, every_sec=HEARTBEAT_SEC) if HEARTBEAT_SEC > 0 else None
+    if lease is not None:
+        if HEARTBEAT_SEC * 2 > LOCK_TTL_SEC:
+            print(f"[relay] WARN: heartbeat={HEARTBEAT_SEC}s is too slow for lock_ttl={LOCK_TTL_SEC}s, "
+                  f"leases may expire between beats")
+        lease.start()
+    # with LISTEN the idle wait is only a fallback, without it this is the polling interval
+    idle_wait = LISTEN_FALLBACK_SEC if listener is not None else IDLE_SLEEP
+    controller = AdaptiveController(
+        enabled=ADAPTIVE,
+        batch_size=BATCH_SIZE,
+        batch_min=BATCH_MIN,
+        batch_max=BATCH_MAX,
+        # with LISTEN the idle cadence is the listener's (notify wakes it, LISTEN_FALLBACK_SEC is the safety net):
+        # the adaptive poll interval only drives plain polling
+        poll_min=IDLE_SLEEP if ADAPTIVE and listener is None else idle_wait,
+        poll_max=POLL_MAX_SEC if ADAPTIVE and listener is None else idle_wait,
+        target_cycle_sec=TARGET_CYCLE_SEC,
+        target_lag_sec=TARGET_LAG_SEC,
+    )
     print(f"[relay] owner={OWNER} bootstrap={BOOTSTRAP} topic={TOPIC} dlq={DLQ_TOPIC} "
-          f"batch={BATCH_SIZE} max_attempts={MAX_ATTEMPTS} lock_ttl={LOCK_TTL_SEC}s")
+          f"batch={BATCH_SIZE} max_attempts={MAX_ATTEMPTS} lock_ttl={LOCK_TTL_SEC}s "
+          f"heartbeat={f'{HEARTBEAT_SEC}s' if lease else 'off'} mode={PUBLISH_MODE} "
+          f"listen={NOTIFY_CHANNEL if listener else 'off'} buckets={OWNERSHIP_BUCKETS or 'off'} "
+          f"adaptive={'on' if ADAPTIVE else 'off'} producer={PRODUCER_PROFILE} schema_version={SCHEMA_VERSION} "
+          f"compression={producer_config().get('compression_type') or 'none'}")
+
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        print(f"[relay] metrics on :{METRICS_PORT}/metrics")
+
+    next_reclaim = 0.0
+    next_backlog_probe = 0.0
 
     try:
-        while True:
-            # 1) reclaim expired processing locks
-            with SessionLocal() as db:
-                with db.begin():
-                    reclaimed = reclaim_stuck_processing(db)
-            if reclaimed:
-                print(f"[relay] reclaimed={reclaimed}")
+        while not STOP:
+            # 1) reclaim expired processing locks (locks live LOCK_TTL_SEC, no need to check every loop)
+            if time.monotonic() >= next_reclaim:
+                with _db_timer("reclaim"), SessionLocal() as db:
+                    with db.begin():
+                        reclaimed = reclaim_stuck_processing(db)
+                next_reclaim = time.monotonic() + min(RECLAIM_EVERY_SEC, LOCK_TTL_SEC / 2)
+                if reclaimed:
+                    M_RECLAIMED.inc(reclaimed)
+                    print(f"[relay] reclaimed={reclaimed}")
+
+            # backlog age for /metrics (cheap: ix_outbox_events_unpublished), only with the endpoint on
+            if METRICS_PORT and time.monotonic() >= next_backlog_probe:
+                with _db_timer("backlog_probe"), SessionLocal() as db:
+                    M_BACKLOG_AGE.set(backlog_age_seconds(db))
+                next_backlog_probe = time.monotonic() + BACKLOG_PROBE_SEC
 
             # 2) reserve batch (transaction)
-            with SessionLocal() as db:
-                with db.begin():
-                    batch = reserve_batch(db, limit=BATCH_SIZE, lock_ttl_sec=LOCK_TTL_SEC, owner=OWNER)
+            limit = controller.batch_size
+            with _db_timer("reserve"):
+                if ownership is not None:
+                    batch = ownership.reserve(limit=limit, lock_ttl_sec=LOCK_TTL_SEC)
+                else:
+                    with SessionLocal() as db:
+                        with db.begin():
+                            batch = reserve_batch(db, limit=limit, lock_ttl_sec=LOCK_TTL_SEC, owner=OWNER)
 
             if not batch:
-                time.sleep(IDLE_SLEEP)
+                controller.on_idle()
+                controller.report()
+                if listener is not None:
+                    listener.wait(controller.poll_sec)
+                else:
+                    time.sleep(controller.poll_sec)
                 continue
 
-            # 3) publish each event + finalize
-            for row in batch:
-                event_id = str(row["id"])
-                attempts_done = int(row.get("publish_attempts") or 0)
-                attempt_next = attempts_done + 1
-
-                msg = _mk_message(row)
-                key = str(row["aggregate_id"])  # IMPORTANT: keep per-aggregate ordering
-
-                # hard validation -> permanent failure -> DLQ immediately
-                if not msg.get("event_id") or not msg.get("type") or not msg.get("aggregate", {}).get("id"):
-                    err = f"PermanentError: invalid envelope for outbox id={event_id}"
-                    dlq_msg = dict(msg)
-                    dlq_msg["dlq"] = {"failed_at": _utc_now_iso(), "attempts": attempt_next, "error": err}
-
-                    try:
-                        send_sync(producer, DLQ_TOPIC, key, dlq_msg, PUBLISH_TIMEOUT_SEC)
-                    except Exception as e2:
-                        # DLQ failed => retry later (do NOT deadlock the event)
-                        delay = backoff_seconds(attempt_next)
-                        with SessionLocal() as db:
-                            with db.begin():
-                                mark_retry(db, event_id=event_id, owner=OWNER,
-                                           err=f"DLQ failed: {type(e2).__name__}: {e2}; original: {err}",
-                                           delay_sec=delay)
-                    else:
-                        with SessionLocal() as db:
-                            with db.begin():
-                                mark_dead(db, event_id=event_id, owner=OWNER, err=f"DLQ: {err}")
-                    continue
-
-                # normal publish path
-                try:
-                    send_sync(producer, TOPIC, key, msg, PUBLISH_TIMEOUT_SEC)
-
-                except Exception as e:
-                    err = f"{type(e).__name__}: {e}"
-
-                    # if attempts threshold reached -> try DLQ
-                    if attempt_next >= MAX_ATTEMPTS:
-                        dlq_msg = dict(msg)
-                        dlq_msg["dlq"] = {"failed_at": _utc_now_iso(), "attempts": attempt_next, "error": err}
-
-                        try:
-                            send_sync(producer, DLQ_TOPIC, key, dlq_msg, PUBLISH_TIMEOUT_SEC)
-                        except Exception as e2:
-                            # DLQ failed => MUST retry (otherwise event freezes forever)
-                            delay = backoff_seconds(attempt_next)
-                            with SessionLocal() as db:
-                                with db.begin():
-                                    mark_retry(
-                                        db,
-                                        event_id=event_id,
-                                        owner=OWNER,
-                                        err=f"DLQ failed: {type(e2).__name__}: {e2}; original: {err}",
-                                        delay_sec=delay,
-                                    )
-                        else:
-                            with SessionLocal() as db:
-                                with db.begin():
-                                    mark_dead(db, event_id=event_id, owner=OWNER, err=f"DLQ: {err}")
-                    else:
-                        # retry main publish
-                        delay = backoff_seconds(attempt_next)
-                        with SessionLocal() as db:
-                            with db.begin():
-                                mark_retry(db, event_id=event_id, owner=OWNER, err=err, delay_sec=delay)
-
-                else:
-                    # success
-                    with SessionLocal() as db:
-                        with db.begin():
-                            mark_sent(db, event_id=event_id, owner=OWNER)
+            M_BATCH_SIZE.observe(len(batch))
+            oldest = batch[0].get("created_at")
+            backlog_age = (datetime.now(timezone.utc) - oldest).total_seconds() if oldest else 0.0
+
+            # 3) publish + finalize
+            t0 = time.monotonic()
+            batch_ids = [str(r["id"]) for r in batch]
+            if lease is not None:
+                lease.track(batch_ids)
+            _IN_BATCH = True
+            try:
+                stats = publish_batch(producer, batch, lease)
+            finally:
+                _IN_BATCH = False
+                if _DRAIN_TIMER is not None:
+                    _DRAIN_TIMER.cancel()  # batch done within the drain budget
+                if lease is not None:
+                    lease.release(batch_ids)  # no-op on the normal path; never keep extending after an error
+
+            controller.on_batch(
+                n=len(batch),
+                backlog_age_sec=max(0.0, backlog_age),
+                cycle_sec=time.monotonic() - t0,
+                finalize_sec=stats.get("finalize_sec", 0.0),
+            )
+            controller.report()
 
     except KeyboardInterrupt:
-        print("[relay] stopping...")
+        pass
 
     finally:
-        try:
-            producer.flush(5)
-            producer.close()
-        except Exception:
-            pass
+        print("[relay] stopping...", flush=True)
+        _shutdown(producer, lease, ownership, listener)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import text as sql_text
+from sqlalchemy.exc import OperationalError
+
+load_dotenv()
+
+# ----------------------------
+# Config
+# ----------------------------
+DATABASE_URL = os.getenv("DATABASE_URL")
+if not DATABASE_URL:
+    raise RuntimeError("DATABASE_URL is missing")
+
+RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))            # keep sent/dead partitions this long
+IDEM_HORIZON_DAYS = int(os.getenv("OUTBOX_IDEM_HORIZON_DAYS", "30"))     # emit_event() dedup window
+PREMAKE_DAYS = int(os.getenv("OUTBOX_PARTITION_PREMAKE_DAYS", "7"))
+ARCHIVE = os.getenv("OUTBOX_RETENTION_ARCHIVE", "0").strip().lower() in ("1", "true", "yes", "on")
+EVERY_SEC = float(os.getenv("OUTBOX_RETENTION_EVERY_SEC", "3600"))
+IDEM_DELETE_BATCH = int(os.getenv("OUTBOX_IDEM_DELETE_BATCH", "10000"))
+CONSUMED_HORIZON_DAYS = int(os.getenv("CONSUMED_EVENTS_HORIZON_DAYS", "14"))  # consumer dedup by event_id
+# DETACH takes ACCESS EXCLUSIVE on the parent (CONCURRENTLY is not allowed while a *_default partition exists):
+# give up after this long instead of queueing every insert behind us, the next run tries again
+LOCK_TIMEOUT = os.getenv("OUTBOX_RETENTION_LOCK_TIMEOUT", "2s")
+
+engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+
+PARTITION_RE = re.compile(r"^(outbox_events|consumed_events)_p(\d{8})$")
+
+
+# ----------------------------
+# SQL
+# ----------------------------
+LIST_PARTITIONS_SQL = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = CAST(:parent AS regclass)
+ORDER BY c.relname;
+"""
+
+DELETE_IDEM_SQL = """
+DELETE FROM outbox_idempotency_keys
+WHERE ctid IN (
+  SELECT ctid
+  FROM outbox_idempotency_keys
+  WHERE created_at < now() - (:days || ' days')::interval
+  LIMIT :limit
+);
+"""
+
+
+def _utc_today():
+    return datetime.now(timezone.utc).date()
+
+
+def ensure_partitions(db, *, days_ahead: int, table: str = "outbox_events") -> list[str]:
+    names = []
+    today = _utc_today()
+    for i in range(days_ahead + 1):
+        day = today + timedelta(days=i)
+        names.append(db.execute(
+            sql_text(f"SELECT {table}_ensure_partition(CAST(:day AS date))"),
+            {"day": day.isoformat()},
+        ).scalar_one())
+    return names
+
+
+def expired_partitions(db, *, retention_days: int, table: str = "outbox_events") -> list[str]:
+    """Daily partitions whose whole range [day, day+1) is older than the retention window."""
+    cutoff = _utc_today() - timedelta(days=retention_days)
+    out = []
+    for name in db.execute(sql_text(LIST_PARTITIONS_SQL), {"parent": table}).scalars():
+        m = PARTITION_RE.match(name)
+        if not m or m.group(1) != table:
+            continue  # *_default and foreign names are never touched
+        day = datetime.strptime(m.group(2), "%Y%m%d").date()
+        if day + timedelta(days=1) <= cutoff:
+            out.append(name)
+    return out
+
+
+def _lock_not_available(e: OperationalError) -> bool:
+    return getattr(e.orig, "pgcode", None) == "55P03"  # lock_not_available
+
+
+def _detach(parent: str, name: str, *, archive_name: str | None = None) -> str:
+    """DETACH + DROP (or rename) in one short transaction under LOCK_TIMEOUT."""
+    try:
+        with SessionLocal() as db:
+            with db.begin():
+                db.execute(sql_text("SELECT set_config('lock_timeout', :t, true)"), {"t": LOCK_TIMEOUT})
+                db.execute(sql_text(f'ALTER TABLE {parent} DETACH PARTITION "{name}"'))
+                if archive_name:
+                    db.execute(sql_text(f'ALTER TABLE "{name}" RENAME TO "{archive_name}"'))
+                else:
+                    db.execute(sql_text(f'DROP TABLE "{name}"'))
+    except OperationalError as e:
+        if not _lock_not_available(e):
+            raise
+        return f"kept (lock timeout {LOCK_TIMEOUT}, next run)"
+    return f"archived as {archive_name}" if archive_name else "dropped"
+
+
+def retire_partition(name: str, *, archive: bool) -> str:
+    """
+    Check first, without touching the parent: a partition with any row not yet sent/dead stays attached.
+    sent/dead are final and nothing is inserted into a day past retention, so the check cannot go stale;
+    only then DETACH, which locks outbox_events for as long as the DETACH itself (see LOCK_TIMEOUT).
+    """
+    with SessionLocal() as db:
+        pending = db.execute(
+            sql_text(f"SELECT 1 FROM \"{name}\" WHERE status NOT IN ('sent','dead') LIMIT 1")
+        ).first()
+    if pending is not None:
+        return "kept (pending rows)"
+
+    archive_name = name.replace("outbox_events_p", "outbox_events_archive_") if archive else None
+    return _detach("outbox_events", name, archive_name=archive_name)
+
+
+def drop_consumed_partition(name: str) -> str:
+    """
+    consumed_events rows have no state to wait for: past the horizon the consumer dedups by
+    the offset watermark instead of event_id, so the partition just goes.
+    """
+    return _detach("consumed_events", name)
+
+
+def purge_idempotency_keys(*, horizon_days: int) -> int:
+    total = 0
+    while True:
+        with SessionLocal() as db:
+            with db.begin():
+                res = db.execute(sql_text(DELETE_IDEM_SQL), {"days": horizon_days, "limit": IDEM_DELETE_BATCH})
+                n = getattr(res, "rowcount", 0) or 0
+        total += n
+        if n < IDEM_DELETE_BATCH:
+            return total
+
+
+def run_once(*, dry_run: bool = False) -> dict:
+    with SessionLocal() as db:
+        with db.begin():
+            created = []
+            if not dry_run:
+                created = ensure_partitions(db, days_ahead=PREMAKE_DAYS)
+                created += ensure_partitions(db, days_ahead=PREMAKE_DAYS, table="consumed_events")
+            expired = expired_partitions(db, retention_days=RETENTION_DAYS)
+            expired_consumed = expired_partitions(db, retention_days=CONSUMED_HORIZON_DAYS, table="consumed_events")
+
+    retired = {}
+    for name in expired:
+        retired[name] = "would retire" if dry_run else retire_partition(name, archive=ARCHIVE)
+    for name in expired_consumed:
+        retired[name] = "would drop" if dry_run else drop_consumed_partition(name)
+
+    purged = 0 if dry_run else purge_idempotency_keys(horizon_days=IDEM_HORIZON_DAYS)
+
+    return {
+        "ensured": created,
+        "retired": retired,
+        "idem_keys_purged": purged,
+        "retention_days": RETENTION_DAYS,
+        "idem_horizon_days": IDEM_HORIZON_DAYS,
+        "consumed_horizon_days": CONSUMED_HORIZON_DAYS,
+        "archive": ARCHIVE,
+    }
+
+
+def main():
+    if IDEM_HORIZON_DAYS < RETENTION_DAYS:
+        print(f"[retention] WARN: idem horizon ({IDEM_HORIZON_DAYS}d) < retention ({RETENTION_DAYS}d)")
+    print(f"[retention] retention={RETENTION_DAYS}d idem_horizon={IDEM_HORIZON_DAYS}d "
+          f"consumed_horizon={CONSUMED_HORIZON_DAYS}d premake={PREMAKE_DAYS}d archive={ARCHIVE} every={EVERY_SEC}s")
+
+    try:
+        while True:
+            try:
+                res = run_once()
+                for name, outcome in res["retired"].items():
+                    print(f"[retention] {name}: {outcome}")
+                if res["idem_keys_purged"]:
+                    print(f"[retention] idem_keys_purged={res['idem_keys_purged']}")
+            except Exception as e:
+                print(f"[retention] ERROR: {type(e).__name__}: {e}")
+            time.sleep(EVERY_SEC)
+    except KeyboardInterrupt:
+        print("[retention] stopping...")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--once", action="store_true", help="run one maintenance pass and exit")
+    ap.add_argument("--dry-run", action="store_true", help="only list partitions that would be retired")
+    args = ap.parse_args()
+
+    if args.once or args.dry_run:
+        print(json.dumps(run_once(dry_run=args.dry_run), ensure_ascii=False))
+        raise SystemExit(0)
+
+    main()
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 import json
-from datetime import datetime, timezone
-from typing import Any, Dict, Optional, Type
+import random
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Annotated, Any, Dict, List, Literal, Mapping, Optional, Tuple, Type
 
-from pydantic import BaseModel, Field, ValidationError, field_validator
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError, field_validator
+from typing_extensions import NotRequired, TypedDict
 from uuid import UUID
 
 class AggregateRef(BaseModel):
@@ -54,12 +57,57 @@ class SessionFinished(BaseModel):
     result: str
     final_state: Dict[str, Any]
 
+# ---- Payloads событий игры (main.py -> outbox_events) ----
+
+class GameCreated(BaseModel):
+    chat_id: int
+    owner_tg_user_id: int
+    status: str
+    phase: str
+    phase_seq: int = Field(ge=0)
+
+class PlayerReadySet(BaseModel):
+    chat_id: int
+    player_id: UUID
+    tg_user_id: int
+    phase_seq: int = Field(ge=0)
+
+class GameFinished(BaseModel):
+    chat_id: int
+
+class RoundStarted(BaseModel):
+    chat_id: int
+    round_num: int = Field(ge=0)
+    phase_seq: int = Field(ge=0)
+
+class PhaseChanged(BaseModel):
+    chat_id: int
+    new_phase: str
+    phase_seq: int = Field(ge=0)
+    round_num: Optional[int] = Field(default=None, ge=0)
+
+class RoundResolved(BaseModel):
+    chat_id: int
+    round_num: int = Field(ge=0)
+
 EVENT_PAYLOADS: Dict[str, Type[BaseModel]] = {
     "game_session.created": GameSessionCreated,
     "game_session.crisis.presented": CrisisPresented,
     "game_session.choice.made": ChoiceMade,
     "game_session.state.updated": StateUpdated,
     "game_session.finished": SessionFinished,
+    "game.created": GameCreated,
+    "player.ready_set": PlayerReadySet,
+    "game.finished": GameFinished,
+    "round.started": RoundStarted,
+    "phase.changed": PhaseChanged,
+    "round.resolved": RoundResolved,
+}
+
+# (type, schema_version) -> payload model; новая версия payload = новая запись здесь
+# (schema_version 2 меняет только конверт, payload'ы те же)
+PAYLOAD_MODELS: Dict[Tuple[str, int], Type[BaseModel]] = {
+    (t, v): m for t, m in EVENT_PAYLOADS.items() for v in (1, 2)
 }
 
 class UnknownEventType(Exception):
@@ -70,11 +118,14 @@ class InvalidEvent(Exception):
         super().__init__(message)
         self.details = details
 
-def parse_and_validate(raw: bytes) -> tuple[EventEnvelope, BaseModel]:
-    try:
-        data = json.loads(raw.decode("utf-8"))
-    except Exception as e:
-        raise InvalidEvent("invalid_json", {"error": str(e)})
+def parse_and_validate(raw: bytes, headers: Optional[Mapping[str, str]] = None) -> tuple[EventEnvelope, BaseModel]:
+    if is_compact(raw):
+        data = decode_compact(raw, headers or {})  # schema_version 2, см. ниже
+    else:
+        try:
+            data = json.loads(raw.decode("utf-8"))
+        except Exception as e:
+            raise InvalidEvent("invalid_json", {"error": str(e)})
 
     try:
         env = EventEnvelope.model_validate(data)
@@ -90,4 +141,180 @@ def parse_and_validate(raw: bytes) -> tuple[EventEnvelope, BaseModel]:
     except ValidationError as e:
         raise InvalidEvent("invalid_payload", e.errors())
 
-    return env, payload
\ No newline at end of file
+    return env, payload
+
+
+# ---- Fast path: валидация прямо из bytes ----
+# Envelope как TypedDict со строковыми полями: pydantic-core разбирает JSON и проверяет его за один проход
+# и возвращает обычный dict (значения как в JSON), без json.loads и без экземпляров моделей.
+# Те же правила, что у EventEnvelope; created_at проверяется регуляркой (смещение обязательно).
+
+UUID_PATTERN = r"^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$"
+RFC3339_PATTERN = r"^\d{4}-\d{2}-\d{2}[Tt ]\d{2}:\d{2}:\d{2}(\.\d+)?([Zz]|[+-]\d{2}:?\d{2})$"
+
+class _AggregateRefFast(TypedDict):
+    __pydantic_config__ = ConfigDict(extra="allow")
+    type: str
+    id: Annotated[str, Field(pattern=UUID_PATTERN)]
+
+class _EventEnvelopeFast(TypedDict):
+    __pydantic_config__ = ConfigDict(extra="allow")
+    schema_version: Annotated[int, Field(ge=1)]
+    event_id: Annotated[str, Field(pattern=UUID_PATTERN)]
+    type: str
+    aggregate: _AggregateRefFast
+    idempotency_key: NotRequired[Optional[str]]
+    created_at: Annotated[str, Field(pattern=RFC3339_PATTERN)]
+    payload: Dict[str, Any]
+
+ENVELOPE_ADAPTER = TypeAdapter(_EventEnvelopeFast)
+
+
+# ---- schema_version 2: компактный конверт ----
+# value:   {"v":2,"ts":<created_at, epoch ms>,"k":<idempotency_key>,"p":<payload>}  (без пробелов, "k" — если не null)
+# headers: x-event-id, x-event-type, x-aggregate-type, x-aggregate-id — по ним consumer делает dedup
+#          и маршрутизацию, не разбирая value; relay ставит timestamp записи Kafka = ts.
+# После разбора v2 разворачивается в dict формы v1 (schema_version=2): дальше код формы не различает.
+
+COMPACT_VERSION = 2
+COMPACT_PREFIX = b'{"v":2,'  # to_compact() всегда пишет "v" первым ключом
+
+H_EVENT_ID = "x-event-id"
+H_EVENT_TYPE = "x-event-type"
+H_AGGREGATE_TYPE = "x-aggregate-type"
+H_AGGREGATE_ID = "x-aggregate-id"
+
+class _CompactEnvelopeFast(TypedDict):
+    __pydantic_config__ = ConfigDict(extra="allow")
+    v: Literal[2]
+    ts: Annotated[int, Field(ge=0)]
+    k: NotRequired[Optional[str]]
+    p: Dict[str, Any]
+
+_RoutingHeaders = TypedDict("_RoutingHeaders", {
+    H_EVENT_ID: Annotated[str, Field(pattern=UUID_PATTERN)],
+    H_EVENT_TYPE: str,
+    H_AGGREGATE_TYPE: str,
+    H_AGGREGATE_ID: Annotated[str, Field(pattern=UUID_PATTERN)],
+})
+
+COMPACT_ADAPTER = TypeAdapter(_CompactEnvelopeFast)
+ROUTING_ADAPTER = TypeAdapter(_RoutingHeaders)
+
+def is_compact(raw: bytes) -> bool:
+    return raw[:len(COMPACT_PREFIX)] == COMPACT_PREFIX
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def epoch_ms(created_at: str) -> int:
+    ts = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        raise ValueError("created_at must be timezone-aware")
+    # целочисленно: float из timestamp() теряет микросекунды, int() усекает к нулю; // — floor, как в iso_from_ms
+    return (ts - EPOCH) // timedelta(milliseconds=1)
+
+@lru_cache(maxsize=4096)
+def _iso_second(sec: int) -> str:
+    # события одной пачки почти всегда из нескольких секунд: форматируем секунду один раз
+    return datetime.fromtimestamp(sec, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+def iso_from_ms(ms: int) -> str:
+    return f"{_iso_second(ms // 1000)}.{ms % 1000:03d}Z"
+
+def to_compact(env: Dict[str, Any]) -> Tuple[bytes, List[Tuple[str, bytes]], int]:
+    """Конверт v1 (dict) -> (value, headers, ts) для schema_version 2."""
+    ts = epoch_ms(env["created_at"])
+    body: Dict[str, Any] = {"v": COMPACT_VERSION, "ts": ts}
+    if env.get("idempotency_key") is not None:
+        body["k"] = env["idempotency_key"]
+    body["p"] = env.get("payload") or {}
+    headers = [
+        (H_EVENT_ID, str(env["event_id"]).encode("utf-8")),
+        (H_EVENT_TYPE, str(env["type"]).encode("utf-8")),
+        (H_AGGREGATE_TYPE, str(env["aggregate"]["type"]).encode("utf-8")),
+        (H_AGGREGATE_ID, str(env["aggregate"]["id"]).encode("utf-8")),
+    ]
+    value = json.dumps(body, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+    return value, headers, ts
+
+def from_compact(body: Mapping[str, Any], headers: Mapping[str, str]) -> Dict[str, Any]:
+    """value v2 (уже разобранный) + заголовки -> dict формы v1. KeyError, если чего-то нет."""
+    return {
+        "schema_version": COMPACT_VERSION,
+        "event_id": headers[H_EVENT_ID],
+        "type": headers[H_EVENT_TYPE],
+        "aggregate": {"type": headers[H_AGGREGATE_TYPE], "id": headers[H_AGGREGATE_ID]},
+        "idempotency_key": body.get("k"),
+        "created_at": iso_from_ms(body["ts"]),
+        "payload": body["p"],
+    }
+
+def decode_compact(raw: bytes, headers: Mapping[str, str]) -> Dict[str, Any]:
+    """Разбор v2 без валидации (аналог json.loads для v1); форма проверяется минимально."""
+    try:
+        body = json.loads(raw)
+    except ValueError as e:
+        raise InvalidEvent("invalid_json", {"error": str(e)})
+    if not isinstance(body, dict) or not isinstance(body.get("ts"), int) or not isinstance(body.get("p"), dict):
+        raise InvalidEvent("invalid_envelope", {"error": "ts / p missing"})
+    try:
+        return from_compact(body, headers)
+    except KeyError as e:
+        raise InvalidEvent("invalid_envelope", {"error": f"header {e.args[0]} missing"})
+
+def _invalid(e: ValidationError) -> InvalidEvent:
+    # битый JSON и битый конверт — одна ошибка pydantic, различаем по типу
+    errors = e.errors(include_url=False)
+    reason = "invalid_json" if any(err["type"] == "json_invalid" for err in errors) else "invalid_envelope"
+    return InvalidEvent(reason, errors)
+
+VALIDATION_MODES = ("full", "sampled", "envelope")
+
+@lru_cache(maxsize=None)
+def payload_validator(event_type: str, schema_version: int):
+    """Собирается один раз на (type, schema_version); None = модели нет."""
+    model = PAYLOAD_MODELS.get((event_type, schema_version))
+    return model.__pydantic_validator__ if model is not None else None
+
+class FastValidator:
+    """
+    validate(raw, headers=None) -> dict конверта (как после json.loads) или InvalidEvent / UnknownEventType.
+    Принимает v1 и v2 (по префиксу value); для v2 нужны заголовки сообщения, результат — dict формы v1.
+
+    full      конверт + payload каждого сообщения
+    sampled   конверт всегда, payload — у доли sample_rate сообщений (под нагрузкой)
+    envelope  только конверт
+
+    strict_types=False: тип без payload-модели проходит с проверенным конвертом
+    (parse_and_validate() в этом случае бросает UnknownEventType).
+    """
+
+    def __init__(self, mode: str = "full", *, sample_rate: float = 0.05, strict_types: bool = False):
+        if mode not in VALIDATION_MODES:
+            raise ValueError(f"mode must be one of {VALIDATION_MODES}, got {mode!r}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.strict_types = strict_types
+
+    def validate(self, raw: bytes, headers: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+        try:
+            if is_compact(raw):
+                env = from_compact(COMPACT_ADAPTER.validate_json(raw), ROUTING_ADAPTER.validate_python(headers or {}))
+            else:
+                env = ENVELOPE_ADAPTER.validate_json(raw)
+        except ValidationError as e:
+            raise _invalid(e)
+
+        if self.mode == "envelope" or (self.mode == "sampled" and random.random() >= self.sample_rate):
+            return env
+
+        validator = payload_validator(env["type"], env["schema_version"])
+        if validator is None:
+            if self.strict_types:
+                raise UnknownEventType(env["type"])
+            return env
+        try:
+            validator.validate_python(env["payload"])
+        except ValidationError as e:
+            raise InvalidEvent("invalid_payload", e.errors(include_url=False))
+        return env
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the services are flat scripts in the repo root (consumer.py, outbox_publisher.py, ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# outbox_publisher refuses to import without it; nothing in tests/ connects to the DB
+os.environ.setdefault("DATABASE_URL", "postgresql://unused@127.0.0.1:1/unused")
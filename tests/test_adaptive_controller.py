@@ -0,0 +1,74 @@
+import pytest
+
+import outbox_publisher as relay
+from outbox_publisher import AdaptiveController
+
+
+def controller(**kw) -> AdaptiveController:
+    args = dict(enabled=True, batch_size=100, batch_min=10, batch_max=1000,
+                poll_min=0.05, poll_max=1.0, target_cycle_sec=2.0, target_lag_sec=1.0)
+    args.update(kw)
+    return AdaptiveController(**args)
+
+
+def test_full_batch_with_old_backlog_doubles_up_to_max():
+    c = controller(batch_max=300)
+    c.on_batch(n=100, backlog_age_sec=5, cycle_sec=0.1, finalize_sec=0.01)
+    assert c.batch_size == 200
+    c.on_batch(n=200, backlog_age_sec=5, cycle_sec=0.1, finalize_sec=0.01)
+    assert c.batch_size == 300
+
+
+def test_fresh_backlog_does_not_grow():
+    c = controller()
+    c.on_batch(n=100, backlog_age_sec=0.2, cycle_sec=0.1, finalize_sec=0.01)
+    assert c.batch_size == 100
+
+
+def test_slow_cycle_halves_down_to_min():
+    c = controller(batch_size=30)
+    c.on_batch(n=30, backlog_age_sec=5, cycle_sec=3.0, finalize_sec=1.0)
+    assert c.batch_size == 15
+    c.on_batch(n=15, backlog_age_sec=5, cycle_sec=3.0, finalize_sec=1.0)
+    assert c.batch_size == 10
+
+
+def test_half_empty_batches_decay_slowly():
+    c = controller()
+    c.on_batch(n=10, backlog_age_sec=0, cycle_sec=0.01, finalize_sec=0.01)
+    assert c.batch_size == 75
+    for _ in range(50):
+        c.on_batch(n=1, backlog_age_sec=0, cycle_sec=0.01, finalize_sec=0.01)
+    assert c.batch_size == 10
+
+
+def test_idle_backs_off_and_rows_reset_the_poll():
+    c = controller()
+    for expected in (0.1, 0.2, 0.4, 0.8, 1.0, 1.0):
+        c.on_idle()
+        assert c.poll_sec == pytest.approx(expected)
+    c.on_batch(n=1, backlog_age_sec=0, cycle_sec=0.01, finalize_sec=0.01)
+    assert c.poll_sec == 0.05
+
+
+def test_fixed_poll_range():
+    # LISTEN on: poll_min == poll_max == the LISTEN fallback, backoff has nowhere to go
+    c = controller(poll_min=5.0, poll_max=5.0)
+    c.on_idle()
+    c.on_idle()
+    assert c.poll_sec == 5.0
+
+
+def test_disabled_keeps_the_static_settings():
+    c = controller(enabled=False)
+    c.on_batch(n=100, backlog_age_sec=50, cycle_sec=10, finalize_sec=1)
+    c.on_idle()
+    assert (c.batch_size, c.poll_sec) == (100, 0.05)
+    assert c.snapshot()["cycle_sec"] == 10
+
+
+def test_bounds_and_cycle_target_are_sane():
+    c = controller(batch_size=5, batch_min=10, batch_max=2, poll_min=0.5, poll_max=0.1, target_cycle_sec=1e6)
+    assert (c.batch_min, c.batch_max) == (5, 5)
+    assert c.poll_max == 0.5
+    assert c.target_cycle_sec == relay.LOCK_TTL_SEC / 3
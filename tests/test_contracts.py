@@ -0,0 +1,137 @@
+import json
+import uuid
+
+import pytest
+
+from services.contracts.contracts import (
+    COMPACT_PREFIX, H_EVENT_ID, FastValidator, InvalidEvent, UnknownEventType, decode_compact, epoch_ms,
+    is_compact, iso_from_ms, parse_and_validate, to_compact,
+)
+
+
+def envelope(event_type: str = "phase.changed", payload: dict | None = None, **kw) -> dict:
+    env = {
+        "schema_version": 1,
+        "event_id": str(uuid.uuid4()),
+        "type": event_type,
+        "aggregate": {"type": "game", "id": str(uuid.uuid4())},
+        "idempotency_key": None,
+        "created_at": "2026-10-17T10:00:00.291Z",
+        "payload": {"chat_id": -100123, "new_phase": "vote", "phase_seq": 3, "round_num": 1}
+        if payload is None else payload,
+    }
+    env.update(kw)
+    return env
+
+
+def raw(env: dict) -> bytes:
+    return json.dumps(env).encode("utf-8")
+
+
+def test_valid_event_returns_the_envelope_dict():
+    env = envelope()
+    assert FastValidator("full").validate(raw(env)) == env
+
+
+@pytest.mark.parametrize("mode", ["full", "sampled", "envelope"])
+def test_broken_json_and_envelope(mode):
+    v = FastValidator(mode)
+    with pytest.raises(InvalidEvent, match="invalid_json"):
+        v.validate(b'{"schema_version": 1,')
+    with pytest.raises(InvalidEvent, match="invalid_envelope"):
+        v.validate(raw(envelope(event_id="not-a-uuid")))
+    with pytest.raises(InvalidEvent, match="invalid_envelope"):
+        v.validate(raw({k: val for k, val in envelope().items() if k != "aggregate"}))
+
+
+def test_payload_checked_by_mode():
+    bad = raw(envelope(payload={"chat_id": 1, "new_phase": "vote", "phase_seq": -1}))
+    with pytest.raises(InvalidEvent, match="invalid_payload"):
+        FastValidator("full").validate(bad)
+    assert FastValidator("envelope").validate(bad)["payload"]["phase_seq"] == -1
+    assert FastValidator("sampled", sample_rate=0.0).validate(bad)
+    with pytest.raises(InvalidEvent, match="invalid_payload"):
+        FastValidator("sampled", sample_rate=1.0).validate(bad)
+
+
+def test_unknown_type():
+    unknown = raw(envelope("chat.renamed", payload={"title": "x"}))
+    assert FastValidator("full").validate(unknown)["type"] == "chat.renamed"
+    with pytest.raises(UnknownEventType):
+        FastValidator("full", strict_types=True).validate(unknown)
+
+
+def test_agrees_with_parse_and_validate():
+    env = envelope()
+    parsed, payload = parse_and_validate(raw(env))
+    fast = FastValidator("full").validate(raw(env))
+    assert str(parsed.event_id) == fast["event_id"]
+    assert payload.phase_seq == fast["payload"]["phase_seq"]
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        FastValidator("lenient")
+
+
+# ---- schema_version 2 (compact) ----
+
+def compact(env: dict) -> tuple[bytes, dict]:
+    value, headers, _ = to_compact(env)
+    return value, {k: v.decode("utf-8") for k, v in headers}
+
+
+def test_compact_round_trip():
+    env = envelope(idempotency_key="game:1:phase:3")
+    value, headers = compact(env)
+    assert is_compact(value) and value.startswith(COMPACT_PREFIX)
+    assert not is_compact(raw(env))
+    assert decode_compact(value, headers) == {**env, "schema_version": 2}
+
+
+def test_compact_value_has_no_routing_fields():
+    env = envelope()
+    value, headers = compact(env)
+    body = json.loads(value)
+    assert set(body) == {"v", "ts", "p"}
+    assert body["ts"] == epoch_ms(env["created_at"])
+    assert headers[H_EVENT_ID] == env["event_id"]
+    assert len(value) < len(raw(env))
+
+
+def test_compact_missing_header():
+    value, headers = compact(envelope())
+    del headers[H_EVENT_ID]
+    with pytest.raises(InvalidEvent, match="invalid_envelope"):
+        decode_compact(value, headers)
+    with pytest.raises(InvalidEvent, match="invalid_envelope"):
+        FastValidator("full").validate(value, headers)
+
+
+def test_fast_validator_on_compact():
+    env = envelope()
+    value, headers = compact(env)
+    assert FastValidator("full").validate(value, headers) == decode_compact(value, headers)
+    parsed, payload = parse_and_validate(value, headers)
+    assert parsed.schema_version == 2 and payload.new_phase == "vote"
+
+    bad, bad_headers = compact(envelope(payload={"chat_id": 1, "new_phase": "vote", "phase_seq": -1}))
+    with pytest.raises(InvalidEvent, match="invalid_payload"):
+        FastValidator("full").validate(bad, bad_headers)
+
+
+@pytest.mark.parametrize("created_at, ms", [
+    ("1970-01-01T00:00:00Z", 0),
+    ("2026-10-17T10:00:00.291Z", 1792231200291),
+    ("2026-10-17T13:00:00.291+03:00", 1792231200291),
+    ("2026-10-17T10:00:00.291999+00:00", 1792231200291),  # truncated, not rounded
+    ("1969-12-31T23:59:59.999500+00:00", -1),  # floor, as iso_from_ms
+])
+def test_epoch_ms(created_at, ms):
+    assert epoch_ms(created_at) == ms
+    assert epoch_ms(iso_from_ms(ms)) == ms
+
+
+def test_epoch_ms_needs_a_timezone():
+    with pytest.raises(ValueError):
+        epoch_ms("2026-10-17T10:00:00")
@@ -0,0 +1,95 @@
+import asyncio
+import concurrent.futures
+import uuid
+from collections import namedtuple
+
+import pytest
+from kafka import TopicPartition
+
+import consumer
+from consumer import PartitionOffsets, _Worker, dead_letter_chunk
+
+TP = TopicPartition("game-events", 0)
+Record = namedtuple("Record", "topic partition offset key value headers")
+
+
+def record(offset: int, value: dict | None = None) -> Record:
+    game_id = str(uuid.uuid4())
+    if value is None:
+        value = {"event_id": str(uuid.uuid4()), "type": "player.joined", "aggregate": {"type": "game", "id": game_id},
+                 "created_at": "2026-10-17T10:00:00.000Z", "payload": {}}
+    return Record(TP.topic, TP.partition, offset, game_id, value, [])
+
+
+class FakeProducer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, key=None, value=None, headers=None):
+        self.sent.append((topic, key, value))
+
+
+@pytest.fixture
+def flushed(monkeypatch):
+    out = []
+    monkeypatch.setattr(consumer, "flush_dlq", lambda Session, dlq, pending, stats: out.extend(pending))
+    return out
+
+
+def test_dead_letter_chunk_sends_every_event(flushed):
+    dlq, stats = FakeProducer(), consumer._new_stats()
+    records = [record(1), record(2), record(3, value={"not": "an envelope"})]
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError as e:
+        dead_letter_chunk(None, dlq, records, e, stats)
+
+    assert [v["src"]["offset"] for _, _, v in dlq.sent] == [1, 2]
+    assert {v["reason"] for _, _, v in dlq.sent} == {"consumer_error"}
+    assert "RuntimeError: boom" in dlq.sent[0][2]["traceback"]
+    assert [i["offset"] for i, _, _ in flushed] == [1, 2]
+    assert (stats["errors"], stats["skipped"]) == (2, 1)
+
+
+def test_raising_worker_does_not_freeze_the_commit_point(monkeypatch, flushed):
+    def broken(self, work):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(_Worker, "_process", broken)
+    worker = _Worker(0, None, FakeProducer())
+    tracker = PartitionOffsets(TP)
+    for o in (10, 11, 12):
+        tracker.add(o)
+        worker.q.put((tracker, record(o)))
+    worker.q.put(None)
+    worker.run()
+
+    assert tracker.commit_offset() == 13
+    assert tracker.in_flight == 0
+    assert len(worker.dlq.sent) == 3
+
+
+def test_raising_apply_stage_does_not_freeze_the_commit_point(monkeypatch, flushed):
+    def broken(*args):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(consumer, "process_batch", broken)
+    pipeline = consumer.StagedPipeline(None, None, FakeProducer(), repair_Session=None, appliers=1, queue_size=1)
+    tracker = PartitionOffsets(TP)
+    chunk = []
+    for o in (10, 11, 12):
+        tracker.add(o)
+        r = record(o)
+        chunk.append((tracker, r, consumer._parse(r)))
+
+    async def run():
+        pipeline.loop = asyncio.get_running_loop()
+        pipeline.apply_qs = [asyncio.Queue()]
+        with concurrent.futures.ThreadPoolExecutor(1) as pipeline.executor:
+            await pipeline.apply_qs[0].put(chunk)
+            await pipeline.apply_qs[0].put(None)
+            await pipeline._apply(0)
+
+    asyncio.run(run())
+    assert tracker.commit_offset() == 13
+    assert len(pipeline.dlq.sent) == 3
@@ -0,0 +1,72 @@
+import threading
+import uuid
+
+from consumer import DedupCache
+
+
+def ids(n: int) -> list[str]:
+    return [str(uuid.uuid4()) for _ in range(n)]
+
+
+def test_disabled_cache_sends_everything_to_the_db():
+    cache = DedupCache(lru_size=0, bloom_capacity=1000)
+    cache.add_many(ids(3))
+    assert not cache.enabled
+    assert cache.is_known("anything") is False
+    assert cache.maybe_consumed("anything") is True
+
+
+def test_added_ids_are_known_and_maybe_consumed():
+    cache = DedupCache(lru_size=100, bloom_capacity=1000)
+    seen = ids(50)
+    cache.add_many(seen)
+    assert all(cache.is_known(e) for e in seen)
+    assert all(cache.maybe_consumed(e) for e in seen)
+
+
+def test_bloom_miss_rate_for_unseen_ids():
+    cache = DedupCache(lru_size=100, bloom_capacity=1000, fp_rate=0.01)
+    cache.add_many(ids(1000))
+    unseen = ids(5000)
+    assert not any(cache.is_known(e) for e in unseen)
+    assert sum(cache.maybe_consumed(e) for e in unseen) < 5000 * 0.03
+
+
+def test_lru_evicts_least_recently_used():
+    cache = DedupCache(lru_size=3, bloom_capacity=1000)
+    a, b, c, d = ids(4)
+    cache.add_many([a, b, c])
+    assert cache.is_known(a)  # a becomes the most recent
+    cache.add_many([d])
+    assert not cache.is_known(b)
+    assert all(cache.is_known(e) for e in (a, c, d))
+    assert cache.maybe_consumed(b)  # still in the Bloom filter
+
+
+def test_bloom_reset_on_overflow_keeps_the_lru():
+    cache = DedupCache(lru_size=10, bloom_capacity=100)
+    old, recent = ids(95), ids(10)
+    cache.add_many(old)
+    cache.add_many(recent)  # count > capacity: rebuilt from the LRU only
+    assert cache._count == 10
+    assert all(cache.maybe_consumed(e) for e in recent)
+    assert sum(cache.maybe_consumed(e) for e in old) < 10
+
+
+def test_concurrent_writers():
+    cache = DedupCache(lru_size=1000, bloom_capacity=3000)
+    chunks = [ids(2000) for _ in range(4)]
+
+    def work(chunk):
+        for i in range(0, len(chunk), 50):
+            cache.add_many(chunk[i:i + 50])
+            for e in chunk[i:i + 50]:
+                cache.maybe_consumed(e)
+
+    threads = [threading.Thread(target=work, args=(c,)) for c in chunks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache._lru) == 1000
+    assert all(cache.maybe_consumed(e) for e in list(cache._lru))
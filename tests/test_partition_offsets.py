@@ -0,0 +1,80 @@
+from collections import namedtuple
+
+from kafka import TopicPartition
+
+from consumer import PartitionOffsets, TrackedOffsets
+
+TP = TopicPartition("game-events", 0)
+Record = namedtuple("Record", "topic partition offset")
+
+
+def tracker(*offsets: int) -> PartitionOffsets:
+    t = PartitionOffsets(TP)
+    for o in offsets:
+        t.add(o)
+    return t
+
+
+def test_nothing_completed():
+    t = tracker(10, 11)
+    assert t.commit_offset() is None
+    assert t.in_flight == 2
+
+
+def test_commit_stops_at_first_incomplete():
+    t = tracker(10, 11, 12, 13)
+    t.complete(11)
+    t.complete(12)
+    assert t.commit_offset() is None  # 10 still in flight
+    t.complete(10)
+    assert t.commit_offset() == 13
+    assert t.in_flight == 1
+    t.complete(13)
+    assert t.commit_offset() == 14
+    assert t.in_flight == 0
+
+
+def test_offsets_with_gaps():
+    # compacted topic / transaction markers: dispatched offsets are not consecutive
+    t = tracker(5, 9, 20)
+    t.complete(9)
+    t.complete(5)
+    assert t.commit_offset() == 10
+
+
+def test_nothing_new_since_last_commit():
+    t = tracker(1, 2)
+    t.complete(1)
+    assert t.commit_offset() == 2
+    t.committed = 2
+    assert t.commit_offset() is None
+    t.complete(2)
+    assert t.commit_offset() == 3
+
+
+class FakeConsumer:
+    def __init__(self):
+        self.commits = []
+
+    def commit(self, offsets):
+        self.commits.append({tp: om.offset for tp, om in offsets.items()})
+
+
+def test_tracked_offsets_commit_per_partition():
+    consumer = FakeConsumer()
+    tracked = TrackedOffsets(consumer)
+    other = TopicPartition("game-events", 1)
+    a = [tracked.track(Record(TP.topic, TP.partition, o)) for o in (0, 1, 2)][0]
+    b = tracked.track(Record(other.topic, other.partition, 7))
+
+    a.complete(1)
+    tracked.commit()
+    assert consumer.commits == []
+
+    a.complete(0)
+    b.complete(7)
+    tracked.commit()
+    assert consumer.commits == [{TP: 2, other: 8}]
+
+    tracked.commit()  # nothing new
+    assert len(consumer.commits) == 1
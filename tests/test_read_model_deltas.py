@@ -0,0 +1,81 @@
+from consumer import fold_read_model_deltas
+
+G1 = "00000000-0000-0000-0000-000000000001"
+G2 = "00000000-0000-0000-0000-000000000002"
+
+
+def ev(event_type: str, game_id: str = G1, created_at: str = "2026-10-17T10:00:00.000Z", **payload) -> dict:
+    return {
+        "aggregate_id": game_id,
+        "event_type": event_type,
+        "msg": {"event_type": event_type, "created_at": created_at, "payload": payload},
+    }
+
+
+def test_one_delta_per_game():
+    deltas, recompute = fold_read_model_deltas([
+        ev("player.joined"),
+        ev("player.joined"),
+        ev("player.joined", G2),
+        ev("round.started", round_num=2),
+    ])
+    assert recompute == set()
+    assert set(deltas) == {G1, G2}
+    assert deltas[G1]["players_inc"] == 2
+    assert deltas[G1]["round_num"] == 2
+    assert deltas[G2]["players_inc"] == 1
+
+
+def test_phase_change_resets_ready_and_latest_phase_wins():
+    deltas, _ = fold_read_model_deltas([
+        ev("phase.changed", phase_seq=3, new_phase="vote", round_num=1, created_at="2026-10-17T10:00:03.000Z"),
+        ev("player.ready_set", phase_seq=3),
+        ev("phase.changed", phase_seq=4, new_phase="night", round_num=1, created_at="2026-10-17T10:00:04.000Z"),
+        ev("player.ready_set", phase_seq=4),
+        ev("player.ready_set", phase_seq=4),
+    ])
+    d = deltas[G1]
+    assert (d["new_phase"], d["phase_seq"], d["round_num"]) == ("night", 4, 1)
+    assert d["phase_started_at"] == "2026-10-17T10:00:04.000Z"
+    assert (d["ready_seq"], d["ready_inc"]) == (4, 2)
+
+
+def test_out_of_order_phase_is_ignored():
+    deltas, _ = fold_read_model_deltas([
+        ev("phase.changed", phase_seq=5, new_phase="day"),
+        ev("phase.changed", phase_seq=4, new_phase="night"),
+        ev("player.ready_set", phase_seq=4),  # phase already over
+    ])
+    d = deltas[G1]
+    assert (d["new_phase"], d["phase_seq"], d["ready_inc"]) == ("day", 5, 0)
+
+
+def test_ready_without_its_phase_in_the_batch():
+    deltas, _ = fold_read_model_deltas([ev("player.ready_set", phase_seq=7), ev("player.ready_set", phase_seq=7)])
+    assert (deltas[G1]["ready_seq"], deltas[G1]["ready_inc"]) == (7, 2)
+
+    # two different phases and no phase.changed: the order cannot be folded
+    deltas, recompute = fold_read_model_deltas([ev("player.ready_set", phase_seq=7), ev("player.ready_set", phase_seq=8)])
+    assert deltas == {} and recompute == {G1}
+
+
+def test_status_events():
+    deltas, _ = fold_read_model_deltas([ev("game.finished"), ev("game.archived", G2)])
+    assert deltas[G1]["status"] == "finished"
+    assert deltas[G2]["status"] == "archived"
+
+
+def test_unknown_or_broken_events_fall_back_to_recompute():
+    deltas, recompute = fold_read_model_deltas([
+        ev("player.joined"),
+        ev("game.created"),            # no delta for it
+        ev("player.joined"),           # the game is recomputed anyway
+        ev("phase.changed", G2),       # payload without phase_seq
+    ])
+    assert deltas == {}
+    assert recompute == {G1, G2}
+
+
+def test_noop_types_touch_nothing():
+    deltas, recompute = fold_read_model_deltas([ev("round.resolved"), ev("snapshot.created")])
+    assert deltas == {} and recompute == set()
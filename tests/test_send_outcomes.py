@@ -0,0 +1,25 @@
+from outbox_publisher import send_outcomes
+
+ERR = TimeoutError("no ack")
+
+
+def test_all_acked():
+    assert send_outcomes(["a", "a", "b"], [None, None, None], ordered=True) == ["sent", "sent", "sent"]
+
+
+def test_aggregate_stops_after_its_first_failure():
+    keys = ["a", "b", "a", "a", "b", "a"]
+    errors = [ERR, None, ERR, None, None, ERR]
+    assert send_outcomes(keys, errors, ordered=True) == ["failed", "sent", "blocked", "sent", "sent", "blocked"]
+
+
+def test_each_aggregate_has_its_own_cut_off():
+    keys = ["a", "b", "a", "b"]
+    errors = [None, ERR, ERR, ERR]
+    assert send_outcomes(keys, errors, ordered=True) == ["sent", "failed", "failed", "blocked"]
+
+
+def test_unordered_counts_every_failure():
+    keys = ["a", "a", "a"]
+    errors = [ERR, ERR, None]
+    assert send_outcomes(keys, errors, ordered=False) == ["failed", "failed", "sent"]